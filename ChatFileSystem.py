@@ -1,11 +1,59 @@
 import sqlite3
 import json
-from datetime import datetime
-from utils import ChatObject  # Assuming ChatObject has already been updated as discussed.
+from datetime import datetime, timedelta
+from itertools import islice
+from utils import ChatObject, LazyChatObject  # Assuming ChatObject has already been updated as discussed.
+
+# Columns with one entry per message, and with one entry per reply (turn)
+MESSAGE_COLUMNS = ('messages',)
+TURN_COLUMNS = ('reply_times', 'addressed_models', 'turn_metrics')
+READ_ALL = 1 << 62  # Upper bound for json_each keys
+
+
+def as_text(value):
+    # Text columns written by a streamed import are BLOBs of UTF-8 text (see ChatMemory.finish_import)
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+def prefix_digests(messages, counts) -> dict:
+    # {count: fingerprint of the first count messages} in one pass, tells whether a branch still matches its parent
+    import hashlib
+    digest = hashlib.sha1()
+    digests, position = {}, 0
+    for count in sorted(set(counts)):
+        for role, content in islice(zip(messages.roles, messages.contents), position, count):
+            digest.update(f"{role}\0{content}\0".encode("utf-8", "surrogatepass"))
+        position = count
+        digests[count] = digest.hexdigest()
+    return digests
+
+
+def shares_prefix(messages, count: int, digest: str) -> bool:
+    return len(messages) >= count and prefix_digests(messages, [count])[count] == digest
+
+
+def chain_segments(chain, per_turn=False) -> list:
+    """
+    [(chat id, first index, count)] that make up a column of the last chat of the chain (root first), count is
+    None for all of its own entries. A branch stores only the entries after its fork point, the ones before it
+    come from its ancestors; per_turn for the columns with one entry per reply.
+    """
+    segments, limit = [], None
+    for chat_id, fork_point in reversed(chain):
+        start = fork_point // 2 if per_turn else fork_point
+        if limit is None:
+            segments.append((chat_id, start, None))
+        elif limit > start:
+            segments.append((chat_id, start, limit - start))
+        limit = start if limit is None else min(limit, start)
+    return segments[::-1]
+
 
 class ChatMemory:
     def __init__(self, db_path='chats.db'):
         self.db_path = db_path
+        # Callbacks listener(chat_id, chat_object) run after a chat is written, chat_object is None on deletion
+        self.change_listeners = []
         self._initialize_database()
 
     def _initialize_database(self):
@@ -18,69 +66,346 @@ class ChatMemory:
                 messages TEXT,
                 reply_times TEXT,
                 addressed_models TEXT,
-                instructions TEXT
+                instructions TEXT,
+                options TEXT,
+                turn_metrics TEXT,
+                kv_context TEXT,
+                parent_id TEXT,  -- Branches: the chat they were forked from
+                fork_point INTEGER,  -- Messages shared with the parent, not stored in this row
+                prefix_digest TEXT  -- Fingerprint of the shared messages, see prefix_digests
+            )
+        ''')
+        # Databases created before these columns existed are migrated in place
+        self._ensure_column(cursor, 'chats', 'options', 'TEXT')
+        self._ensure_column(cursor, 'chats', 'turn_metrics', 'TEXT')
+        self._ensure_column(cursor, 'chats', 'kv_context', 'TEXT')
+        self._ensure_column(cursor, 'chats', 'parent_id', 'TEXT')
+        self._ensure_column(cursor, 'chats', 'fork_point', 'INTEGER')
+        self._ensure_column(cursor, 'chats', 'prefix_digest', 'TEXT')
+        cursor.execute('CREATE INDEX IF NOT EXISTS chats_parent ON chats (parent_id)')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS import_batches (
+                import_id TEXT NOT NULL,
+                column_name TEXT NOT NULL,
+                batch INTEGER NOT NULL,
+                items TEXT NOT NULL,  -- JSON array, a slice of the column
+                PRIMARY KEY (import_id, column_name, batch)
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS model_options (
+                model TEXT PRIMARY KEY,
+                options TEXT NOT NULL
             )
         ''')
         conn.commit()
         conn.close()
 
+    def _ensure_column(self, cursor, table, column, column_type):
+        cursor.execute(f'PRAGMA table_info({table})')
+        if column not in [row[1] for row in cursor.fetchall()]:
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+
+    def add_change_listener(self, listener):
+        self.change_listeners.append(listener)
+
+    def _notify_change(self, chat_id: str, chat_object: ChatObject = None):
+        for listener in self.change_listeners:
+            listener(chat_id, chat_object)
+
     def add_chat(self, chat_object: ChatObject):
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
 
         cursor.execute('''
-            INSERT INTO chats (timestamp, name, messages, reply_times, addressed_models, instructions)
-            VALUES (?, ?, ?, ?, ?, ?)
+            INSERT INTO chats (timestamp, name, messages, reply_times, addressed_models, instructions,
+                               options, turn_metrics, kv_context)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
         ''', (
             chat_object.creation_time,  # Use the timestamp as the unique identifier
             chat_object.name,
-            json.dumps(chat_object.messages),
-            json.dumps(chat_object.reply_times),
+            json.dumps(chat_object.messages.tolist()),
+            json.dumps(list(chat_object.reply_times)),
             json.dumps(chat_object.addressed_models),
-            chat_object.instructions
+            chat_object.instructions,
+            json.dumps(chat_object.options),
+            json.dumps(chat_object.turn_metrics),
+            json.dumps(chat_object.kv_context)
         ))
 
         conn.commit()
         conn.close()
+        self._notify_change(chat_object.creation_time, chat_object)
+
+    def add_chat_rows(self, rows: list) -> list:
+        """
+        Several chats in one transaction (bulk_import.py): each row has the values of add_chat's columns after
+        the id, in the same order, with the JSON ones already encoded. The ids are allocated in the transaction,
+        from now or one microsecond after the newest stored id, so they never collide with stored chats or
+        with another import. Returns the ids, in the order of the rows.
+        """
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('BEGIN IMMEDIATE')  # Holds the write lock from reading the newest id to the commit
+        newest = conn.execute('SELECT MAX(timestamp) FROM chats').fetchone()[0]
+        next_id = datetime.now()
+        if newest is not None:
+            try:
+                next_id = max(next_id, datetime.fromisoformat(newest) + timedelta(microseconds=1))
+            except ValueError:
+                pass  # Not an ISO timestamp (hand edited database), start from now
+        ids = [(next_id + timedelta(microseconds=offset)).isoformat(timespec="microseconds")
+               for offset in range(len(rows))]
+        conn.executemany('''
+            INSERT INTO chats (timestamp, name, messages, reply_times, addressed_models, instructions,
+                               options, turn_metrics, kv_context)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', [(chat_id, *row) for chat_id, row in zip(ids, rows)])
+        conn.commit()
+        conn.close()
+        if self.change_listeners:
+            for chat_id in ids:
+                self._notify_change(chat_id, self.get_chat_by_timestamp(chat_id))
+        return ids
+
+    # ---- streamed imports (see chat_import.py) ----
+    def stage_import_batch(self, import_id: str, column: str, batch: int, items: str):
+        # A slice of a history column (non-empty JSON array text), kept aside until finish_import
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('INSERT OR REPLACE INTO import_batches (import_id, column_name, batch, items) VALUES (?, ?, ?, ?)',
+                     (import_id, column, batch, items))
+        conn.commit()
+        conn.close()
+
+    def finish_import(self, import_id: str, chat_object: ChatObject):
+        """
+        Adds the chat with the staged slices as its history (the history of chat_object is ignored), in memory
+        bounded by a slice whatever the size of the export. The row is inserted with zero filled BLOBs of the
+        final sizes, which SQLite writes to disk without building them in memory, as long as only zeroblobs and
+        NULLs follow them in the row. So the header columns that come after messages (instructions, options,
+        kv_context) are created the same way, and everything is then written in place through blob I/O, the
+        history one slice at a time. These columns stay BLOBs of UTF-8 text until the chat is saved again:
+        readers decode either (json.loads takes bytes, as_text, SQL casts them to TEXT).
+        """
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        columns = MESSAGE_COLUMNS + TURN_COLUMNS
+        sizes = []
+        for column in columns:
+            cursor.execute('''
+                SELECT COUNT(*), TOTAL(length(CAST(items AS BLOB))) FROM import_batches
+                WHERE import_id = ? AND column_name = ?
+            ''', (import_id, column))
+            batches, total = cursor.fetchone()
+            # '[' + the slices without their brackets, joined by ', ' + ']'
+            sizes.append(2 + int(total) - 2 * batches + 2 * max(batches - 1, 0))
+        header = {'instructions': chat_object.instructions.encode('utf-8'),
+                  'options': json.dumps(chat_object.options).encode('utf-8'),
+                  'kv_context': json.dumps(chat_object.kv_context).encode('utf-8')}
+        cursor.execute('''
+            INSERT INTO chats (timestamp, name, messages, reply_times, addressed_models, turn_metrics,
+                               instructions, options, kv_context)
+            VALUES (?, ?, zeroblob(?), zeroblob(?), zeroblob(?), zeroblob(?), zeroblob(?), zeroblob(?), zeroblob(?))
+        ''', (chat_object.creation_time, chat_object.name, *sizes, *[len(value) for value in header.values()]))
+        row_id = cursor.lastrowid
+        for column, value in header.items():
+            if value:
+                with conn.blobopen('chats', column, row_id) as blob:
+                    blob.write(value)
+        for column in columns:
+            with conn.blobopen('chats', column, row_id) as blob:
+                blob.write(b'[')
+                separator = b''
+                for (items,) in conn.execute('''
+                    SELECT items FROM import_batches WHERE import_id = ? AND column_name = ? ORDER BY batch
+                ''', (import_id, column)):
+                    blob.write(separator + items[1:-1].encode('utf-8'))
+                    separator = b', '
+                blob.write(b']')
+        cursor.execute('DELETE FROM import_batches WHERE import_id = ?', (import_id,))
+
+        conn.commit()
+        conn.close()
+        if self.change_listeners:
+            # Opened lazily, listeners that need the history load it
+            self._notify_change(chat_object.creation_time, LazyChatObject.open(self, chat_object.creation_time))
+
+    def abort_import(self, import_id: str):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('DELETE FROM import_batches WHERE import_id = ?', (import_id,))
+        conn.commit()
+        conn.close()
 
     def get_chat_by_timestamp(self, timestamp: str) -> ChatObject:
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
 
-        cursor.execute('SELECT * FROM chats WHERE timestamp = ?', (timestamp,))
-        chat_data = cursor.fetchone()
+        chat_object = self._load_chat(cursor, timestamp)
         conn.close()
 
-        if chat_data:
-            return self._row_to_chat_object(chat_data)
-        return None
+        return chat_object
+
+    def _chain(self, cursor, chat_id: str) -> list:
+        # [(chat id, fork point)] from the root of the chat's branch tree down to the chat, [] if it doesn't exist
+        cursor.execute('''
+            WITH RECURSIVE chain(id, parent, fork_point, depth) AS (
+                SELECT timestamp, parent_id, fork_point, 0 FROM chats WHERE timestamp = ?
+                UNION ALL
+                SELECT chats.timestamp, chats.parent_id, chats.fork_point, chain.depth + 1
+                FROM chats JOIN chain ON chats.timestamp = chain.parent
+            )
+            SELECT id, fork_point FROM chain ORDER BY depth DESC
+        ''', (chat_id,))
+        return [(row_id, fork_point or 0) for row_id, fork_point in cursor.fetchall()]
+
+    def _load_chat(self, cursor, chat_id: str) -> ChatObject:
+        cursor.execute('SELECT * FROM chats WHERE timestamp = ?', (chat_id,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        chat_object = self._row_to_chat_object(row)
+        if row[9] is None:
+            return chat_object
+        # A branch: its shared history is read from the chats it was forked from
+        chain = self._chain(cursor, chat_id)
+        for column in MESSAGE_COLUMNS + TURN_COLUMNS:
+            values = []
+            for row_id, _, count in chain_segments(chain, per_turn=column in TURN_COLUMNS):
+                cursor.execute(f'SELECT {column} FROM chats WHERE timestamp = ?', (row_id,))
+                own = json.loads(cursor.fetchone()[0] or '[]')
+                values.extend(own if count is None else own[:count])
+            setattr(chat_object, column, values)
+        return chat_object
+
+    def _own_columns(self, chat_object: ChatObject, fork_point: int) -> tuple:
+        # JSON of the history a row stores itself: all of it, or what comes after the fork point of a branch
+        turns = fork_point // 2
+        return (json.dumps(chat_object.messages[fork_point:] if fork_point else chat_object.messages.tolist()),
+                json.dumps(list(chat_object.reply_times)[turns:]),
+                json.dumps(chat_object.addressed_models[turns:]),
+                json.dumps(chat_object.turn_metrics[turns:]))
+
+    def _rebase_children(self, cursor, chat_id: str, messages=None):
+        """
+        Copy on write: branches of the chat whose shared messages are about to change (all of them when messages
+        is None, i.e. the chat is deleted) get a copy of the part they can no longer share. They move up to the
+        chat's own parent when they forked within the history it shares with that parent.
+        """
+        cursor.execute('SELECT timestamp, fork_point, prefix_digest FROM chats WHERE parent_id = ?', (chat_id,))
+        children = cursor.fetchall()
+        if messages is not None and children:
+            digests = prefix_digests(messages, [fork_point for _, fork_point, _ in children
+                                                if fork_point <= len(messages)])
+            children = [child for child in children if digests.get(child[1]) != child[2]]
+        if not children:
+            return
+        old = self._load_chat(cursor, chat_id)
+        cursor.execute('SELECT parent_id, fork_point FROM chats WHERE timestamp = ?', (chat_id,))
+        parent_id, parent_fork_point = cursor.fetchone()
+        parent_fork_point = (parent_fork_point or 0) if parent_id is not None else 0
+        old_columns = {'messages': old.messages, 'reply_times': list(old.reply_times),
+                       'addressed_models': old.addressed_models, 'turn_metrics': old.turn_metrics}
+        for child_id, fork_point, _ in children:
+            new_fork_point = min(fork_point, parent_fork_point)
+            cursor.execute(f'SELECT {", ".join(old_columns)} FROM chats WHERE timestamp = ?', (child_id,))
+            values = []
+            for column, own in zip(old_columns, cursor.fetchone()):
+                scale = 2 if column in TURN_COLUMNS else 1
+                copied = old_columns[column][new_fork_point // scale:fork_point // scale]
+                values.append(json.dumps(list(copied) + json.loads(own or '[]')))
+            cursor.execute('''
+                UPDATE chats
+                SET messages = ?, reply_times = ?, addressed_models = ?, turn_metrics = ?,
+                    parent_id = ?, fork_point = ?, prefix_digest = ?
+                WHERE timestamp = ?
+            ''', (*values, parent_id if new_fork_point else None, new_fork_point,
+                  prefix_digests(old.messages, [new_fork_point])[new_fork_point] if new_fork_point else None,
+                  child_id))
 
     def update_chat(self, chat_object: ChatObject):
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
 
+        chat_id = chat_object.creation_time
+        cursor.execute('SELECT parent_id, fork_point, prefix_digest FROM chats WHERE timestamp = ?', (chat_id,))
+        parent_id, fork_point, digest = cursor.fetchone() or (None, 0, None)
+        fork_point = fork_point or 0
+        self._rebase_children(cursor, chat_id, chat_object.messages)
+        if parent_id is not None and not shares_prefix(chat_object.messages, fork_point, digest):
+            # The history before the fork point changed (e.g. cleared), the branch stores all of it from now on
+            parent_id, fork_point, digest = None, 0, None
+
         cursor.execute('''
             UPDATE chats
-            SET messages = ?, reply_times = ?, addressed_models = ?, instructions = ?
+            SET messages = ?, reply_times = ?, addressed_models = ?, turn_metrics = ?, instructions = ?, options = ?,
+                kv_context = ?, parent_id = ?, fork_point = ?, prefix_digest = ?
             WHERE timestamp = ?
         ''', (
-            json.dumps(chat_object.messages),
-            json.dumps(chat_object.reply_times),
-            json.dumps(chat_object.addressed_models),
+            *self._own_columns(chat_object, fork_point),
             chat_object.instructions,
-            chat_object.creation_time  # Use the timestamp to identify which chat to update
+            json.dumps(chat_object.options),
+            json.dumps(chat_object.kv_context),
+            parent_id,
+            fork_point,
+            digest,
+            chat_id  # Use the timestamp to identify which chat to update
         ))
 
         conn.commit()
         conn.close()
+        self._notify_change(chat_object.creation_time, chat_object)
+
+    def fork_chat(self, chat_id: str, message_count: int, name: str) -> ChatObject:
+        """
+        New chat continuing from the first message_count messages of a stored chat. The shared messages are
+        not copied: the branch row only refers to them, and stores what is added to the branch afterwards.
+        """
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        parent = self._load_chat(cursor, chat_id)
+        if parent is None:
+            conn.close()
+            raise KeyError(chat_id)
+        if not 0 < message_count <= len(parent.messages):
+            conn.close()
+            raise ValueError(f"Cannot branch after message {message_count}, the chat has {len(parent.messages)}")
+        turns = message_count // 2
+        branch = ChatObject(name,
+                            messages=parent.messages[:message_count],
+                            reply_times=list(parent.reply_times)[:turns],
+                            addressed_models=parent.addressed_models[:turns],
+                            instructions=parent.instructions,
+                            options=dict(parent.options),
+                            turn_metrics=parent.turn_metrics[:turns])
+        cursor.execute('''
+            INSERT INTO chats (timestamp, name, messages, reply_times, addressed_models, instructions,
+                               options, turn_metrics, kv_context, parent_id, fork_point, prefix_digest)
+            VALUES (?, ?, '[]', '[]', '[]', ?, ?, '[]', '{}', ?, ?, ?)
+        ''', (
+            branch.creation_time,
+            branch.name,
+            branch.instructions,
+            json.dumps(branch.options),
+            chat_id,
+            message_count,
+            prefix_digests(parent.messages, [message_count])[message_count]
+        ))
+
+        conn.commit()
+        conn.close()
+        self._notify_change(branch.creation_time, branch)
+        return branch
 
     def delete_chat_by_timestamp(self, timestamp: str):
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
 
+        self._rebase_children(cursor, timestamp)
         cursor.execute('DELETE FROM chats WHERE timestamp = ?', (timestamp,))
         conn.commit()
         conn.close()
+        self._notify_change(timestamp)
 
     def list_chat_names(self):
         conn = sqlite3.connect(self.db_path)
@@ -92,6 +417,28 @@ class ChatMemory:
 
         return chat_names
 
+    def list_chats(self):
+        # [(chat id, name)] of all chats in one query
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        cursor.execute('SELECT timestamp, name FROM chats')
+        chats = cursor.fetchall()
+        conn.close()
+
+        return chats
+
+    def list_chat_tree(self):
+        # [(chat id, name, parent chat id or None, fork point)] of all chats
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        cursor.execute('SELECT timestamp, name, parent_id, COALESCE(fork_point, 0) FROM chats')
+        chats = cursor.fetchall()
+        conn.close()
+
+        return chats
+
     def get_chat_name(self, chat_id: str) -> str:
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
@@ -120,21 +467,157 @@ class ChatMemory:
             messages=json.loads(row[2]),
             reply_times=json.loads(row[3]),
             addressed_models=json.loads(row[4]),
-            instructions=row[5],
-            creation_time=row[0]  # Use timestamp as creation time
+            instructions=as_text(row[5]),
+            creation_time=row[0],  # Use timestamp as creation time
+            options=json.loads(row[6]) if row[6] else {},  # NULL for chats stored before options existed
+            turn_metrics=json.loads(row[7]) if row[7] else [],
+            kv_context=json.loads(row[8]) if row[8] else {}
         )
 
+    def get_chat_header(self, chat_id: str) -> dict:
+        # {"name", "instructions", "options", "kv_context"} of a chat without its history, None if there is none
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        cursor.execute('SELECT name, instructions, options, kv_context FROM chats WHERE timestamp = ?', (chat_id,))
+        row = cursor.fetchone()
+        conn.close()
+
+        if row is None:
+            return None
+        return {"name": row[0], "instructions": as_text(row[1]) or "", "options": json.loads(row[2]) if row[2] else {},
+                "kv_context": json.loads(row[3]) if row[3] else {}}
+
+    def get_message_count(self, chat_id: str) -> int:
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        segments = chain_segments(self._chain(cursor, chat_id))
+        count = 0
+        if segments:
+            chat_id, start, _ = segments[-1]
+            cursor.execute('SELECT json_array_length(CAST(messages AS TEXT)) FROM chats WHERE timestamp = ?',
+                           (chat_id,))
+            count = start + cursor.fetchone()[0]
+        conn.close()
+
+        return count
+
+    def list_message_counts(self) -> dict:
+        # chat id -> number of messages, counted by SQLite without decoding the histories.
+        # A branch stores the messages after its fork point, the ones before it are shared
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        cursor.execute('SELECT timestamp, COALESCE(fork_point, 0) + json_array_length(CAST(messages AS TEXT)) '
+                       'FROM chats')
+        counts = dict(cursor.fetchall())
+        conn.close()
+
+        return counts
+
+    def _read_range(self, cursor, column: str, segments: list, start: int, stop: int = READ_ALL,
+                    select: str = 'value') -> list:
+        # [(index, *select)] of the entries start .. stop - 1 of a column, stitched from the segments of a branch
+        rows = []
+        for chat_id, offset, count in segments:
+            end = stop if count is None else min(stop, offset + count)
+            first = max(start, offset)
+            if end <= first:
+                continue
+            cursor.execute(f'''
+                SELECT key, {select} FROM chats, json_each(CAST(chats.{column} AS TEXT))
+                WHERE timestamp = ? AND key >= ? AND key < ?
+                ORDER BY key
+            ''', (chat_id, first - offset, end - offset))
+            rows.extend((offset + row[0], *row[1:]) for row in cursor.fetchall())
+        return rows
+
+    def get_message_sizes(self, chat_id: str, start: int = 0) -> list:
+        # [(is_user, characters, newlines)] per message from start on, measured by SQLite so that the contents
+        # never reach Python
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        content = "json_extract(value, '$.content')"
+        rows = self._read_range(cursor, 'messages', chain_segments(self._chain(cursor, chat_id)), start,
+                                select=f"json_extract(value, '$.role') = 'user', length({content}), "
+                                       f"length({content}) - length(replace({content}, char(10), ''))")
+        sizes = [(bool(is_user), characters, newlines) for _, is_user, characters, newlines in rows]
+        conn.close()
+
+        return sizes
+
+    def get_message_page(self, chat_id: str, start: int, count: int) -> list:
+        # Messages start .. start + count - 1 with the model and reply time of their turn, for paginated display
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        chain = self._chain(cursor, chat_id)
+        messages = [(role, content) for _, role, content in
+                    self._read_range(cursor, 'messages', chain_segments(chain), start, start + count,
+                                     select="json_extract(value, '$.role'), json_extract(value, '$.content')")]
+        first_turn, last_turn = start // 2, (start + count) // 2 + 1
+        turns = {}
+        for column in ('addressed_models', 'reply_times'):
+            turns[column] = dict(self._read_range(cursor, column, chain_segments(chain, per_turn=True),
+                                                  first_turn, last_turn))
+        conn.close()
+
+        return [{"role": role, "content": content,
+                 "model": turns['addressed_models'].get((start + offset) // 2, ""),
+                 "reply_time": turns['reply_times'].get((start + offset) // 2)}
+                for offset, (role, content) in enumerate(messages)]
+
+    def get_model_options(self, model: str) -> dict:
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        cursor.execute('SELECT options FROM model_options WHERE model = ?', (model,))
+        row = cursor.fetchone()
+        conn.close()
+
+        return json.loads(row[0]) if row else {}
+
+    def set_model_options(self, model: str, options: dict):
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        if options:
+            cursor.execute('INSERT OR REPLACE INTO model_options (model, options) VALUES (?, ?)',
+                           (model, json.dumps(options)))
+        else:
+            cursor.execute('DELETE FROM model_options WHERE model = ?', (model,))
+        conn.commit()
+        conn.close()
+
+    def list_model_options(self) -> dict:
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        cursor.execute('SELECT model, options FROM model_options')
+        profiles = {row[0]: json.loads(row[1]) for row in cursor.fetchall()}
+        conn.close()
+
+        return profiles
+
     def clear_all_chats(self):
+        removed_ids = self.list_chat_ids()
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
         cursor.execute('DELETE FROM chats')
         conn.commit()
         conn.close()
+        for chat_id in removed_ids:
+            self._notify_change(chat_id)
 
     def reset_database(self):
+        removed_ids = self.list_chat_ids()
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
         cursor.execute('DROP TABLE IF EXISTS chats')
         self._initialize_database()
         conn.commit()
         conn.close()
+        for chat_id in removed_ids:
+            self._notify_change(chat_id)
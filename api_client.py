@@ -0,0 +1,163 @@
+"""
+Client for api_server.py. ApiClient has the ChatMemory methods the desktop app uses plus get_response /
+prefill / list_models, so the app can run as a thin client of a remote backend (set LLAMA_API_URL).
+"""
+import json
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from chat_engine import chat_from_dict, chat_to_dict
+from utils import ChatObject, response_from_turn
+
+
+class ApiError(Exception):
+    pass
+
+
+class ApiClient:
+    def __init__(self, base_url: str, timeout: float = 600.0):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout  # Generation requests can take minutes on CPU
+        self.db_path = None  # No local database, the indexes that need one are disabled in thin client mode
+        self.change_listeners = []
+
+    def _open(self, method: str, path: str, body=None, timeout: float = None):
+        data = json.dumps(body).encode() if body is not None else None
+        request = urllib.request.Request(f"{self.base_url}{path}", data=data, method=method,
+                                         headers={"Content-Type": "application/json"})
+        try:
+            return urllib.request.urlopen(request, timeout=timeout or self.timeout)
+        except urllib.error.HTTPError as e:
+            try:
+                message = json.loads(e.read()).get("error", str(e))
+            except ValueError:
+                message = str(e)
+            raise ApiError(message) from None
+
+    def _call(self, method: str, path: str, body=None, timeout: float = None):
+        with self._open(method, path, body, timeout) as response:
+            return json.loads(response.read())
+
+    def _quote(self, value: str) -> str:
+        return urllib.parse.quote(value, safe="")
+
+    def is_alive(self, timeout: float = 0.5) -> bool:
+        try:
+            return self._call("GET", "/api/health", timeout=timeout)["status"] == "ok"
+        except (OSError, ApiError, ValueError):
+            return False
+
+    def list_models(self) -> list:
+        return self._call("GET", "/api/models")
+
+    def close(self):
+        pass  # Nothing to release, the server keeps running for its other clients
+
+    # ---- ChatMemory compatible ----
+    def add_change_listener(self, listener):
+        # Only changes made through this client are reported
+        self.change_listeners.append(listener)
+
+    def _notify_change(self, chat_id: str, chat_object: ChatObject = None):
+        for listener in self.change_listeners:
+            listener(chat_id, chat_object)
+
+    def add_chat(self, chat_object: ChatObject):
+        self._call("POST", "/api/chats", chat_to_dict(chat_object))
+        self._notify_change(chat_object.creation_time, chat_object)
+
+    def update_chat(self, chat_object: ChatObject):
+        self._call("PUT", f"/api/chats/{self._quote(chat_object.creation_time)}", chat_to_dict(chat_object))
+        self._notify_change(chat_object.creation_time, chat_object)
+
+    def get_chat_by_timestamp(self, timestamp: str) -> ChatObject:
+        try:
+            return chat_from_dict(self._call("GET", f"/api/chats/{self._quote(timestamp)}"))
+        except ApiError:
+            return None
+
+    def get_chat_header(self, chat_id: str) -> dict:
+        try:
+            return self._call("GET", f"/api/chats/{self._quote(chat_id)}/header")
+        except ApiError:
+            return None
+
+    def get_message_count(self, chat_id: str) -> int:
+        return self._call("GET", f"/api/chats/{self._quote(chat_id)}/message-count")["count"]
+
+    def get_message_sizes(self, chat_id: str, start: int = 0) -> list:
+        sizes = self._call("GET", f"/api/chats/{self._quote(chat_id)}/message-sizes?start={int(start)}")["sizes"]
+        return [(bool(is_user), characters, newlines) for is_user, characters, newlines in sizes]
+
+    def get_message_page(self, chat_id: str, start: int, count: int) -> list:
+        return self._call("GET", f"/api/chats/{self._quote(chat_id)}/messages?start={int(start)}&count={int(count)}")
+
+    def fork_chat(self, chat_id: str, message_count: int, name: str) -> ChatObject:
+        chat = chat_from_dict(self._call("POST", f"/api/chats/{self._quote(chat_id)}/branches",
+                                         {"message_count": message_count, "name": name}))
+        self._notify_change(chat.creation_time, chat)
+        return chat
+
+    def stage_import_batch(self, import_id: str, column: str, batch: int, items: str):
+        self._call("PUT", f"/api/imports/{self._quote(import_id)}/{self._quote(column)}/{batch}", json.loads(items))
+
+    def finish_import(self, import_id: str, chat_object: ChatObject):
+        self._call("POST", f"/api/imports/{self._quote(import_id)}",
+                   {"id": chat_object.creation_time, "name": chat_object.name,
+                    "instructions": chat_object.instructions, "options": chat_object.options})
+        if self.change_listeners:
+            self._notify_change(chat_object.creation_time, self.get_chat_by_timestamp(chat_object.creation_time))
+
+    def abort_import(self, import_id: str):
+        self._call("DELETE", f"/api/imports/{self._quote(import_id)}")
+
+    def delete_chat_by_timestamp(self, timestamp: str):
+        self._call("DELETE", f"/api/chats/{self._quote(timestamp)}")
+        self._notify_change(timestamp)
+
+    def list_chat_ids(self):
+        return [chat["id"] for chat in self._call("GET", "/api/chats")]
+
+    def list_chats(self):
+        return [(chat["id"], chat["name"]) for chat in self._call("GET", "/api/chats")]
+
+    def list_chat_tree(self):
+        return [(chat["id"], chat["name"], chat["parent_id"], chat["fork_point"])
+                for chat in self._call("GET", "/api/chat-tree")]
+
+    def list_chat_names(self):
+        return [chat["name"] for chat in self._call("GET", "/api/chats")]
+
+    def get_chat_name(self, chat_id: str) -> str:
+        chat = self.get_chat_by_timestamp(chat_id)
+        return chat.name if chat else None
+
+    def get_model_options(self, model: str) -> dict:
+        return self._call("GET", f"/api/model-options/{self._quote(model)}")
+
+    def set_model_options(self, model: str, options: dict):
+        self._call("PUT", f"/api/model-options/{self._quote(model)}", options)
+
+    # ---- generation ----
+    def get_response(self, curr_chat: ChatObject, model: str, selected_gpu: str, on_piece=None):
+        # Same return value as utils.get_response; the server applies the model options and document retrieval
+        body = {"chat": chat_to_dict(curr_chat), "model": model, "gpu": selected_gpu, "stream": on_piece is not None}
+        start = time.time()
+        if on_piece is None:
+            result = self._call("POST", "/api/respond", body)
+        else:
+            with self._open("POST", "/api/respond", body) as stream:
+                for line in stream:
+                    result = json.loads(line)
+                    if not result.get("done"):
+                        on_piece(result["content"])
+        if result.get("error"):
+            raise ApiError(result["error"])
+        curr_chat.kv_context = result.get("kv_context") or {}
+        return response_from_turn(result["content"], result["metrics"]), time.time() - start
+
+    def prefill(self, curr_chat: ChatObject, model: str, selected_gpu: str) -> dict:
+        # Same return value as utils.prefill_chat
+        return self._call("POST", "/api/prefill", {"chat": chat_to_dict(curr_chat), "model": model, "gpu": selected_gpu})
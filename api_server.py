@@ -0,0 +1,341 @@
+"""
+Headless HTTP / WebSocket API over the chat engine, so the desktop GUIs (and anything else) can be thin
+clients of one backend that owns the Ollama connection and the chat database.
+
+    python api_server.py --port 8765
+
+HTTP (JSON bodies):
+    GET    /api/health
+    GET    /api/models
+    GET    /api/chats                       -> [{"id", "name"}]
+    POST   /api/chats                       chat (exported chat format, "name" required) -> chat with its "id"
+    GET    /api/chats/{id}
+    GET    /api/chats/{id}/header           -> {"id", "name", "instructions", "options", "kv_context"}, no history
+    GET    /api/chats/{id}/message-count    -> {"count"}
+    GET    /api/chats/{id}/messages?start=&count=  -> [{"role", "content", "model", "reply_time"}], a page
+    GET    /api/chats/{id}/message-sizes?start=    -> {"start", "sizes": [[is_user, characters, newlines]]}
+    POST   /api/chats/{id}/branches         {"message_count", "name"} -> new chat sharing those first messages
+    GET    /api/chat-tree                   -> [{"id", "name", "parent_id", "fork_point"}]
+    PUT    /api/imports/{id}/{column}/{n}   list -> stages slice n of a history column of a streamed import
+    POST   /api/imports/{id}                {"id", "name", "instructions", "options"} -> {"id", "name"}
+    DELETE /api/imports/{id}                drops the staged slices
+    PUT    /api/chats/{id}                  replaces history / instructions / options
+    DELETE /api/chats/{id}
+    POST   /api/chats/{id}/messages         {"prompt", "model", "gpu", "stream"} -> the stored turn
+    POST   /api/respond                     {"chat", "model", "gpu", "stream"} -> answer without storing
+    POST   /api/prefill                     {"chat", "model", "gpu"} -> timings of evaluating the history ahead
+    GET    /api/model-options/{model}
+    PUT    /api/model-options/{model}       options dict, see utils.GENERATION_OPTIONS
+
+With "stream": true the reply comes as NDJSON lines {"content": piece} followed by the final object
+with "done": true.
+
+WebSocket /api/ws: send {"type": "send", "id", "chat_id", "prompt", "model", "gpu"}, receive
+{"type": "chunk", "id", "content"} pieces then {"type": "reply", "id", ...turn} or {"type": "error", "id", "error"}.
+Every socket also receives {"type": "chat_changed", "chat_id", "deleted"} when any client changes a chat.
+
+The engine is blocking (sqlite, Ollama client), so its calls run in a thread pool; the event loop only
+moves bytes, which keeps many idle or streaming clients cheap.
+"""
+import argparse
+import asyncio
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from aiohttp import WSMsgType, web
+
+from chat_engine import ChatEngine, ChatNotFoundError, chat_from_dict, chat_to_dict
+from ChatFileSystem import ChatMemory
+from utils import ensure_ollama_server, get_ollama_pool, parse_generation_options, terminate_with_children
+
+DEFAULT_PORT = 8765
+DEFAULT_WORKERS = 32  # Blocking engine calls in flight, generation itself is limited by the Ollama pool
+
+
+class ApiServer:
+    def __init__(self, engine: ChatEngine, workers: int = DEFAULT_WORKERS):
+        self.engine = engine
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.sockets = set()
+        self.loop = None
+        engine.chat_memory.add_change_listener(self.on_chat_changed)
+
+    def run_blocking(self, function, *args, **kwargs):
+        return self.loop.run_in_executor(self.executor, partial(function, *args, **kwargs))
+
+    def make_app(self) -> web.Application:
+        app = web.Application(middlewares=[self.error_middleware])
+        app.add_routes([
+            web.get('/api/health', self.health),
+            web.get('/api/models', self.list_models),
+            web.get('/api/chats', self.list_chats),
+            web.post('/api/chats', self.create_chat),
+            web.get('/api/chats/{chat_id}', self.get_chat),
+            web.get('/api/chats/{chat_id}/header', self.get_chat_header),
+            web.get('/api/chats/{chat_id}/message-count', self.get_message_count),
+            web.get('/api/chats/{chat_id}/messages', self.get_message_page),
+            web.get('/api/chats/{chat_id}/message-sizes', self.get_message_sizes),
+            web.put('/api/chats/{chat_id}', self.update_chat),
+            web.delete('/api/chats/{chat_id}', self.delete_chat),
+            web.post('/api/chats/{chat_id}/messages', self.send_message),
+            web.post('/api/chats/{chat_id}/branches', self.fork_chat),
+            web.get('/api/chat-tree', self.list_chat_tree),
+            web.put('/api/imports/{import_id}/{column}/{batch:\\d+}', self.stage_import_batch),
+            web.post('/api/imports/{import_id}', self.finish_import),
+            web.delete('/api/imports/{import_id}', self.abort_import),
+            web.post('/api/respond', self.respond),
+            web.post('/api/prefill', self.prefill),
+            web.get('/api/model-options/{model:.+}', self.get_model_options),
+            web.put('/api/model-options/{model:.+}', self.set_model_options),
+            web.get('/api/ws', self.websocket),
+        ])
+        app.on_startup.append(self.on_startup)
+        app.on_shutdown.append(self.on_shutdown)
+        return app
+
+    async def on_startup(self, app):
+        self.loop = asyncio.get_running_loop()
+
+    async def on_shutdown(self, app):
+        for ws in list(self.sockets):
+            await ws.close()
+        self.executor.shutdown(wait=False)
+
+    @web.middleware
+    async def error_middleware(self, request, handler):
+        try:
+            return await handler(request)
+        except ChatNotFoundError as e:
+            return web.json_response({"error": f"No chat with id {e.args[0]}"}, status=404)
+        except KeyError as e:
+            return web.json_response({"error": f"Missing field {e.args[0]}"}, status=400)
+        except ValueError as e:  # Invalid chat data, options or JSON body
+            return web.json_response({"error": str(e)}, status=400)
+        except web.HTTPException:
+            raise
+        except Exception as e:
+            print(f"API request {request.method} {request.path} failed: {e}")
+            return web.json_response({"error": str(e)}, status=502)
+
+    # ---- chats ----
+    async def health(self, request):
+        return web.json_response({"status": "ok", "clients": len(self.sockets)})
+
+    async def list_models(self, request):
+        return web.json_response(await self.run_blocking(self.engine.list_models))
+
+    async def list_chats(self, request):
+        return web.json_response(await self.run_blocking(self.engine.list_chats))
+
+    async def create_chat(self, request):
+        chat = await self.run_blocking(self.engine.create_chat, await request.json())
+        return web.json_response(chat_to_dict(chat), status=201)
+
+    async def get_chat(self, request):
+        chat = await self.run_blocking(self.engine.get_chat, request.match_info['chat_id'])
+        return web.json_response(chat_to_dict(chat))
+
+    async def get_chat_header(self, request):
+        return web.json_response(await self.run_blocking(self.engine.get_chat_header, request.match_info['chat_id']))
+
+    async def get_message_count(self, request):
+        return web.json_response(await self.run_blocking(self.engine.get_message_count, request.match_info['chat_id']))
+
+    async def get_message_page(self, request):
+        page = await self.run_blocking(self.engine.get_message_page, request.match_info['chat_id'],
+                                       int(request.query.get('start', 0)), int(request.query['count']))
+        return web.json_response(page)
+
+    async def get_message_sizes(self, request):
+        return web.json_response(await self.run_blocking(self.engine.get_message_sizes, request.match_info['chat_id'],
+                                                         int(request.query.get('start', 0))))
+
+    async def update_chat(self, request):
+        chat = await self.run_blocking(self.engine.update_chat, request.match_info['chat_id'], await request.json())
+        return web.json_response(chat_to_dict(chat))
+
+    async def fork_chat(self, request):
+        body = await request.json()
+        chat = await self.run_blocking(self.engine.fork_chat, request.match_info['chat_id'], body['message_count'],
+                                       body.get('name'))
+        return web.json_response(chat_to_dict(chat), status=201)
+
+    async def list_chat_tree(self, request):
+        return web.json_response(await self.run_blocking(self.engine.list_chat_tree))
+
+    async def stage_import_batch(self, request):
+        await self.run_blocking(self.engine.stage_import_batch, request.match_info['import_id'],
+                                request.match_info['column'], int(request.match_info['batch']), await request.json())
+        return web.json_response({"staged": int(request.match_info['batch'])})
+
+    async def finish_import(self, request):
+        chat = await self.run_blocking(self.engine.finish_import, request.match_info['import_id'], await request.json())
+        return web.json_response(chat, status=201)
+
+    async def abort_import(self, request):
+        await self.run_blocking(self.engine.abort_import, request.match_info['import_id'])
+        return web.json_response({"aborted": request.match_info['import_id']})
+
+    async def delete_chat(self, request):
+        await self.run_blocking(self.engine.delete_chat, request.match_info['chat_id'])
+        return web.json_response({"deleted": request.match_info['chat_id']})
+
+    async def get_model_options(self, request):
+        return web.json_response(await self.run_blocking(self.engine.get_model_options, request.match_info['model']))
+
+    async def set_model_options(self, request):
+        # Accepts the same text values as the settings tab, so they are validated the same way
+        raw = {name: str(value) for name, value in (await request.json()).items()}
+        options = parse_generation_options(raw)
+        await self.run_blocking(self.engine.set_model_options, request.match_info['model'], options)
+        return web.json_response(options)
+
+    # ---- generation ----
+    def stream_pieces(self, function, *args):
+        # Runs function(*args, on_piece=...) in the pool; returns (queue of pieces, future of the result).
+        # The queue ends with None once the function returned or failed
+        pieces = asyncio.Queue()
+
+        def on_piece(piece):
+            self.loop.call_soon_threadsafe(pieces.put_nowait, piece)
+
+        future = self.run_blocking(function, *args, on_piece=on_piece)
+        future.add_done_callback(lambda _: pieces.put_nowait(None))
+        return pieces, future
+
+    async def stream_ndjson(self, request, function, *args, finish=lambda result: result):
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+        pieces, future = self.stream_pieces(function, *args)
+        while (piece := await pieces.get()) is not None:
+            await response.write((json.dumps({"content": piece}) + "\n").encode())
+        try:
+            final = dict(finish(future.result()), done=True)
+        except Exception as e:
+            final = {"done": True, "error": str(e)}
+        await response.write((json.dumps(final) + "\n").encode())
+        await response.write_eof()
+        return response
+
+    async def send_message(self, request):
+        body = await request.json()
+        args = (request.match_info['chat_id'], body["prompt"], body["model"], body.get("gpu", "CPU"))
+        if body.get("stream"):
+            await self.run_blocking(self.engine.get_chat, args[0])  # 404 before the stream starts
+            return await self.stream_ndjson(request, self.engine.send_message, *args)
+        return web.json_response(await self.run_blocking(self.engine.send_message, *args))
+
+    async def respond(self, request):
+        # Stateless answer for clients that keep their own history (e.g. the desktop app in thin client mode)
+        body = await request.json()
+        chat = chat_from_dict(body["chat"])
+
+        def finish(result):
+            response, time_taken, metrics = result
+            return {"content": response['message']['content'], "reply_time": time_taken, "metrics": metrics,
+                    "kv_context": chat.kv_context}
+
+        args = (chat, body["model"], body.get("gpu", "CPU"))
+        if body.get("stream"):
+            return await self.stream_ndjson(request, self.engine.respond, *args, finish=finish)
+        return web.json_response(finish(await self.run_blocking(self.engine.respond, *args)))
+
+    async def prefill(self, request):
+        # Evaluates the history of a chat the client is about to extend, see utils.prefill_chat
+        body = await request.json()
+        chat = chat_from_dict(body["chat"])
+        return web.json_response(await self.run_blocking(self.engine.prefill, chat, body["model"],
+                                                         body.get("gpu", "CPU")))
+
+    # ---- websocket ----
+    async def websocket(self, request):
+        ws = web.WebSocketResponse(heartbeat=30)
+        await ws.prepare(request)
+        self.sockets.add(ws)
+        tasks = set()
+        try:
+            async for message in ws:
+                if message.type != WSMsgType.TEXT:
+                    continue
+                try:
+                    data = json.loads(message.data)
+                except ValueError:
+                    await ws.send_json({"type": "error", "error": "Invalid JSON"})
+                    continue
+                if data.get("type") == "send":
+                    # Each request streams on its own, a socket can have several turns in flight
+                    task = asyncio.ensure_future(self.websocket_send(ws, data))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                else:
+                    await ws.send_json({"type": "error", "id": data.get("id"),
+                                        "error": f"Unknown message type {data.get('type')}"})
+        finally:
+            self.sockets.discard(ws)
+        return ws
+
+    async def websocket_send(self, ws, data):
+        request_id = data.get("id")
+        try:
+            pieces, future = self.stream_pieces(self.engine.send_message, data["chat_id"], data["prompt"],
+                                                data["model"], data.get("gpu", "CPU"))
+            while (piece := await pieces.get()) is not None:
+                if not ws.closed:
+                    await ws.send_json({"type": "chunk", "id": request_id, "content": piece})
+            reply = dict(future.result(), type="reply", id=request_id)
+        except ChatNotFoundError as e:
+            reply = {"type": "error", "id": request_id, "error": f"No chat with id {e.args[0]}"}
+        except Exception as e:
+            reply = {"type": "error", "id": request_id, "error": str(e)}
+        if not ws.closed:
+            await ws.send_json(reply)
+
+    def on_chat_changed(self, chat_id, chat_object=None):
+        # ChatMemory listener, runs on an engine thread
+        if self.loop is not None and self.sockets:
+            event = {"type": "chat_changed", "chat_id": chat_id, "deleted": chat_object is None}
+            asyncio.run_coroutine_threadsafe(self.broadcast(event), self.loop)
+
+    async def broadcast(self, event):
+        for ws in list(self.sockets):
+            if not ws.closed:
+                await ws.send_json(event)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the chat engine over HTTP and WebSocket")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--db", default="chats.db")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    args = parser.parse_args(argv)
+
+    chat_memory = ChatMemory(args.db)
+    retriever = None
+    try:
+        from document_index import DocumentIndex
+        from utils import embed_texts
+        retriever = DocumentIndex(embed_texts, db_path=args.db).retriever()
+    except ImportError:  # numpy is optional, document retrieval is disabled without it
+        pass
+
+    # Reuses a running server, or starts one for as long as the API runs
+    server_process, ready = ensure_ollama_server()
+    if not ready:
+        print("Ollama server is not reachable", file=sys.stderr)
+        return 2
+    get_ollama_pool().start_health_checks()
+    api = ApiServer(ChatEngine(chat_memory, retriever), args.workers)
+    try:
+        web.run_app(api.make_app(), host=args.host, port=args.port)
+    finally:
+        get_ollama_pool().stop_health_checks()
+        if server_process is not None:
+            terminate_with_children(server_process)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,276 @@
+"""
+Optional out-of-process backend for the desktop app (LLAMA_BACKEND_PROCESS=1).
+
+A worker process owns the Ollama server / client and ChatMemory; the GUI talks to it over two
+multiprocessing queues. Response parsing, JSON encoding of chats and sqlite writes then run under the
+worker's GIL, so they can no longer delay Tk events. ProcessBackend has the same interface as
+api_client.ApiClient (the ChatMemory methods the app uses plus get_response / prefill / list_models).
+
+Storage calls are executed in order on the worker's main thread; generation requests run on a thread
+pool so several chats can be answered at once.
+
+Requests are pickled by the caller before call() returns, not later by the queue's feeder thread: the worker
+gets a snapshot of the chat as it was when it was sent, which the window changing it afterwards can't tear.
+That pickling is the part of a write the GUI process still pays for (about 6 ms for a 4000 message chat, the
+JSON encoding it saves takes 36 ms). Writes don't wait for the worker; a failed write is reported to the
+error listeners.
+"""
+import itertools
+import multiprocessing
+import pickle
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from utils import ChatObject, response_from_turn
+
+# ChatMemory methods the GUI may call, reads (and fork_chat, which returns the new chat, and the import steps,
+# whose errors the importer needs) wait for the result, writes are fire and forget
+READ_METHODS = {"get_chat_by_timestamp", "get_chat_header", "get_message_count", "get_message_sizes",
+                "get_message_page", "list_chats", "list_chat_tree", "list_chat_ids", "list_chat_names",
+                "get_chat_name", "get_model_options", "fork_chat", "stage_import_batch", "finish_import",
+                "abort_import"}
+WRITE_METHODS = {"add_chat", "update_chat", "delete_chat_by_timestamp", "set_model_options"}
+
+
+def worker_main(requests, events, db_path, workers):
+    # Imported here so the GUI process never loads the engine's dependencies twice
+    from ChatFileSystem import ChatMemory
+    from chat_engine import ChatEngine
+    from utils import ensure_ollama_server, get_ollama_pool, start_local_device_servers, terminate_with_children
+
+    server_process, ready = ensure_ollama_server()
+    device_servers = start_local_device_servers()
+    if ready:
+        get_ollama_pool().start_health_checks()
+    retriever = None
+    try:
+        from document_index import DocumentIndex
+        from utils import embed_texts
+        retriever = DocumentIndex(embed_texts, db_path=db_path).retriever()
+    except ImportError:  # numpy is optional, document retrieval is disabled without it
+        pass
+    engine = ChatEngine(ChatMemory(db_path), retriever)
+    events.put((None, "ready", ready))
+
+    def generate(request_id, chat, model, selected_gpu, stream):
+        on_piece = (lambda piece: events.put((request_id, "piece", piece))) if stream else None
+        try:
+            response, time_taken, metrics = engine.respond(chat, model, selected_gpu, on_piece)
+            events.put((request_id, "result", (response['message']['content'], time_taken, metrics,
+                                               chat.kv_context)))
+        except Exception as e:
+            events.put((request_id, "error", f"{type(e).__name__}: {e}"))
+
+    def prefill(request_id, chat, model, selected_gpu):
+        try:
+            events.put((request_id, "result", engine.prefill(chat, model, selected_gpu)))
+        except Exception as e:
+            events.put((request_id, "error", f"{type(e).__name__}: {e}"))
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        while True:
+            request = requests.get()
+            if request is None:
+                break
+            request_id, method, args = pickle.loads(request)
+            if method == "get_response":
+                executor.submit(generate, request_id, *args)
+                continue
+            if method == "prefill":
+                executor.submit(prefill, request_id, *args)
+                continue
+            try:
+                if method == "list_models":
+                    result = engine.list_models()
+                elif method in READ_METHODS or method in WRITE_METHODS:
+                    result = getattr(engine.chat_memory, method)(*args)
+                else:
+                    raise ValueError(f"Unknown backend method {method}")
+                events.put((request_id, "result", result))
+            except Exception as e:
+                events.put((request_id, "error", f"{type(e).__name__}: {e}"))
+    finally:
+        executor.shutdown(wait=False)
+        get_ollama_pool().stop_health_checks()
+        for process in [server_process] + device_servers:
+            if process is not None:
+                terminate_with_children(process)
+        events.put(None)
+
+
+class BackendError(Exception):
+    pass
+
+
+class ProcessBackend:
+    def __init__(self, db_path: str = 'chats.db', workers: int = 4):
+        # spawn, not fork: a forked copy of a running Tk app is not safe to use
+        context = multiprocessing.get_context("spawn")
+        self.requests = context.Queue()
+        self.events = context.Queue()
+        self.process = context.Process(target=worker_main, args=(self.requests, self.events, db_path, workers),
+                                       daemon=True)
+        self.db_path = None  # No local database, the indexes that need one are disabled with this backend
+        self.change_listeners = []
+        self.error_listeners = []
+        self.server_ready = False
+        self._ready_event = threading.Event()
+        self._pending = {}  # request id -> (future, on_piece)
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._reader = None
+
+    def start(self):
+        self.process.start()
+        self._reader = threading.Thread(target=self._read_events, daemon=True)
+        self._reader.start()
+        return self
+
+    def _read_events(self):
+        while True:
+            event = self.events.get()
+            if event is None:
+                break
+            request_id, kind, value = event
+            if request_id is None:  # Worker started
+                self.server_ready = value
+                self._ready_event.set()
+                continue
+            with self._lock:
+                future, on_piece = self._pending.get(request_id, (None, None))
+                if kind != "piece":
+                    self._pending.pop(request_id, None)
+            if future is None:
+                continue
+            if kind == "piece":
+                on_piece(value)
+            elif kind == "result":
+                future.set_result(value)
+            else:
+                future.set_exception(BackendError(value))
+        # Worker is gone, nothing pending will ever be answered
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for future, _ in pending.values():
+            future.set_exception(BackendError("Backend process stopped"))
+
+    def call(self, method: str, *args, on_piece=None) -> Future:
+        future = Future()
+        request_id = next(self._ids)
+        request = pickle.dumps((request_id, method, args), pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._pending[request_id] = (future, on_piece)
+        self.requests.put(request)
+        return future
+
+    def add_error_listener(self, listener):
+        # listener(method, message) runs on the event reader thread when a write failed in the worker
+        self.error_listeners.append(listener)
+
+    def _write(self, method: str, *args):
+        future = self.call(method, *args)
+        future.add_done_callback(lambda f: f.exception() and self._write_failed(method, f.exception()))
+
+    def _write_failed(self, method: str, error: Exception):
+        print(f"Backend {method} failed: {error}")
+        for listener in self.error_listeners:
+            listener(method, str(error))
+
+    def is_alive(self, timeout: float = 0.5) -> bool:
+        return self._ready_event.wait(timeout) and self.server_ready and self.process.is_alive()
+
+    def list_models(self) -> list:
+        return self.call("list_models").result()
+
+    def close(self):
+        if self.process.is_alive():
+            self.requests.put(None)
+            self.process.join(timeout=5.0)
+            if self.process.is_alive():
+                self.process.terminate()
+
+    # ---- ChatMemory compatible ----
+    def add_change_listener(self, listener):
+        # Only changes made through this backend are reported
+        self.change_listeners.append(listener)
+
+    def _notify_change(self, chat_id: str, chat_object: ChatObject = None):
+        for listener in self.change_listeners:
+            listener(chat_id, chat_object)
+
+    def add_chat(self, chat_object: ChatObject):
+        self._write("add_chat", chat_object)
+        self._notify_change(chat_object.creation_time, chat_object)
+
+    def update_chat(self, chat_object: ChatObject):
+        self._write("update_chat", chat_object)
+        self._notify_change(chat_object.creation_time, chat_object)
+
+    def delete_chat_by_timestamp(self, timestamp: str):
+        self._write("delete_chat_by_timestamp", timestamp)
+        self._notify_change(timestamp)
+
+    def fork_chat(self, chat_id: str, message_count: int, name: str) -> ChatObject:
+        chat = self.call("fork_chat", chat_id, message_count, name).result()
+        self._notify_change(chat.creation_time, chat)
+        return chat
+
+    def stage_import_batch(self, import_id: str, column: str, batch: int, items: str):
+        self.call("stage_import_batch", import_id, column, batch, items).result()
+
+    def finish_import(self, import_id: str, chat_object: ChatObject):
+        self.call("finish_import", import_id, chat_object).result()
+        if self.change_listeners:
+            self._notify_change(chat_object.creation_time, self.get_chat_by_timestamp(chat_object.creation_time))
+
+    def abort_import(self, import_id: str):
+        self.call("abort_import", import_id).result()
+
+    def set_model_options(self, model: str, options: dict):
+        self._write("set_model_options", model, options)
+
+    def get_chat_by_timestamp(self, timestamp: str) -> ChatObject:
+        return self.call("get_chat_by_timestamp", timestamp).result()
+
+    def get_chat_header(self, chat_id: str) -> dict:
+        return self.call("get_chat_header", chat_id).result()
+
+    def get_message_count(self, chat_id: str) -> int:
+        return self.call("get_message_count", chat_id).result()
+
+    def get_message_sizes(self, chat_id: str, start: int = 0) -> list:
+        return self.call("get_message_sizes", chat_id, start).result()
+
+    def get_message_page(self, chat_id: str, start: int, count: int) -> list:
+        return self.call("get_message_page", chat_id, start, count).result()
+
+    def list_chat_ids(self):
+        return self.call("list_chat_ids").result()
+
+    def list_chats(self):
+        return self.call("list_chats").result()
+
+    def list_chat_tree(self):
+        return self.call("list_chat_tree").result()
+
+    def list_chat_names(self):
+        return self.call("list_chat_names").result()
+
+    def get_chat_name(self, chat_id: str) -> str:
+        return self.call("get_chat_name", chat_id).result()
+
+    def get_model_options(self, model: str) -> dict:
+        return self.call("get_model_options", model).result()
+
+    # ---- generation ----
+    def get_response(self, curr_chat: ChatObject, model: str, selected_gpu: str, on_piece=None):
+        # Same return value as utils.get_response
+        future = self.call("get_response", curr_chat, model, selected_gpu, on_piece is not None, on_piece=on_piece)
+        content, time_taken, metrics, kv_context = future.result()
+        curr_chat.kv_context = kv_context
+        return response_from_turn(content, metrics), time_taken
+
+    def prefill(self, curr_chat: ChatObject, model: str, selected_gpu: str) -> dict:
+        # Same return value as utils.prefill_chat
+        return self.call("prefill", curr_chat, model, selected_gpu).result()
@@ -0,0 +1,157 @@
+"""
+Headless batch runner: sends a list of prompts through the same request path as the app
+(utils.get_response) with bounded concurrency and streams the results to a JSONL file.
+
+    python batch_runner.py Prompt_examples.txt --model llama3.2:3b --concurrency 4 --output results.jsonl
+    cat prompts.txt | python batch_runner.py - --model llama3.2:3b --chat-id 2024-10-01T12:00:00
+
+Each prompt is answered independently, with the instructions and options of --chat-id (or --instructions).
+Re-running with the same output file resumes: prompts already answered successfully are skipped.
+"""
+import argparse
+import json
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+
+from ChatFileSystem import ChatMemory
+from utils import (ChatObject, ensure_ollama_server, extract_turn_metrics, get_ollama_pool, get_response,
+                   terminate_with_children)
+
+
+def read_prompts(source: str) -> list:
+    # One prompt per non empty line, "-" reads stdin
+    stream = sys.stdin if source == "-" else open(source, 'r', encoding='utf-8')
+    try:
+        return [line.strip() for line in stream if line.strip()]
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+
+def load_completed(output_path: str) -> set:
+    # Indices already answered successfully in a previous (possibly interrupted) run
+    completed = set()
+    try:
+        with open(output_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # Truncated last line of an interrupted run
+                if record.get("status") == "ok":
+                    completed.add(record["index"])
+    except FileNotFoundError:
+        pass
+    return completed
+
+
+class BatchRunner:
+    def __init__(self, model: str, instructions: str = "", options: dict = None, model_options: dict = None,
+                 selected_gpu: str = "CPU", concurrency: int = 4):
+        self.model = model
+        self.instructions = instructions
+        self.options = options or {}
+        self.model_options = model_options or {}
+        self.selected_gpu = selected_gpu
+        self.concurrency = max(1, concurrency)
+
+    def run_one(self, index: int, prompt: str) -> dict:
+        chat = ChatObject(name=f"batch-{index}", messages=[{"role": "user", "content": prompt}],
+                          instructions=self.instructions, options=dict(self.options))
+        record = {"index": index, "prompt": prompt, "model": self.model,
+                  "started_at": datetime.now().isoformat()}
+        start = time.perf_counter()
+        try:
+            response, time_taken = get_response(chat, self.model, self.selected_gpu, self.model_options)
+        except Exception as e:
+            record.update(status="error", error=str(e), reply_time=time.perf_counter() - start)
+            return record
+        record.update(status="ok", response=response['message']['content'], reply_time=time_taken,
+                      metrics=extract_turn_metrics(response))
+        return record
+
+    def run(self, prompts: list, output_path: str, progress=None) -> dict:
+        completed = load_completed(output_path)
+        todo = [(index, prompt) for index, prompt in enumerate(prompts) if index not in completed]
+        summary = {"total": len(prompts), "skipped": len(prompts) - len(todo), "ok": 0, "error": 0}
+        start = time.perf_counter()
+        with open(output_path, 'a', encoding='utf-8') as output, \
+                ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            in_flight = set()
+            pending = iter(todo)
+            # Keep a bounded number of prompts in flight so huge inputs don't all sit in the executor queue
+            while True:
+                while len(in_flight) < self.concurrency * 2:
+                    item = next(pending, None)
+                    if item is None:
+                        break
+                    in_flight.add(executor.submit(self.run_one, *item))
+                if not in_flight:
+                    break
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    record = future.result()
+                    summary[record["status"]] += 1
+                    # Results are written from this thread only, as they complete
+                    output.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    output.flush()  # Every finished prompt survives an interruption
+                    if progress:
+                        progress(record, summary)
+        summary["elapsed"] = time.perf_counter() - start
+        processed = summary["ok"] + summary["error"]
+        summary["throughput"] = processed / summary["elapsed"] if summary["elapsed"] > 0 else 0.0
+        return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a file of prompts through a model and write JSONL results")
+    parser.add_argument("prompts", help="Prompt file, one prompt per line, or - for stdin")
+    parser.add_argument("--model", required=True)
+    parser.add_argument("--output", default="batch_results.jsonl")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--chat-id", help="Use the instructions and options of this stored chat (its timestamp)")
+    parser.add_argument("--instructions", default=None, help="Instructions text, overrides the chat's")
+    parser.add_argument("--gpu", default="CPU", help="Device to route to, as shown in the app's GPU dropdown")
+    parser.add_argument("--db", default="chats.db")
+    args = parser.parse_args(argv)
+
+    chat_memory = ChatMemory(args.db)
+    instructions, options = "", {}
+    if args.chat_id:
+        chat = chat_memory.get_chat_by_timestamp(args.chat_id)
+        if chat is None:
+            parser.error(f"No chat with id {args.chat_id}")
+        instructions, options = chat.instructions, chat.options
+    if args.instructions is not None:
+        instructions = args.instructions
+
+    # Reuses a running server, or starts one for the duration of the batch
+    server_process, ready = ensure_ollama_server()
+    if not ready:
+        print("Ollama server is not reachable", file=sys.stderr)
+        return 2
+
+    runner = BatchRunner(args.model, instructions, options, chat_memory.get_model_options(args.model),
+                         args.gpu, args.concurrency)
+
+    def progress(record, summary):
+        done = summary["ok"] + summary["error"] + summary["skipped"]
+        status = "ok" if record["status"] == "ok" else f"error: {record['error']}"
+        print(f"[{done}/{summary['total']}] #{record['index']} {record['reply_time']:.2f}s {status}", file=sys.stderr)
+
+    get_ollama_pool().start_health_checks()  # Brings endpoints back after a timeout or a server restart
+    try:
+        summary = runner.run(read_prompts(args.prompts), args.output, progress)
+    finally:
+        get_ollama_pool().stop_health_checks()
+        if server_process is not None:
+            terminate_with_children(server_process)
+    print(f"Done: {summary['ok']} ok, {summary['error']} failed, {summary['skipped']} skipped (already done), "
+          f"{summary['throughput']:.2f} prompts/s", file=sys.stderr)
+    return 0 if summary["error"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
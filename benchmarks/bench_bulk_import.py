@@ -0,0 +1,78 @@
+"""
+Time to import a folder of exported chats: one file at a time the way Import Chat did it before (json.load,
+validation, add_chat with its own transaction) against bulk_import.py with 1 .. --max-workers parsing processes.
+
+    python benchmarks/bench_bulk_import.py --files 500 --turns 200 --max-workers 8
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bulk_import import bulk_import
+from ChatFileSystem import ChatMemory
+from utils import ChatObject, validate_data_structure
+
+
+def write_exports(directory, files, turns, content_chars):
+    for number in range(files):
+        messages = []
+        for turn in range(turns):
+            messages.append({"role": "user", "content": f"chat {number} question {turn} ".ljust(content_chars // 4, "q")})
+            messages.append({"role": "assistant", "content": f"answer {turn} ".ljust(content_chars, "a")})
+        chat_data = {"name": f"chat {number}", "messages": messages, "reply_times": [1.0] * turns,
+                     "addressed_models": ["llama3.2:3b"] * turns, "instructions": "", "options": {}, "turn_metrics": []}
+        with open(os.path.join(directory, f"chat_{number}.json"), "w", encoding="utf-8") as f:
+            json.dump(chat_data, f, indent=2, ensure_ascii=False)
+
+
+def import_one_by_one(directory, memory):
+    for name in sorted(os.listdir(directory)):
+        with open(os.path.join(directory, name), "r", encoding="utf-8") as f:
+            chat_data = json.load(f)
+        error = validate_data_structure(chat_data)
+        if error:
+            raise error
+        chat = ChatObject(chat_data["name"], chat_data["messages"], chat_data["reply_times"],
+                          chat_data["addressed_models"], chat_data["instructions"],
+                          options=chat_data.get("options", {}), turn_metrics=chat_data.get("turn_metrics", []))
+        time.sleep(0.000001)  # Chat ids are timestamps
+        memory.add_chat(chat)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=500)
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--content-chars", type=int, default=400)
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        exports = os.path.join(directory, "exports")
+        os.makedirs(exports)
+        write_exports(exports, args.files, args.turns, args.content_chars)
+        size = sum(os.path.getsize(os.path.join(exports, name)) for name in os.listdir(exports))
+        print(f"{args.files} files, {size / (1 << 20):.0f} MB, {os.cpu_count()} cores")
+        print(f"{'importer':<16}{'seconds':>9}{'files/s':>9}")
+
+        start = time.perf_counter()
+        import_one_by_one(exports, ChatMemory(os.path.join(directory, "one_by_one.db")))
+        seconds = time.perf_counter() - start
+        print(f"{'one by one':<16}{seconds:>9.2f}{args.files / seconds:>9.0f}")
+
+        workers = 1
+        while True:
+            summary = bulk_import(exports, ChatMemory(os.path.join(directory, f"bulk_{workers}.db")), workers)
+            print(f"{f'bulk, {workers} workers':<16}{summary['seconds']:>9.2f}{summary['files_per_second']:>9.0f}")
+            if workers >= args.max_workers:
+                break
+            workers = min(workers * 2, args.max_workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Storage and load time of branches of a long chat: forked with ChatMemory.fork_chat (shared history) against
+full copies (what exporting and importing the chat did before).
+
+    python benchmarks/bench_chat_branches.py --turns 2000 --branches 20 --suffix-turns 5
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ChatFileSystem import ChatMemory
+from utils import ChatObject
+
+
+def long_chat(turns, content_chars):
+    messages = []
+    for turn in range(turns):
+        messages.append({"role": "user", "content": f"question {turn} ".ljust(content_chars // 4, "q")})
+        messages.append({"role": "assistant", "content": f"answer {turn} ".ljust(content_chars, "a")})
+    return ChatObject("benchmark", messages, [1.0] * turns, ["llama3.2:3b"] * turns)
+
+
+def add_suffix(chat, turns):
+    for turn in range(turns):
+        chat.messages.append({"role": "user", "content": f"branch question {turn}"})
+        chat.messages.append({"role": "assistant", "content": f"branch answer {turn}"})
+        chat.reply_times.append(1.0)
+        chat.addressed_models.append("llama3.2:3b")
+
+
+def build(directory, args, shared):
+    memory = ChatMemory(os.path.join(directory, "shared.db" if shared else "copies.db"))
+    root = long_chat(args.turns, args.content_chars)
+    memory.add_chat(root)
+    branch_ids = []
+    for number in range(args.branches):
+        fork_point = 2 * args.turns * (number + 1) // (args.branches + 1)
+        if shared:
+            branch = memory.fork_chat(root.creation_time, fork_point, f"branch {number}")
+        else:
+            branch = ChatObject(f"branch {number}", root.messages[:fork_point],
+                                list(root.reply_times)[:fork_point // 2], root.addressed_models[:fork_point // 2])
+            memory.add_chat(branch)
+        time.sleep(0.001)  # Chat ids are timestamps
+        add_suffix(branch, args.suffix_turns)
+        memory.update_chat(branch)
+        branch_ids.append(branch.creation_time)
+    start = time.perf_counter()
+    for chat_id in branch_ids:
+        memory.get_chat_by_timestamp(chat_id)
+    load_time = (time.perf_counter() - start) / len(branch_ids)
+    return os.path.getsize(memory.db_path), load_time
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=2000)
+    parser.add_argument("--content-chars", type=int, default=400, help="Characters per reply, questions are 1/4")
+    parser.add_argument("--branches", type=int, default=20)
+    parser.add_argument("--suffix-turns", type=int, default=5, help="Turns added to every branch")
+    args = parser.parse_args()
+
+    print("storage        db_mb  load_branch_ms")
+    with tempfile.TemporaryDirectory() as directory:
+        for name, shared in (("full copies", False), ("shared", True)):
+            size, load_time = build(directory, args, shared)
+            print(f"{name:12s}  {size / 1e6:6.1f}  {load_time * 1000:14.1f}")
+
+
+if __name__ == "__main__":
+    main()
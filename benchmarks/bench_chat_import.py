@@ -0,0 +1,73 @@
+"""
+Peak memory (RSS) and time of importing a large exported chat: the whole-file path (json.load, validation,
+ChatObject, one add_chat) against the streaming importer (chat_import.py). Each runs in a fresh interpreter.
+
+    python benchmarks/bench_chat_import.py --turns 200000 --content-chars 400
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROBE = """
+import json, resource, sys, time
+sys.path.insert(0, {root!r})
+from ChatFileSystem import ChatMemory
+memory = ChatMemory({db!r})
+start = time.perf_counter()
+if {streaming!r}:
+    from chat_import import import_chat_file
+    import_chat_file({path!r}, memory)
+else:
+    from utils import ChatObject, validate_data_structure
+    with open({path!r}, encoding="utf-8") as f:
+        chat_data = json.load(f)
+    error = validate_data_structure(chat_data)
+    if error:
+        raise error
+    chat = ChatObject(chat_data["name"], chat_data["messages"], chat_data["reply_times"],
+                      chat_data["addressed_models"], chat_data["instructions"])
+    memory.add_chat(chat)
+elapsed = time.perf_counter() - start
+scale = 1 if sys.platform == "darwin" else 1024  # ru_maxrss is in bytes on macOS, KiB elsewhere
+print(elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale)
+"""
+
+
+def write_export(path, turns, content_chars):
+    # Written a turn at a time, in the format of save_chat
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('{\n  "name": "benchmark",\n  "messages": [\n')
+        for turn in range(turns):
+            question = json.dumps({"role": "user", "content": f"question {turn} ".ljust(content_chars // 4, "q")})
+            answer = json.dumps({"role": "assistant", "content": f"answer {turn} ".ljust(content_chars, "a")})
+            f.write(f"    {question},\n    {answer}{',' if turn < turns - 1 else ''}\n")
+        f.write('  ],\n  "reply_times": [' + ", ".join(["1.5"] * turns) + '],\n')
+        f.write('  "addressed_models": [' + ", ".join(['"llama3.2:3b"'] * turns) + '],\n')
+        f.write('  "instructions": "",\n  "options": {},\n  "turn_metrics": []\n}\n')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=200000)
+    parser.add_argument("--content-chars", type=int, default=400, help="Characters per reply, questions are 1/4")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "export.json")
+        write_export(path, args.turns, args.content_chars)
+        print(f"Export: {os.path.getsize(path) / 1e6:.0f} MB, {args.turns} turns")
+        print("importer      seconds  peak_rss_mb")
+        for name, streaming in (("whole file", False), ("streaming", True)):
+            db = os.path.join(directory, f"{name.replace(' ', '_')}.db")
+            probe = PROBE.format(root=ROOT, db=db, path=path, streaming=streaming)
+            elapsed, peak = subprocess.run([sys.executable, "-c", probe], capture_output=True, text=True,
+                                           check=True).stdout.split()
+            print(f"{name:12s}  {float(elapsed):7.1f}  {int(peak) / 1e6:11.0f}")
+
+
+if __name__ == "__main__":
+    main()
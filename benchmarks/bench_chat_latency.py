@@ -0,0 +1,43 @@
+"""
+Measures end to end chat latency of utils.get_response against the fake Ollama server.
+
+    python benchmarks/bench_chat_latency.py --turns 20 --token-latency 0.01
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_ollama_server import FakeOllamaServer, build_arg_parser, config_from_args
+
+
+def main():
+    parser = build_arg_parser()
+    parser.set_defaults(port=0)
+    parser.add_argument("--turns", type=int, default=10)
+    parser.add_argument("--model", default="llama3.1:latest")
+    args = parser.parse_args()
+
+    with FakeOllamaServer(args.host, args.port, config_from_args(args)) as server:
+        os.environ["OLLAMA_HOST"] = server.url  # Must be set before utils reads its configuration
+        from utils import ChatObject, get_response
+
+        chat = ChatObject("benchmark")
+        latencies = []
+        for turn in range(args.turns):
+            chat.messages.append({"role": "user", "content": f"benchmark question number {turn}"})
+            start = time.perf_counter()
+            response, _ = get_response(chat, args.model, "CPU")
+            latencies.append(time.perf_counter() - start)
+            chat.messages.append({"role": "assistant", "content": response['message']['content']})
+
+    latencies.sort()
+    print(f"turns={len(latencies)} "
+          f"mean={sum(latencies) / len(latencies) * 1000:.1f}ms "
+          f"p50={latencies[len(latencies) // 2] * 1000:.1f}ms "
+          f"max={latencies[-1] * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Memory held by a long chat loaded from storage, with the plain list-of-dicts layout (before) and with
+ChatObject's compact layout (after), plus the time to load it from and save it to JSON.
+
+    python benchmarks/bench_chat_memory.py --turns 50000 --content-chars 200
+
+Bytes per turn (one user message and one reply) are measured with tracemalloc; "overhead" leaves out the
+message texts themselves, which both layouts store the same way.
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import ChatObject
+
+
+class PlainChat:
+    # The layout ChatObject had before: a __dict__ and plain lists of dicts / floats / strings
+    def __init__(self, name, messages, reply_times, addressed_models):
+        self.name = name
+        self.messages = messages
+        self.reply_times = reply_times
+        self.addressed_models = addressed_models
+
+
+def stored_columns(turns, content_chars):
+    # The JSON columns of a chat row as ChatMemory stores them
+    messages, reply_times, models = [], [], []
+    for turn in range(turns):
+        messages.append({"role": "user", "content": f"question {turn} ".ljust(content_chars // 4, "q")})
+        messages.append({"role": "assistant", "content": f"answer {turn} ".ljust(content_chars, "a")})
+        reply_times.append(1.0 + turn % 7 / 10)
+        models.append(("llama3.2:3b", "qwen2.5:7b")[turn % 2])
+    return json.dumps(messages), json.dumps(reply_times), json.dumps(models)
+
+
+def measure(build, columns):
+    # Timed without tracemalloc, which slows allocations down
+    start = time.perf_counter()
+    chat = build(*(json.loads(column) for column in columns))
+    load_time = time.perf_counter() - start
+    del chat
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    chat = build(*(json.loads(column) for column in columns))
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    start = time.perf_counter()
+    json.dumps(chat.messages if isinstance(chat.messages, list) else chat.messages.tolist())
+    json.dumps(list(chat.reply_times))
+    json.dumps(chat.addressed_models)
+    save_time = time.perf_counter() - start
+    return chat, size, load_time, save_time
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=50000)
+    parser.add_argument("--content-chars", type=int, default=200, help="Characters per reply, questions are 1/4")
+    args = parser.parse_args()
+
+    columns = stored_columns(args.turns, args.content_chars)
+    layouts = {
+        "before (dicts)": lambda messages, times, models: PlainChat("benchmark", messages, times, models),
+        "after (compact)": lambda messages, times, models: ChatObject("benchmark", messages, times, models),
+    }
+    print("layout            bytes_per_turn  overhead_per_turn  load_ms  save_ms")
+    for name, build in layouts.items():
+        chat, size, load_time, save_time = measure(build, columns)
+        text = sum(sys.getsizeof(message["content"]) for message in chat.messages)
+        print(f"{name:16s}  {size / args.turns:14.0f}  {(size - text) / args.turns:17.0f}  "
+              f"{load_time * 1000:7.0f}  {save_time * 1000:7.0f}")
+        del chat
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""
+Latency of running a code block with warm interpreters from the pool against starting one per run.
+
+    python benchmarks/bench_code_runner.py --runs 20 --pause 0.2
+
+The pause between runs gives the pool time to start the replacement interpreter, as between two clicks on Run Code.
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from code_runner import CodeRunner
+
+SNIPPET = "print(sum(range(1000)))"
+
+
+def measure(runner, runs, pause):
+    times = []
+    for _ in range(runs):
+        result = runner.run(SNIPPET)
+        assert result["exit_code"] == 0, result
+        times.append(result["wall_time"])
+        time.sleep(pause)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--pause", type=float, default=0.2, help="Seconds between runs")
+    args = parser.parse_args()
+
+    print("mode   p50_ms  p95_ms  max_ms")
+    for name, pool_size in (("cold", 0), ("warm", 2)):
+        runner = CodeRunner(pool_size)
+        if pool_size:
+            runner.start()
+            time.sleep(1.0)
+        times = sorted(measure(runner, args.runs, args.pause))
+        runner.close()
+        print(f"{name}  {statistics.median(times) * 1000:7.1f}  {times[int(len(times) * 0.95) - 1] * 1000:6.1f}  "
+              f"{times[-1] * 1000:6.1f}")
+
+
+if __name__ == "__main__":
+    main()
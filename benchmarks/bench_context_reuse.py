@@ -0,0 +1,52 @@
+"""
+Compares prompt evaluation per turn with and without context reuse (reuse_context option).
+
+    python benchmarks/bench_context_reuse.py --turns 10 --prompt-eval-latency 0.0005
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_ollama_server import FakeOllamaServer, FakeServerConfig
+
+
+def run_chat(turns, model, reuse):
+    from utils import ChatObject, get_response, extract_turn_metrics
+
+    chat = ChatObject("benchmark", instructions="You are a terse assistant.",
+                      options={"reuse_context": True} if reuse else {})
+    rows = []
+    for turn in range(turns):
+        chat.messages.append({"role": "user", "content": f"question {turn} about something fairly specific"})
+        start = time.perf_counter()
+        response, _ = get_response(chat, model, "CPU")
+        elapsed = time.perf_counter() - start
+        chat.messages.append({"role": "assistant", "content": response['message']['content']})
+        metrics = extract_turn_metrics(response)
+        rows.append((metrics.get("prompt_eval_count", 0), metrics.get("reused_context_tokens", 0), elapsed))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=10)
+    parser.add_argument("--prompt-eval-latency", type=float, default=0.0005)
+    parser.add_argument("--model", default="llama3.1:latest")
+    args = parser.parse_args()
+
+    config = FakeServerConfig(prompt_eval_latency=args.prompt_eval_latency)
+    with FakeOllamaServer(config=config) as server:
+        os.environ["OLLAMA_HOST"] = server.url  # Must be set before utils reads its configuration
+        full = run_chat(args.turns, args.model, reuse=False)
+        reused = run_chat(args.turns, args.model, reuse=True)
+
+    print("turn  full_prompt_eval  reuse_prompt_eval  reused_tokens  full_ms  reuse_ms")
+    for turn, (a, b) in enumerate(zip(full, reused)):
+        print(f"{turn:4d}  {a[0]:16d}  {b[0]:17d}  {b[1]:13d}  {a[2] * 1000:7.1f}  {b[2] * 1000:8.1f}")
+
+
+if __name__ == "__main__":
+    main()
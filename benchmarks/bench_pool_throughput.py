@@ -0,0 +1,54 @@
+"""
+Measures chat throughput through OllamaPool as the number of endpoints grows, using fake servers.
+
+    python benchmarks/bench_pool_throughput.py --max-endpoints 4 --requests 32 --concurrency 8
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_ollama_server import FakeOllamaServer, FakeServerConfig
+from ollama_pool import OllamaPool
+
+
+def run(endpoint_count, args):
+    # Each fake server handles one generation at a time, like a single GPU would
+    servers = [FakeOllamaServer(config=FakeServerConfig(token_latency=args.token_latency,
+                                                        reply_tokens=args.reply_tokens,
+                                                        max_concurrency=1)).start()
+               for _ in range(endpoint_count)]
+    try:
+        pool = OllamaPool.from_urls([server.url for server in servers])
+        pool.check_all()
+        messages = [{"role": "user", "content": "benchmark question"}]
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            list(executor.map(lambda _: pool.chat(args.model, messages), range(args.requests)))
+        elapsed = time.perf_counter() - start
+        served = [stats["requests"] for stats in pool.stats()]
+        print(f"endpoints={endpoint_count} requests={args.requests} "
+              f"throughput={args.requests / elapsed:.2f} req/s per_endpoint={served}")
+    finally:
+        for server in servers:
+            server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--max-endpoints", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=32)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--token-latency", type=float, default=0.005)
+    parser.add_argument("--reply-tokens", type=int, default=20)
+    parser.add_argument("--model", default="llama3.1:latest")
+    args = parser.parse_args()
+    for endpoint_count in range(1, args.max_endpoints + 1):
+        run(endpoint_count, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Time to first token with and without prefill (LLAMA_PREFILL, utils.prefill_chat) on the fake server with its
+prompt cache. Before every turn another chat uses the model, so its cached prompt is gone when the user starts
+typing; with prefill the history is evaluated again while the prompt is typed, not after it is sent.
+
+    python benchmarks/bench_prefill.py --turns 8 --history-turns 40 --prompt-eval-latency 0.0002
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_ollama_server import FakeOllamaServer, FakeServerConfig
+
+
+def run_chat(turns, history_turns, model, prefill):
+    from utils import ChatObject, get_response, prefill_chat
+
+    chat = ChatObject("benchmark", instructions="You are a terse assistant.")
+    for turn in range(history_turns):
+        chat.messages.append({"role": "user", "content": f"earlier question {turn} " + "word " * 60})
+        chat.messages.append({"role": "assistant", "content": f"earlier answer {turn} " + "word " * 200})
+    other = ChatObject("other chat", [{"role": "user", "content": "something unrelated " * 50}])
+    rows = []
+    for turn in range(turns):
+        get_response(other, model, "CPU")  # Takes the prompt cache
+        prefill_eval = 0
+        if prefill:
+            prefill_eval = prefill_chat(chat, model, "CPU").get("prompt_eval_count", 0)  # While the prompt is typed
+        chat.messages.append({"role": "user", "content": f"question {turn} about something fairly specific"})
+        first_piece = []
+        start = time.perf_counter()
+        response, _ = get_response(chat, model, "CPU",
+                                   on_piece=lambda piece: first_piece or first_piece.append(time.perf_counter()))
+        chat.messages.append({"role": "assistant", "content": response['message']['content']})
+        rows.append(((first_piece[0] - start) * 1000, response.get("prompt_eval_count", 0), prefill_eval))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=8)
+    parser.add_argument("--history-turns", type=int, default=40)
+    parser.add_argument("--prompt-eval-latency", type=float, default=0.0002)
+    parser.add_argument("--token-latency", type=float, default=0.01)
+    parser.add_argument("--model", default="llama3.1:latest")
+    args = parser.parse_args()
+
+    config = FakeServerConfig(prompt_eval_latency=args.prompt_eval_latency, token_latency=args.token_latency,
+                              prompt_cache=True)
+    with FakeOllamaServer(config=config) as server:
+        os.environ["OLLAMA_HOST"] = server.url  # Must be set before utils reads its configuration
+        without = run_chat(args.turns, args.history_turns, args.model, prefill=False)
+        with_prefill = run_chat(args.turns, args.history_turns, args.model, prefill=True)
+
+    print("turn  ttft_ms  prompt_eval  |  prefill: ttft_ms  prompt_eval  evaluated_ahead")
+    for turn, (a, b) in enumerate(zip(without, with_prefill)):
+        print(f"{turn:4d}  {a[0]:7.1f}  {a[1]:11d}  |  {b[0]:16.1f}  {b[1]:11d}  {b[2]:15d}")
+    mean = lambda rows: sum(row[0] for row in rows) / len(rows)
+    print(f"mean time to first token: {mean(without):.1f} ms without prefill, {mean(with_prefill):.1f} ms with")
+
+
+if __name__ == "__main__":
+    main()
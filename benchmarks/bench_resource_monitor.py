@@ -0,0 +1,58 @@
+"""
+Cost of one resource monitor sample (resource_monitor.py) for server process trees of growing size, and the
+share of time it takes at a few sampling intervals. nvidia-smi is timed separately when it is available.
+
+    python benchmarks/bench_resource_monitor.py --children 1 4 16 --samples 50
+"""
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from resource_monitor import ResourceMonitor, query_nvidia_smi
+
+TREE = """
+import subprocess, sys, time
+children = [subprocess.Popen([sys.executable, "-c", "import time; time.sleep(600)"]) for _ in range({count})]
+time.sleep(600)
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--children", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--samples", type=int, default=50)
+    parser.add_argument("--intervals", type=float, nargs="+", default=[0.25, 1.0, 5.0])
+    args = parser.parse_args()
+
+    print(f"{'processes':>9}  {'ms/sample':>9}  " + "  ".join(f"{f'{interval:g} s':>8}" for interval in args.intervals))
+    for count in args.children:
+        root = subprocess.Popen([sys.executable, "-c", TREE.format(count=count)], start_new_session=True)
+        try:
+            monitor = ResourceMonitor(interval=1.0, gpu_interval=0, server_pids=lambda: [root.pid])
+            while monitor.sample()["processes"] < count + 1:  # Wait for the children to start
+                time.sleep(0.1)
+            start = time.perf_counter()
+            for _ in range(args.samples):
+                monitor.sample()
+            per_sample = (time.perf_counter() - start) / args.samples
+        finally:
+            os.killpg(root.pid, signal.SIGKILL)
+            root.wait()
+        # The share of one core spent sampling at each interval
+        shares = "  ".join(f"{100 * per_sample / interval:7.2f}%" for interval in args.intervals)
+        print(f"{count + 1:>9}  {per_sample * 1000:>9.2f}  {shares}")
+
+    start = time.perf_counter()
+    if query_nvidia_smi():
+        print(f"nvidia-smi query: {(time.perf_counter() - start) * 1000:.0f} ms")
+    else:
+        print("nvidia-smi not available, GPU sampling disabled")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Measures nearest neighbour query latency and recall@10 of the semantic index over a synthetic,
+clustered history (real embeddings cluster by topic, uniform random vectors would not).
+
+    python benchmarks/bench_semantic_search.py --messages 100000 --dim 768
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from semantic_index import SemanticIndex, normalize
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--queries", type=int, default=20)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    topics = rng.standard_normal((500, args.dim), dtype=np.float32)
+
+    def sample(count):
+        return normalize(topics[rng.integers(0, len(topics), count)] +
+                         0.8 * rng.standard_normal((count, args.dim), dtype=np.float32))
+
+    with tempfile.TemporaryDirectory() as directory:
+        index = SemanticIndex(embed_fn=None, db_path=os.path.join(directory, "chats.db"),
+                              vectors_path=os.path.join(directory, "vectors.f16"), model="synthetic")
+        # Fill the store directly, 100 messages per chat
+        start = time.perf_counter()
+        chunk = 10000
+        for first in range(0, args.messages, chunk):
+            count = min(chunk, args.messages - first)
+            vectors = sample(count)
+            first_row = index.store.append(vectors, index.model)
+            conn = sqlite3.connect(index.db_path)
+            conn.executemany('INSERT INTO message_vectors (row_id, chat_id, message_index) VALUES (?, ?, ?)',
+                             [(first_row + i, f"chat-{(first + i) // 100}", (first + i) % 100) for i in range(count)])
+            conn.commit()
+            conn.close()
+        print(f"indexed {args.messages} vectors in {time.perf_counter() - start:.2f}s, "
+              f"file size {os.path.getsize(index.store.path) / 1e6:.1f} MB")
+
+        exact_matrix = np.asarray(index.store.matrix(), dtype=np.float32)
+        index.search_vector(sample(1)[0], k=10)  # Warm the page cache
+        latencies, recalls = [], []
+        for _ in range(args.queries):
+            query = sample(1)[0]
+            start = time.perf_counter()
+            hits = index.search_vector(query, k=10)
+            latencies.append(time.perf_counter() - start)
+            exact = set(np.argsort(-(exact_matrix @ query))[:10].tolist())
+            found = {int(chat_id.split("-")[1]) * 100 + message_index for _, chat_id, message_index in hits}
+            recalls.append(len(exact & found) / 10)
+        latencies.sort()
+        print(f"queries={args.queries} p50={latencies[len(latencies) // 2] * 1000:.1f}ms "
+              f"max={latencies[-1] * 1000:.1f}ms recall@10={sum(recalls) / len(recalls):.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Startup cost: import time of the headless modules (each in a fresh interpreter) and, when a display is
+available, the desktop app's startup timeline against the fake server.
+
+    python benchmarks/bench_startup.py --runs 5
+
+Headless imports must not load the GUI toolkit or the Ollama client; any heavy module they pull in is listed.
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEADLESS_MODULES = ["utils", "ChatFileSystem", "chat_engine", "batch_runner", "api_client"]
+HEAVY_MODULES = ["customtkinter", "tkinter", "ollama", "httpx", "psutil", "numpy", "torch"]
+PROBE = """
+import sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(elapsed, ",".join(name for name in {heavy!r} if name in sys.modules))
+"""
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def import_time(module, runs):
+    times, heavy = [], ""
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", PROBE.format(module=module, heavy=HEAVY_MODULES)],
+                                cwd=ROOT, capture_output=True, text=True, check=True).stdout.split()
+        times.append(float(output[0]))
+        heavy = output[1] if len(output) > 1 else ""
+    return statistics.median(times), heavy
+
+
+def app_timeline(timeout):
+    env = dict(os.environ, OLLAMA_FAKE_SERVER="1", OLLAMA_HOST=f"http://127.0.0.1:{free_port()}")
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "startup.json")
+        subprocess.run([sys.executable, os.path.join(ROOT, "llama_desktop_app.py"), "--startup-report", path,
+                        "--exit-after-startup"], cwd=directory, env=env, timeout=timeout,
+                       stdout=subprocess.DEVNULL, check=True)
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)["events"]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5, help="Fresh interpreters per module, the median is shown")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    args = parser.parse_args()
+
+    print("module           import_ms  heavy modules loaded")
+    for module in HEADLESS_MODULES:
+        seconds, heavy = import_time(module, args.runs)
+        print(f"{module:15s}  {seconds * 1000:9.1f}  {heavy or '-'}")
+
+    if not (os.environ.get("DISPLAY") or sys.platform in ("win32", "darwin")):
+        print("\nNo display, skipping the desktop app timeline")
+        return
+    print("\nDesktop app startup timeline")
+    print("      at_ms  duration_ms  step")
+    for event in app_timeline(args.timeout):
+        duration = "" if event["duration_ms"] is None else f"{event['duration_ms']:.1f}"
+        name = f"import {event['name']}" if event["kind"] == "import" else event["name"]
+        print(f"{event['at_ms']:11.1f}  {duration:>11s}  {name}")
+
+
+if __name__ == "__main__":
+    main()
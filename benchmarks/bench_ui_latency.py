@@ -0,0 +1,152 @@
+"""
+Measures UI event-loop latency while long replies stream and a long chat is saved after every turn,
+with the backend in the GUI process (threads, the default) and in a worker process (LLAMA_BACKEND_PROCESS=1).
+
+    python benchmarks/bench_ui_latency.py --history 2000 --turns 10 --chats 2
+
+A callback is scheduled every --interval seconds, on a Tk root when a display is available and otherwise
+on a plain loop on the main thread; its lag is how much later than scheduled it actually ran.
+The fake server runs as its own process so it doesn't add to either side.
+"""
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class LagProbe:
+    def __init__(self, interval):
+        self.interval = interval
+        self.lags = []
+        self.root = None
+        if os.environ.get("DISPLAY") or sys.platform in ("win32", "darwin"):
+            import tkinter as tk
+            self.root = tk.Tk()
+            self.root.withdraw()
+
+    def run_until(self, done: threading.Event):
+        if self.root is None:
+            while not done.is_set():
+                expected = time.perf_counter() + self.interval
+                time.sleep(self.interval)
+                self.lags.append(time.perf_counter() - expected)
+            return
+
+        def tick(expected):
+            self.lags.append(time.perf_counter() - expected)
+            if done.is_set():
+                self.root.quit()
+                return
+            self.root.after(int(self.interval * 1000), tick, time.perf_counter() + self.interval)
+
+        self.root.after(int(self.interval * 1000), tick, time.perf_counter() + self.interval)
+        self.root.mainloop()
+
+
+def make_chat(history, index):
+    from utils import ChatObject
+
+    chat = ChatObject(f"benchmark {index}")
+    chat.creation_time += f"-{index}"
+    for turn in range(history // 2):
+        chat.messages.append({"role": "user", "content": f"question {turn} " + "lorem ipsum " * 40})
+        chat.messages.append({"role": "assistant", "content": f"answer {turn} " + "dolor sit amet " * 60})
+        chat.reply_times.append(1.0)
+        chat.addressed_models.append("llama3.2:3b")
+    return chat
+
+
+def run_turns(backend, chat, turns, model):
+    # What the app does per turn: stream a reply, then save the whole chat
+    for turn in range(turns):
+        chat.messages.append({"role": "user", "content": f"new question {turn}"})
+        pieces = []
+        response, time_taken = backend.get_response(chat, model, "CPU", on_piece=pieces.append)
+        chat.messages.append({"role": "assistant", "content": response['message']['content']})
+        chat.reply_times.append(time_taken)
+        chat.addressed_models.append(model)
+        backend.update_chat(chat)
+
+
+class InProcessBackend:
+    def __init__(self, db_path):
+        from ChatFileSystem import ChatMemory
+        from utils import get_response
+        self.chat_memory = ChatMemory(db_path)
+        self.get_response = get_response
+        self.add_chat = self.chat_memory.add_chat
+        self.update_chat = self.chat_memory.update_chat
+
+
+def measure(backend, args):
+    chats = [make_chat(args.history, i) for i in range(args.chats)]
+    for chat in chats:
+        backend.add_chat(chat)
+    done = threading.Event()
+    probe = LagProbe(args.interval)
+    workers = [threading.Thread(target=run_turns, args=(backend, chat, args.turns, args.model)) for chat in chats]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    threading.Thread(target=lambda: ([worker.join() for worker in workers], done.set()), daemon=True).start()
+    probe.run_until(done)
+    elapsed = time.perf_counter() - start
+    lags = sorted(lag * 1000 for lag in probe.lags)
+    return {"p50": statistics.median(lags), "p99": lags[int(len(lags) * 0.99)], "max": lags[-1],
+            "ticks": len(lags), "elapsed": elapsed}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--history", type=int, default=2000, help="Messages already in each chat")
+    parser.add_argument("--turns", type=int, default=10)
+    parser.add_argument("--chats", type=int, default=2, help="Chats answered at the same time")
+    parser.add_argument("--reply-tokens", type=int, default=400)
+    parser.add_argument("--token-latency", type=float, default=0.001)
+    parser.add_argument("--interval", type=float, default=0.005, help="Seconds between probe callbacks")
+    parser.add_argument("--model", default="llama3.2:3b")
+    args = parser.parse_args()
+
+    port = free_port()
+    server = subprocess.Popen([sys.executable, os.path.join(ROOT, "fake_ollama_server.py"), "--port", str(port),
+                               "--reply-tokens", str(args.reply_tokens), "--token-latency", str(args.token_latency)])
+    os.environ["OLLAMA_HOST"] = f"http://127.0.0.1:{port}"  # Must be set before utils reads its configuration
+    from backend_process import ProcessBackend
+    from utils import wait_for_server
+
+    try:
+        wait_for_server(process=server)
+        with tempfile.TemporaryDirectory() as directory:
+            results = {"in process": measure(InProcessBackend(os.path.join(directory, "threads.db")), args)}
+            backend = ProcessBackend(os.path.join(directory, "process.db")).start()
+            if not backend.is_alive(timeout=30):
+                raise SystemExit("Backend process did not start")
+            try:
+                results["worker process"] = measure(backend, args)
+            finally:
+                backend.close()
+    finally:
+        server.terminate()
+
+    print("backend          lag_p50_ms  lag_p99_ms  lag_max_ms  ticks  elapsed_s")
+    for name, row in results.items():
+        print(f"{name:15s}  {row['p50']:10.2f}  {row['p99']:10.2f}  {row['max']:10.2f}  {row['ticks']:5d}  "
+              f"{row['elapsed']:9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+"""
+Bulk import of exported chats (the format save_chat writes) from a folder or an archive (.zip, .tar, .tar.gz).
+
+    python bulk_import.py exports/ --db chats.db --workers 8
+    python bulk_import.py exports.zip
+
+Files are read, parsed and validated in a process pool, and each worker hands back the chat already encoded as
+database values, so the parsing scales with the cores. The calling thread is the single writer: it drops chats
+that are already stored (same name and same messages, see chat_fingerprint) or that appear twice in the import,
+and adds the rest with ChatMemory.add_chat_rows in large transactions, which allocates their ids. A file that
+fails is reported and skipped, the others are still imported.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tarfile
+import time
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from ChatFileSystem import ChatMemory, prefix_digests
+from chat_import import REQUIRED_KEYS
+from utils import MessageList, validate_data_structure
+
+TRANSACTION_CHATS = 500  # Chats per transaction at most
+TRANSACTION_BYTES = 64 << 20  # Encoded chats held before a transaction is written
+PENDING_PER_WORKER = 4  # Files in flight per worker, bounds the parsed chats waiting for the writer
+ARCHIVE_SUFFIXES = (".zip", ".tar", ".tar.gz", ".tgz")
+
+
+def tar_members(archive):
+    return (member for member in archive if member.isfile() and member.name.lower().endswith(".json"))
+
+
+def collect_sources(path: str) -> list:
+    """
+    [(label, path, member, data)] of the .json files of a folder (recursive) or an archive, sorted (tar members
+    in archive order), data is None. Workers read files and zip members themselves; tar members can only be read
+    in order, so read_sources reads them as they are handed to the workers.
+    """
+    if os.path.isdir(path):
+        return [(os.path.relpath(os.path.join(root, name), path), os.path.join(root, name), None, None)
+                for root, _, names in sorted(os.walk(path)) for name in sorted(names)
+                if name.lower().endswith(".json")]
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            return [(member, path, member, None) for member in sorted(archive.namelist())
+                    if member.lower().endswith(".json")]
+    if path.lower().endswith(ARCHIVE_SUFFIXES) and tarfile.is_tarfile(path):
+        with tarfile.open(path) as archive:
+            return [(member.name, path, member.name, None) for member in tar_members(archive)]
+    raise ValueError(f"{path} is not a folder or a .zip / .tar archive")
+
+
+def read_sources(path: str, sources: list):
+    # Yields the sources, with the data of tar members read one at a time (on the next submit to the pool)
+    if os.path.isdir(path) or zipfile.is_zipfile(path):
+        yield from sources
+        return
+    with tarfile.open(path) as archive:
+        for member in tar_members(archive):
+            yield member.name, path, member.name, archive.extractfile(member).read()
+
+
+def chat_fingerprint(messages) -> str:
+    # Same fingerprint as branch prefixes, over the whole history
+    return prefix_digests(messages, [len(messages)])[len(messages)]
+
+
+def parse_chat_file(source) -> dict:
+    # Runs in a worker: {"source", "size", "name", "count", "fingerprint", "row"} or {"source", "size", "error"}
+    label, path, member, data = source
+    try:
+        if data is None and member is None:
+            with open(path, 'rb') as f:
+                data = f.read()
+        elif data is None:
+            with zipfile.ZipFile(path) as archive:
+                data = archive.read(member)
+        chat_data = json.loads(data)
+        if not isinstance(chat_data, dict):
+            raise ValueError("Invalid chat data format: expected a dictionary")
+        if not all(key in chat_data for key in REQUIRED_KEYS):
+            raise ValueError("Invalid chat data format: Missing some required keys")
+        error = validate_data_structure(chat_data)
+        if error:
+            raise error
+        messages = MessageList(chat_data["messages"])
+        row = (chat_data["name"], json.dumps(chat_data["messages"]), json.dumps(chat_data["reply_times"]),
+               json.dumps(chat_data["addressed_models"]), chat_data["instructions"],
+               json.dumps(chat_data.get("options") or {}), json.dumps(chat_data.get("turn_metrics") or []), "{}")
+        return {"source": label, "size": len(data), "name": chat_data["name"], "count": len(messages),
+                "fingerprint": chat_fingerprint(messages), "row": row}
+    except json.JSONDecodeError as e:
+        return {"source": label, "size": len(data or b""), "error": f"Invalid JSON: {e}"}
+    except Exception as e:
+        return {"source": label, "size": len(data or b""), "error": str(e)}
+
+
+class StoredChats:
+    # Fingerprints of the stored chats, computed only for chats with the name and length of an imported one
+    def __init__(self, chat_memory: ChatMemory):
+        self.chat_memory = chat_memory
+        self.ids_by_name = {}
+        for chat_id, name in chat_memory.list_chats():
+            self.ids_by_name.setdefault(name, []).append(chat_id)
+        self.counts = {}
+        self.fingerprints = {}
+
+    def contains(self, name: str, count: int, fingerprint: str) -> bool:
+        for chat_id in self.ids_by_name.get(name, ()):
+            if chat_id not in self.counts:
+                self.counts[chat_id] = self.chat_memory.get_message_count(chat_id)
+            if self.counts[chat_id] != count:
+                continue
+            if chat_id not in self.fingerprints:
+                self.fingerprints[chat_id] = chat_fingerprint(self.chat_memory.get_chat_by_timestamp(chat_id).messages)
+            if self.fingerprints[chat_id] == fingerprint:
+                return True
+        return False
+
+
+def bulk_import(path: str, chat_memory: ChatMemory, workers: int = None, on_progress=None, on_chats=None,
+                cancelled=None) -> dict:
+    """
+    Imports the chats of a folder or archive. on_progress(summary) is called after every file, on_chats([(chat
+    id, name)]) after every transaction; cancelled is a threading.Event checked between files, chats written
+    until then stay. Returns {"files", "done", "imported", "duplicates", "errors": [(file, message)], "bytes",
+    "seconds", "files_per_second", "mb_per_second", "workers", "cancelled"}.
+    """
+    start = time.perf_counter()
+    workers = workers or os.cpu_count() or 1
+    sources = collect_sources(path)
+    stored = StoredChats(chat_memory)
+    seen = set()  # (name, count, fingerprint) of the chats of this import
+    summary = {"files": len(sources), "done": 0, "imported": 0, "duplicates": 0, "errors": [], "bytes": 0,
+               "workers": workers, "cancelled": False}
+    rows, row_bytes = [], 0
+
+    def write():
+        nonlocal rows, row_bytes
+        if rows:
+            ids = chat_memory.add_chat_rows(rows)
+            if on_chats is not None:
+                on_chats([(chat_id, row[0]) for chat_id, row in zip(ids, rows)])
+            rows, row_bytes = [], 0
+
+    def add(result):
+        nonlocal row_bytes
+        summary["done"] += 1
+        summary["bytes"] += result["size"]
+        if "error" in result:
+            summary["errors"].append((result["source"], result["error"]))
+            return
+        key = (result["name"], result["count"], result["fingerprint"])
+        if key in seen or stored.contains(*key):
+            summary["duplicates"] += 1
+            return
+        seen.add(key)
+        rows.append(result["row"])
+        row_bytes += result["size"]
+        summary["imported"] += 1
+        if len(rows) >= TRANSACTION_CHATS or row_bytes >= TRANSACTION_BYTES:
+            write()
+
+    # Spawned, not forked: the app calls this with Tk and other threads running
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        pending, queued = set(), read_sources(path, sources)
+        while True:
+            while not summary["cancelled"] and len(pending) < workers * PENDING_PER_WORKER:
+                source = next(queued, None)
+                if source is None:
+                    break
+                pending.add(executor.submit(parse_chat_file, source))
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                add(future.result())
+                if on_progress is not None:
+                    on_progress(summary)
+            if cancelled is not None and cancelled.is_set() and not summary["cancelled"]:
+                summary["cancelled"] = True
+                for future in pending:
+                    future.cancel()
+        queued.close()
+    write()
+
+    seconds = time.perf_counter() - start
+    summary.update(seconds=seconds, files_per_second=summary["done"] / seconds if seconds else 0.0,
+                   mb_per_second=summary["bytes"] / (1 << 20) / seconds if seconds else 0.0)
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import a folder or archive of exported chats")
+    parser.add_argument("path", help="Folder (searched recursively) or .zip / .tar / .tar.gz archive of .json chats")
+    parser.add_argument("--db", default="chats.db")
+    parser.add_argument("--workers", type=int, default=None, help="Parsing processes, default one per core")
+    args = parser.parse_args(argv)
+
+    def progress(summary):
+        if summary["done"] % 100 == 0 or summary["done"] == summary["files"]:
+            print(f"[{summary['done']}/{summary['files']}] {summary['imported']} imported, "
+                  f"{summary['duplicates']} duplicates, {len(summary['errors'])} errors", file=sys.stderr)
+
+    try:
+        summary = bulk_import(args.path, ChatMemory(args.db), args.workers, progress)
+    except (OSError, ValueError) as e:
+        print(e, file=sys.stderr)
+        return 2
+    for source, error in summary["errors"]:
+        print(f"{source}: {error}", file=sys.stderr)
+    print(f"{summary['imported']} chats imported, {summary['duplicates']} duplicates skipped, "
+          f"{len(summary['errors'])} files failed ({summary['done']} files, {summary['bytes'] / (1 << 20):.1f} MB "
+          f"in {summary['seconds']:.2f} s: {summary['files_per_second']:.0f} files/s, "
+          f"{summary['mb_per_second']:.1f} MB/s, {summary['workers']} workers)")
+    return 1 if summary["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,186 @@
+"""
+The chat operations of the app without any UI: storing chats and answering a new message through
+utils.get_response. Used by the API server (api_server.py) so remote clients get exactly the same
+request path as the desktop app.
+"""
+import json
+import threading
+
+from ChatFileSystem import MESSAGE_COLUMNS, TURN_COLUMNS, ChatMemory
+from utils import (ChatObject, extract_turn_metrics, get_available_models, get_response, prefill_chat,
+                   recorded_options, validate_data_structure, validate_message)
+
+
+class ChatNotFoundError(KeyError):
+    pass
+
+
+def chat_to_dict(chat_object: ChatObject) -> dict:
+    # Same keys as the exported chat files, plus the id and the stored server context
+    return {
+        "id": chat_object.creation_time,
+        "name": chat_object.name,
+        "messages": chat_object.messages.tolist(),
+        "reply_times": list(chat_object.reply_times),
+        "addressed_models": chat_object.addressed_models,
+        "instructions": chat_object.instructions,
+        "options": chat_object.options,
+        "turn_metrics": chat_object.turn_metrics,
+        "kv_context": chat_object.kv_context,
+    }
+
+
+def chat_from_dict(chat_data: dict) -> ChatObject:
+    # Missing history keys default to an empty chat, raises ValueError like an import of a bad file
+    chat_data = dict(chat_data)
+    for key in ("messages", "reply_times", "addressed_models"):
+        chat_data.setdefault(key, [])
+    if not chat_data.get("name"):
+        raise ValueError("Invalid chat data format: 'name' is required")
+    error = validate_data_structure(chat_data)
+    if error:
+        raise error
+    chat = ChatObject(chat_data["name"],
+                      messages=chat_data["messages"],
+                      reply_times=chat_data["reply_times"],
+                      addressed_models=chat_data["addressed_models"],
+                      instructions=chat_data.get("instructions", ""),
+                      options=chat_data.get("options") or {},
+                      turn_metrics=chat_data.get("turn_metrics") or [],
+                      kv_context=chat_data.get("kv_context") or {})
+    if chat_data.get("id"):
+        chat.creation_time = chat_data["id"]
+    return chat
+
+
+class ChatEngine:
+    def __init__(self, chat_memory: ChatMemory = None, retriever=None):
+        self.chat_memory = chat_memory or ChatMemory()
+        self.retriever = retriever  # Document retriever passed to get_response, see DocumentIndex.retriever
+        self._chat_locks = {}  # chat id -> lock, one turn at a time per chat
+        self._locks_lock = threading.Lock()
+
+    def _chat_lock(self, chat_id: str) -> threading.Lock:
+        with self._locks_lock:
+            return self._chat_locks.setdefault(chat_id, threading.Lock())
+
+    def list_models(self) -> list:
+        return get_available_models()
+
+    def list_chats(self) -> list:
+        return [{"id": chat_id, "name": name} for chat_id, name in self.chat_memory.list_chats()]
+
+    def list_chat_tree(self) -> list:
+        return [{"id": chat_id, "name": name, "parent_id": parent_id, "fork_point": fork_point}
+                for chat_id, name, parent_id, fork_point in self.chat_memory.list_chat_tree()]
+
+    def get_chat(self, chat_id: str) -> ChatObject:
+        chat = self.chat_memory.get_chat_by_timestamp(chat_id)
+        if chat is None:
+            raise ChatNotFoundError(chat_id)
+        return chat
+
+    def get_chat_header(self, chat_id: str) -> dict:
+        header = self.chat_memory.get_chat_header(chat_id)
+        if header is None:
+            raise ChatNotFoundError(chat_id)
+        return dict(header, id=chat_id)
+
+    def get_message_count(self, chat_id: str) -> dict:
+        self.get_chat_header(chat_id)
+        return {"count": self.chat_memory.get_message_count(chat_id)}
+
+    def get_message_page(self, chat_id: str, start: int, count: int) -> list:
+        # Messages of a stored chat for paginated display, see ChatMemory.get_message_page
+        self.get_chat_header(chat_id)
+        return self.chat_memory.get_message_page(chat_id, int(start), int(count))
+
+    def get_message_sizes(self, chat_id: str, start: int = 0) -> dict:
+        self.get_chat_header(chat_id)
+        sizes = self.chat_memory.get_message_sizes(chat_id, int(start))
+        return {"start": int(start), "sizes": [[int(is_user), characters, newlines]
+                                               for is_user, characters, newlines in sizes]}
+
+    def create_chat(self, chat_data: dict) -> ChatObject:
+        chat = chat_from_dict(chat_data)
+        self.chat_memory.add_chat(chat)
+        return chat
+
+    def update_chat(self, chat_id: str, chat_data: dict) -> ChatObject:
+        # Replaces the stored history / instructions / options of an existing chat
+        chat = chat_from_dict(dict(chat_data, id=chat_id, name=chat_data.get("name") or "chat"))
+        with self._chat_lock(chat_id):
+            self.get_chat(chat_id)
+            self.chat_memory.update_chat(chat)
+        return self.get_chat(chat_id)
+
+    def fork_chat(self, chat_id: str, message_count: int, name: str = None) -> ChatObject:
+        # New chat sharing the first message_count messages of the chat, see ChatMemory.fork_chat
+        chat = self.get_chat(chat_id)
+        with self._chat_lock(chat_id):
+            return self.chat_memory.fork_chat(chat_id, int(message_count), name or f"{chat.name} (branch)")
+
+    def stage_import_batch(self, import_id: str, column: str, batch: int, items: list):
+        # A slice of a streamed import (see chat_import.py), checked again since it comes from a client
+        if column not in MESSAGE_COLUMNS + TURN_COLUMNS:
+            raise ValueError(f"Invalid chat data format: unknown history column '{column}'")
+        if not isinstance(items, list) or not items:
+            raise ValueError(f"Invalid chat data format: '{column}' slice should be a non-empty list")
+        if column == "messages":
+            for index, message in enumerate(items):
+                validate_message(index, message)
+        self.chat_memory.stage_import_batch(import_id, column, int(batch), json.dumps(items))
+
+    def finish_import(self, import_id: str, chat_data: dict) -> dict:
+        # Adds the chat of a streamed import, chat_data has its id, name, instructions and options
+        if not chat_data.get("name"):
+            raise ValueError("Invalid chat data format: 'name' is required")
+        if not isinstance(chat_data.get("options") or {}, dict):
+            raise ValueError("Invalid chat data format: 'options' should be a dictionary")
+        chat = ChatObject(chat_data["name"], instructions=chat_data.get("instructions", ""),
+                          options=chat_data.get("options") or {})
+        if chat_data.get("id"):
+            chat.creation_time = chat_data["id"]
+        self.chat_memory.finish_import(import_id, chat)
+        return {"id": chat.creation_time, "name": chat.name}
+
+    def abort_import(self, import_id: str):
+        self.chat_memory.abort_import(import_id)
+
+    def delete_chat(self, chat_id: str):
+        self.get_chat(chat_id)
+        self.chat_memory.delete_chat_by_timestamp(chat_id)
+        with self._locks_lock:
+            self._chat_locks.pop(chat_id, None)
+
+    def get_model_options(self, model: str) -> dict:
+        return self.chat_memory.get_model_options(model)
+
+    def set_model_options(self, model: str, options: dict):
+        self.chat_memory.set_model_options(model, options)
+
+    def respond(self, chat_object: ChatObject, model: str, selected_gpu: str = "CPU", on_piece=None):
+        # Answers the last message of a chat without storing anything.
+        # Returns (response, time_taken, turn metrics)
+        model_options = self.chat_memory.get_model_options(model)
+        response, time_taken = get_response(chat_object, model, selected_gpu, model_options, self.retriever, on_piece)
+        return response, time_taken, extract_turn_metrics(response, recorded_options(model_options, chat_object.options))
+
+    def prefill(self, chat_object: ChatObject, model: str, selected_gpu: str = "CPU") -> dict:
+        # Evaluates the history ahead of the next message, see utils.prefill_chat
+        return prefill_chat(chat_object, model, selected_gpu, self.chat_memory.get_model_options(model))
+
+    def send_message(self, chat_id: str, prompt: str, model: str, selected_gpu: str = "CPU", on_piece=None) -> dict:
+        # Appends the prompt, answers it and stores the turn. on_piece(text) streams the reply
+        with self._chat_lock(chat_id):
+            chat = self.get_chat(chat_id)
+            chat.messages.append({"role": "user", "content": prompt})
+            response, time_taken, metrics = self.respond(chat, model, selected_gpu, on_piece)
+            content = response['message']['content']
+            chat.messages.append({"role": "assistant", "content": content})
+            chat.reply_times.append(time_taken)
+            chat.addressed_models.append(model)
+            chat.turn_metrics.append(metrics)
+            self.chat_memory.update_chat(chat)
+        return {"chat_id": chat_id, "message_index": len(chat.messages) - 1, "content": content,
+                "reply_time": time_taken, "model": model, "metrics": metrics}
@@ -0,0 +1,188 @@
+"""
+Streaming import of exported chat files (the format save_chat writes), for exports too large to load at once.
+
+The file is parsed a chunk at a time and the history arrays element by element: every message is validated
+as it arrives (same errors as utils.validate_data_structure, so a bad file fails at its first bad message),
+and the arrays are written to ChatMemory in batches, one transaction each, then copied slice by slice into the
+new chat row through blob I/O (ChatMemory.finish_import). Memory use, Python's and SQLite's, is bounded by the
+batch size and the largest single message, not by the file.
+"""
+import codecs
+import json
+import os
+import uuid
+
+from utils import ChatObject, parse_generation_options, validate_message
+
+CHUNK_SIZE = 1 << 20  # Bytes read at a time
+BATCH_SIZE = 2000  # Array elements per transaction
+HISTORY_KEYS = ("messages", "reply_times", "addressed_models", "turn_metrics")
+REQUIRED_KEYS = ("name", "messages", "reply_times", "addressed_models", "instructions")
+WHITESPACE = " \t\r\n"
+NUMBER_CHARACTERS = "0123456789.eE+-"
+
+
+class ImportCancelled(Exception):
+    pass
+
+
+class JsonStream:
+    """JSON values read from a binary file a chunk at a time, arrays can be consumed element by element."""
+
+    def __init__(self, f, chunk_size: int = CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.bytes_read = 0
+
+    def fill(self, at_least: int = 0) -> bool:
+        # Reads more text, dropping what was consumed. Reads at least as much as asked for, so a large value
+        # that needs several attempts to decode is buffered in a few geometric steps
+        if self.eof:
+            return False
+        data = self.f.read(max(self.chunk_size, at_least))
+        self.bytes_read += len(data)
+        self.buffer = self.buffer[self.pos:] + self.text_decoder.decode(data, final=not data)
+        self.pos = 0
+        self.eof = not data
+        return bool(data)
+
+    def error(self, message: str):
+        return json.JSONDecodeError(message, self.buffer, self.pos)
+
+    def peek(self) -> str:
+        # Next non-whitespace character, "" at the end of the file
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return ""
+
+    def expect(self, character: str):
+        if self.peek() != character:
+            raise self.error(f"Expecting '{character}'")
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError as e:
+                # Only a value cut off by the end of the buffer is worth reading more for
+                truncated = e.pos >= len(self.buffer) - 8 or e.msg.startswith("Unterminated string")
+                if not truncated or not self.fill(len(self.buffer) - self.pos):
+                    raise
+                continue
+            # A number at the end of the buffer may go on in the next chunk
+            if not self.eof and len(self.buffer) - end < 32 and not self.buffer[end:].strip(NUMBER_CHARACTERS):
+                if self.fill():
+                    continue
+            self.pos = end
+            return value
+
+    def items(self):
+        # Elements of the array starting at the current position
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            separator = self.peek()
+            self.pos += 1
+            if separator == "]":
+                return
+            if separator != ",":
+                self.pos -= 1
+                raise self.error("Expecting ',' delimiter")
+
+    def keys(self):
+        # Keys of the object starting at the current position, the caller reads each value
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            if self.peek() != '"':
+                raise self.error("Expecting property name enclosed in double quotes")
+            key = self.value()
+            self.expect(":")
+            yield key
+            separator = self.peek()
+            self.pos += 1
+            if separator == "}":
+                return
+            if separator != ",":
+                self.pos -= 1
+                raise self.error("Expecting ',' delimiter")
+
+
+def import_chat_file(path: str, chat_memory, on_progress=None, cancelled=None, batch_size: int = BATCH_SIZE):
+    """
+    Imports an exported chat into chat_memory and returns its (chat id, name). on_progress(bytes read, file
+    size) is called after every batch; cancelled is a threading.Event checked as often. Raises ValueError for
+    an invalid chat, json.JSONDecodeError for a malformed file and ImportCancelled; nothing is added then.
+    """
+    total = os.path.getsize(path)
+    import_id = uuid.uuid4().hex
+    fields, counts, batches = {}, {}, 0
+
+    def stage(column, items):
+        nonlocal batches
+        if cancelled is not None and cancelled.is_set():
+            raise ImportCancelled()
+        chat_memory.stage_import_batch(import_id, column, batches, "[" + ", ".join(items) + "]")
+        batches += 1
+        if on_progress is not None:
+            on_progress(stream.bytes_read, total)
+
+    try:
+        with open(path, "rb") as f:
+            stream = JsonStream(f)
+            if stream.peek() != "{":
+                raise ValueError("Invalid chat data format: expected a dictionary")
+            for key in stream.keys():
+                if key not in HISTORY_KEYS:
+                    fields[key] = stream.value()
+                    continue
+                if stream.peek() != "[":
+                    raise ValueError(f"Invalid chat data format: '{key}' should be a list")
+                if key in counts:
+                    raise ValueError(f"Invalid chat data format: '{key}' appears twice")
+                batch, count = [], 0
+                for item in stream.items():
+                    if key == "messages":
+                        validate_message(count, item)
+                    batch.append(json.dumps(item))
+                    count += 1
+                    if len(batch) >= batch_size:
+                        stage(key, batch)
+                        batch = []
+                if batch:
+                    stage(key, batch)
+                counts[key] = count
+            if stream.peek():
+                raise stream.error("Extra data")
+
+        if not all(key in fields or key in counts for key in REQUIRED_KEYS):
+            raise ValueError("Invalid chat data format: Missing some required keys")
+        if counts["reply_times"] != counts["addressed_models"]:
+            raise ValueError(f"Number of  reply_times {counts['reply_times']} doesn't match number of "
+                             f"addressed_models {counts['addressed_models']}")
+        if "options" in fields and not isinstance(fields["options"], dict):
+            raise ValueError("Invalid chat data format: 'options' should be a dictionary")
+        options = parse_generation_options(fields.get("options") or {})  # Same checks as utils.validate_data_structure
+
+        chat = ChatObject(fields["name"], instructions=fields["instructions"], options=options)
+        chat_memory.finish_import(import_id, chat)
+        return chat.creation_time, chat.name
+    except BaseException:
+        chat_memory.abort_import(import_id)
+        raise
@@ -0,0 +1,255 @@
+"""
+Sidebar chat list that stays fast with tens of thousands of chats.
+
+Chats are kept newest first and grouped by date under header rows. Only the rows that fit in the Listbox
+are inserted into it, so loading, filtering and scrolling don't depend on the number of chats in Tk.
+Typing in the filter box narrows the previous matches when the query only got longer. Selection is by
+chat id, never by row position: an id -> row index is rebuilt with the rows. The date groups are recomputed
+when the day changes, so "Today" doesn't stay on yesterday's chats.
+"""
+import tkinter as tk
+from datetime import date, datetime, timedelta
+
+HEADER_COLOR = '#8a8a8a'
+
+
+def date_group(chat_id: str, today: date) -> str:
+    # Chat ids are ISO timestamps of the chat creation
+    try:
+        created = datetime.fromisoformat(chat_id[:26]).date()
+    except ValueError:
+        return "Older"
+    age = (today - created).days
+    if age <= 0:
+        return "Today"
+    if age == 1:
+        return "Yesterday"
+    if age < 7:
+        return "Previous 7 Days"
+    if age < 30:
+        return "Previous 30 Days"
+    return created.strftime("%B %Y")
+
+
+class ChatListView(tk.Frame):
+    def __init__(self, master, on_select, entry_options=None, **listbox_options):
+        super().__init__(master, bg=listbox_options.get('bg'))
+        self.on_select = on_select  # on_select(chat_id) when the user picks a chat
+        self.grid_columnconfigure(0, weight=1)
+        self.grid_rowconfigure(1, weight=1)
+
+        self.filter_var = tk.StringVar()
+        self.filter_entry = tk.Entry(self, textvariable=self.filter_var, **(entry_options or {}))
+        self.filter_entry.grid(row=0, column=0, columnspan=2, sticky="ew", pady=(0, 5))
+        self.filter_var.trace_add("write", lambda *_: self.apply_filter())
+
+        self.listbox = tk.Listbox(self, exportselection=False, activestyle='none', **listbox_options)
+        self.listbox.grid(row=1, column=0, sticky="nsew")
+        self.scrollbar = tk.Scrollbar(self, command=self.yview)
+        self.scrollbar.grid(row=1, column=1, sticky="ns")
+        self.listbox.bind('<<ListboxSelect>>', self.on_listbox_select)
+        for sequence in ("<MouseWheel>", "<Button-4>", "<Button-5>"):
+            self.listbox.bind(sequence, self.on_mouse_wheel)
+        self.listbox.bind("<Configure>", lambda event: self.render())
+
+        self.ids = []  # Newest first
+        self.names = {}  # chat id -> name
+        self.lowered = []  # Lower case names, parallel to ids
+        self.groups = []  # Date group of each chat, parallel to ids
+        self.query = ""
+        self.matches = []  # Positions in ids matching the filter
+        self.rows = []  # Visible rows: position in ids, or -1 - group number for a header
+        self.row_index = {}  # chat id -> row in rows, for the chats passing the filter
+        self.group_names = []
+        self.first_row = 0
+        self.selected_id = None
+        self.today = date.today()  # Day the groups were computed for
+        self.schedule_rollover()
+
+    # ---- data ----
+    def set_chats(self, chats):
+        # chats: [(chat_id, name)] in any order
+        self.today = date.today()
+        ordered = sorted(chats, key=lambda chat: chat[0], reverse=True)
+        self.ids = [chat_id for chat_id, _ in ordered]
+        self.names = dict(ordered)
+        self.lowered = [name.lower() for _, name in ordered]
+        self.groups = [date_group(chat_id, self.today) for chat_id in self.ids]
+        self.query = None  # Forces a full filter pass
+        self.apply_filter()
+
+    def position_of(self, chat_id: str) -> int:
+        # Binary search in the newest first ids: the first position whose id is not newer than chat_id
+        low, high = 0, len(self.ids)
+        while low < high:
+            middle = (low + high) // 2
+            if self.ids[middle] > chat_id:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def add_chat(self, chat_id: str, name: str):
+        self.check_date()
+        position = self.position_of(chat_id)
+        self.ids.insert(position, chat_id)
+        self.names[chat_id] = name
+        self.lowered.insert(position, name.lower())
+        self.groups.insert(position, date_group(chat_id, self.today))
+        self.query = None
+        self.apply_filter()
+
+    def remove_chat(self, chat_id: str):
+        # Returns the id of the chat now shown in its place (the next one, or the previous at the end), or None
+        if chat_id not in self.names:
+            return None
+        neighbour = None
+        row = self.row_index.get(chat_id)
+        if row is not None:
+            after = next((position for position in self.rows[row + 1:] if position >= 0), None)
+            before = next((position for position in reversed(self.rows[:row]) if position >= 0), None)
+            if after is not None:
+                neighbour = self.ids[after]
+            elif before is not None:
+                neighbour = self.ids[before]
+        position = self.position_of(chat_id)
+        del self.ids[position], self.lowered[position], self.groups[position]
+        del self.names[chat_id]
+        if self.selected_id == chat_id:
+            self.selected_id = None
+        self.query = None
+        self.apply_filter()
+        return neighbour
+
+    def has_chat(self, chat_id: str) -> bool:
+        return chat_id in self.names
+
+    def name_of(self, chat_id: str) -> str:
+        return self.names.get(chat_id)
+
+    # ---- date groups ----
+    def schedule_rollover(self):
+        # Wakes up just after the next midnight to move the chats to their new date groups
+        now = datetime.now()
+        midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+        self.after(int((midnight - now).total_seconds() * 1000) + 1000, self.on_rollover)
+
+    def on_rollover(self):
+        self.check_date()
+        self.schedule_rollover()
+
+    def check_date(self):
+        # Regroups the chats when the day changed since the groups were computed (also covers a late timer)
+        today = date.today()
+        if today == self.today:
+            return
+        self.today = today
+        self.groups = [date_group(chat_id, today) for chat_id in self.ids]
+        self.build_rows()
+        self.render()
+
+    # ---- filtering ----
+    def apply_filter(self):
+        query = self.filter_var.get().strip().lower()
+        if self.query is not None and query.startswith(self.query):
+            candidates = self.matches  # Longer query: only the previous matches can still match
+        else:
+            candidates = range(len(self.ids))
+        lowered = self.lowered
+        self.matches = [i for i in candidates if query in lowered[i]] if query else list(candidates)
+        self.query = query
+        self.build_rows()
+        self.first_row = 0
+        self.render()
+
+    def build_rows(self):
+        rows, group_names, row_index = [], [], {}
+        previous = None
+        ids, groups = self.ids, self.groups
+        for i in self.matches:
+            if groups[i] != previous:
+                previous = groups[i]
+                group_names.append(previous)
+                rows.append(-len(group_names))
+            row_index[ids[i]] = len(rows)
+            rows.append(i)
+        self.rows, self.group_names, self.row_index = rows, group_names, row_index
+
+    # ---- selection ----
+    def row_of(self, chat_id: str):
+        return self.row_index.get(chat_id)
+
+    def select(self, chat_id: str):
+        # Selects and scrolls to a chat, clearing the filter if it hides the chat
+        self.selected_id = chat_id
+        row = self.row_of(chat_id)
+        if row is None and self.query:
+            self.filter_var.set("")  # Re-filters through the variable trace
+            row = self.row_of(chat_id)
+        if row is not None:
+            visible = self.visible_rows()
+            if not self.first_row <= row < self.first_row + visible:
+                self.first_row = max(0, row - visible // 2)
+        self.render()
+
+    def on_listbox_select(self, event):
+        selection = self.listbox.curselection()
+        if not selection:
+            return
+        row = self.first_row + selection[0]
+        if row >= len(self.rows) or self.rows[row] < 0:
+            self.render()  # Headers can't be selected, restore the highlight of the selected chat
+            return
+        chat_id = self.ids[self.rows[row]]
+        if chat_id != self.selected_id:
+            self.selected_id = chat_id
+            self.on_select(chat_id)
+
+    # ---- scrolling ----
+    def visible_rows(self) -> int:
+        bbox = self.listbox.bbox(0)
+        height = self.listbox.winfo_height()
+        if not bbox or height <= 1:
+            return int(self.listbox.cget("height"))
+        return max(1, height // bbox[3])
+
+    def yview(self, *args):
+        visible = self.visible_rows()
+        if args[0] == "moveto":
+            self.first_row = int(float(args[1]) * len(self.rows))
+        elif args[0] == "scroll":
+            self.first_row += int(args[1]) * (visible if args[2] == "pages" else 1)
+        self.render()
+
+    def on_mouse_wheel(self, event):
+        if event.num == 4:
+            lines = -3
+        elif event.num == 5:
+            lines = 3
+        else:
+            lines = -3 * (1 if event.delta > 0 else -1)
+        self.yview("scroll", lines, "units")
+        return "break"
+
+    def config(self, cnf=None, **options):
+        # Styling goes to the Listbox, like the plain Listbox this replaces
+        options.update(cnf or {})
+        self.listbox.config(**options)
+        self.render()
+
+    configure = config
+
+    def render(self):
+        visible = self.visible_rows()
+        self.first_row = max(0, min(self.first_row, len(self.rows) - visible))
+        window = self.rows[self.first_row:self.first_row + visible + 1]
+        self.listbox.delete(0, tk.END)
+        self.listbox.insert(tk.END, *[self.group_names[-row - 1] if row < 0 else self.names[self.ids[row]]
+                                      for row in window])
+        for offset, row in enumerate(window):
+            if row < 0:
+                self.listbox.itemconfig(offset, fg=HEADER_COLOR, selectforeground=HEADER_COLOR)
+            elif self.ids[row] == self.selected_id:
+                self.listbox.selection_set(offset)
+        total = max(1, len(self.rows))
+        self.scrollbar.set(self.first_row / total, min(1.0, (self.first_row + visible) / total))
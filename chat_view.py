@@ -0,0 +1,446 @@
+"""
+Virtualized chat display for very long conversations.
+
+Only the messages around the viewport are inserted into the Text widget. Every message has a height in
+display lines, estimated from its length and the widget width until it has been shown and measured, kept
+in a Fenwick tree so the message at any scroll position is found in O(log n). Messages are read from a
+source a page at a time through a small cache, so memory use stays bounded by the window and the cache,
+not by the chat (apart from a few bytes per message for the size index).
+"""
+import tkinter as tk
+import tkinter.font as tkfont
+from array import array
+from collections import OrderedDict
+
+PAGE_SIZE = 100
+CACHED_PAGES = 8
+WINDOW_MARGIN = 5  # Messages materialized above and below the visible ones
+MAX_WINDOW = 200  # Upper bound of materialized messages, whatever their size
+
+
+class HeightIndex:
+    """Fenwick tree over item heights: prefix sums and position lookups in O(log n)."""
+
+    def __init__(self, heights=()):
+        self.heights = array('l')
+        self.tree = array('l', [0])  # 1-based
+        self.rebuild(heights)
+
+    def rebuild(self, heights):
+        self.heights = array('l', heights)
+        self.tree = array('l', [0]) + self.heights
+        for i in range(1, len(self.tree)):
+            parent = i + (i & -i)
+            if parent < len(self.tree):
+                self.tree[parent] += self.tree[i]
+
+    def __len__(self):
+        return len(self.heights)
+
+    def append(self, height: int):
+        i = len(self.tree)
+        self.heights.append(height)
+        # The new node covers (i - lowbit(i), i]
+        self.tree.append(height + self.prefix(i - 1) - self.prefix(i - (i & -i)))
+
+    def set(self, index: int, height: int):
+        delta = height - self.heights[index]
+        if not delta:
+            return
+        self.heights[index] = height
+        i = index + 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+    def prefix(self, count: int) -> int:
+        # Sum of the first count heights, i.e. the first line of item count
+        total = 0
+        while count > 0:
+            total += self.tree[count]
+            count -= count & -count
+        return total
+
+    def total(self) -> int:
+        return self.prefix(len(self.heights))
+
+    def find(self, line: int) -> int:
+        # Index of the item containing the given line
+        position, remaining = 0, line
+        step = 1 << (len(self.heights).bit_length())
+        while step:
+            nxt = position + step
+            if nxt < len(self.tree) and self.tree[nxt] <= remaining:
+                position = nxt
+                remaining -= self.tree[nxt]
+            step >>= 1
+        return min(position, max(len(self.heights) - 1, 0))
+
+
+class ChatObjectSource:
+    """Messages of a ChatObject already in memory."""
+
+    def __init__(self, chat_object):
+        self.chat = chat_object
+
+    def count(self) -> int:
+        return len(self.chat.messages)
+
+    def sizes(self, start: int = 0) -> list:
+        # [(is_user, characters, newlines)] from message start on
+        messages = self.chat.messages  # MessageList, read its columns without building message dicts
+        return [(role == 'user', len(content), content.count("\n"))
+                for role, content in zip(messages.roles[start:], messages.contents[start:])]
+
+    def page(self, start: int, count: int) -> list:
+        entries = []
+        for i in range(start, min(start + count, len(self.chat.messages))):
+            message = self.chat.messages[i]
+            turn = i // 2
+            entries.append({"role": message['role'], "content": message['content'],
+                            "model": self.chat.addressed_models[turn] if turn < len(self.chat.addressed_models) else "",
+                            "reply_time": self.chat.reply_times[turn] if turn < len(self.chat.reply_times) else None})
+        return entries
+
+
+class ChatMemorySource:
+    """Messages of a stored chat, read from ChatMemory a page at a time."""
+
+    def __init__(self, chat_memory, chat_id: str):
+        self.chat_memory = chat_memory
+        self.chat_id = chat_id
+
+    def count(self) -> int:
+        return self.chat_memory.get_message_count(self.chat_id)
+
+    def sizes(self, start: int = 0) -> list:
+        return self.chat_memory.get_message_sizes(self.chat_id, start)
+
+    def page(self, start: int, count: int) -> list:
+        return self.chat_memory.get_message_page(self.chat_id, start, count)
+
+
+class VirtualChatView(tk.Frame):
+    def __init__(self, master, scrollbar_color='#1e1e1e', **text_options):
+        super().__init__(master)
+        self.grid_columnconfigure(0, weight=1)
+        self.grid_rowconfigure(0, weight=1)
+        self.text = tk.Text(self, wrap=tk.WORD, **text_options)
+        self.text.grid(row=0, column=0, sticky="nsew")
+        self.scrollbar = tk.Scrollbar(self, command=self.yview, bg=scrollbar_color, troughcolor=scrollbar_color)
+        self.scrollbar.grid(row=0, column=1, sticky="ns")
+        self.text.config(state=tk.DISABLED)
+
+        self.source = None
+        self.title = None
+        self.placeholder = ""
+        self.index = HeightIndex()  # Item 0 is the chat title, item i + 1 is message i
+        # Per message sizes, kept to estimate heights again when the width or font changes
+        self.user_flags = bytearray()
+        self.char_counts = array('l')
+        self.newline_counts = array('l')
+        self.pages = OrderedDict()  # page number -> entries, least recently used first
+        self.top = 0  # First visible line
+        self.follow_end = True  # Keep the last message in view as messages are added
+        self.stream_header = None
+        self.stream_text = ""
+        self.chars_per_line = 80
+        self.metrics_font = None
+        self.metrics = (1, 1)
+        self.render_pending = False
+        self.window = (0, 0)
+
+        for sequence in ("<MouseWheel>", "<Button-4>", "<Button-5>"):
+            self.text.bind(sequence, self.on_mouse_wheel)
+        self.text.bind("<Configure>", self.on_resize)
+
+    # ---- Text passthrough, so the widget can be styled like the ScrolledText it replaces ----
+    def config(self, cnf=None, **options):
+        options.update(cnf or {})
+        self.text.config(**options)
+        if "font" in options:
+            self.relayout()
+
+    configure = config
+
+    def tag_configure(self, tag, **options):
+        self.text.tag_configure(tag, **options)
+        if "font" in options:
+            self.relayout()
+
+    def see(self, index):
+        if index == tk.END:
+            self.scroll_to_end()
+
+    # ---- content ----
+    def show_placeholder(self, text: str):
+        self.source, self.title, self.placeholder = None, None, text
+        self.index.rebuild([])
+        self.store_sizes([], reset=True)
+        self.pages = OrderedDict()
+        self.stream_header, self.stream_text = None, ""
+        self.top = 0
+        self.render()
+
+    def set_source(self, source, title: str):
+        self.source, self.title, self.placeholder = source, title, ""
+        self.pages = OrderedDict()
+        self.stream_header, self.stream_text = None, ""
+        self.store_sizes(source.sizes(0), reset=True)
+        self.update_chars_per_line()
+        self.rebuild_index()
+        self.scroll_to_end()
+
+    def replace_source(self, source):
+        # Another source of the same chat (e.g. its loaded history in place of storage): the layout is kept,
+        # only the messages it has beyond the old one are added
+        self.source = source
+        self.refresh()
+
+    def store_sizes(self, sizes, reset=False):
+        if reset:
+            self.user_flags, self.char_counts, self.newline_counts = bytearray(), array('l'), array('l')
+        for is_user, characters, newlines in sizes:
+            self.user_flags.append(is_user)
+            self.char_counts.append(characters)
+            self.newline_counts.append(newlines)
+
+    def message_count(self) -> int:
+        return len(self.char_counts)
+
+    def rebuild_index(self):
+        self.index.rebuild([2] + [self.estimate(self.user_flags[i], self.char_counts[i], self.newline_counts[i])
+                                  for i in range(self.message_count())])
+
+    def refresh(self):
+        # Picks up messages added to the source since the last call
+        if self.source is None:
+            return
+        count = self.source.count()
+        known = self.message_count()
+        if count < known:
+            self.set_source(self.source, self.title)
+            return
+        for page in range(max(known - 1, 0) // PAGE_SIZE, max(count - 1, 0) // PAGE_SIZE + 1):
+            self.pages.pop(page, None)  # Cached pages at the end are incomplete now
+        new_sizes = self.source.sizes(known)
+        self.store_sizes(new_sizes)
+        for is_user, characters, newlines in new_sizes:
+            self.index.append(self.estimate(is_user, characters, newlines))
+        self.stream_header, self.stream_text = None, ""
+        if self.follow_end:
+            self.scroll_to_end()
+        else:
+            self.render()
+
+    def append_stream(self, header: str, piece: str):
+        # Reply text arriving while it is generated, shown after the last message until refresh()
+        if self.source is None:
+            return
+        self.stream_header = header
+        self.stream_text += piece
+        if "stream_start" in self.text.mark_names():  # The reply is materialized, just extend it
+            self.text.config(state=tk.NORMAL)
+            self.text.insert(tk.END, piece)
+            self.text.config(state=tk.DISABLED)
+            if self.follow_end:
+                self.text.see(tk.END)
+        elif self.window[1] == len(self.index):
+            self.schedule_render()
+
+    def scroll_to_message(self, message_index: int):
+        if 0 <= message_index < self.message_count():
+            self.top = self.index.prefix(message_index + 1)
+            self.follow_end = False
+            self.render()
+
+    def message_at(self, x: int, y: int):
+        # Index of the message shown at a pixel position, None over the title or a reply being streamed
+        if self.source is None:
+            return None
+        position = self.text.index(f"@{x},{y}")
+        if "stream_start" in self.text.mark_names() and self.text.compare(position, ">=", "stream_start"):
+            return None
+        start, end = self.window
+        for item in range(end - 1, start - 1, -1):
+            if self.text.compare(f"item_{item}", "<=", position):
+                return item - 1 if item > 0 else None
+        return None
+
+    def scroll_to_end(self):
+        self.follow_end = True
+        self.top = max(0, self.index.total() + self.stream_lines() - self.visible_lines())
+        self.render()
+
+    # ---- layout ----
+    def font_metrics(self):
+        # (line height, average character width) in pixels, measured once per font
+        font = str(self.text.cget("font"))
+        if self.metrics_font != font:
+            measured = tkfont.Font(font=self.text.cget("font"))
+            self.metrics = (max(1, measured.metrics("linespace")), max(1, measured.measure("0")))
+            self.metrics_font = font
+        return self.metrics
+
+    def visible_lines(self) -> int:
+        line_space = self.font_metrics()[0]
+        height = self.text.winfo_height()
+        if height <= 1:  # Not laid out yet
+            height = int(self.text.cget("height")) * line_space
+        return max(1, height // line_space)
+
+    def update_chars_per_line(self):
+        char_width = self.font_metrics()[1]
+        width = self.text.winfo_width()
+        if width <= 1:
+            width = int(self.text.cget("width")) * char_width
+        self.chars_per_line = max(10, width // char_width)
+
+    def estimate(self, is_user, characters: int, newlines: int) -> int:
+        lines = 1 + newlines + characters // self.chars_per_line  # Header line, then the wrapped content
+        return lines + 1 + (0 if is_user else 2)  # Blank line, response time and another blank line
+
+    def stream_lines(self) -> int:
+        if self.stream_header is None:
+            return 0
+        return self.estimate(False, len(self.stream_text), self.stream_text.count("\n"))
+
+    def relayout(self):
+        # Font or width changed: every estimate and measurement is off, start again from the sizes
+        if self.source is None:
+            return
+        first = self.index.find(self.top)
+        self.update_chars_per_line()
+        self.rebuild_index()
+        if self.follow_end:
+            self.scroll_to_end()
+        else:
+            self.top = self.index.prefix(first)
+            self.render()
+
+    def on_resize(self, event):
+        old = self.chars_per_line
+        self.update_chars_per_line()
+        if self.chars_per_line != old:
+            self.chars_per_line = old
+            self.after_idle(self.relayout)
+        else:
+            self.schedule_render()
+
+    # ---- scrolling ----
+    def yview(self, *args):
+        # Scrollbar command
+        total = max(1, self.index.total() + self.stream_lines())
+        visible = self.visible_lines()
+        if args[0] == "moveto":
+            self.top = int(float(args[1]) * total)
+        elif args[0] == "scroll":
+            amount = int(args[1]) * (visible if args[2] == "pages" else 1)
+            self.top += amount
+        self.follow_end = self.top + visible >= total
+        self.schedule_render()
+
+    def on_mouse_wheel(self, event):
+        if event.num == 4:
+            lines = -3
+        elif event.num == 5:
+            lines = 3
+        else:
+            lines = -3 * (1 if event.delta > 0 else -1)
+        self.yview("scroll", lines, "units")
+        return "break"  # The Text must not scroll its own (partial) content
+
+    def schedule_render(self):
+        # Coalesces bursts of scroll events into one render per idle cycle
+        if not self.render_pending:
+            self.render_pending = True
+            self.after_idle(self.render)
+
+    # ---- rendering ----
+    def entry(self, message_index: int) -> dict:
+        page_number = message_index // PAGE_SIZE
+        page = self.pages.get(page_number)
+        if page is None:
+            page = self.source.page(page_number * PAGE_SIZE, PAGE_SIZE)
+            self.pages[page_number] = page
+            while len(self.pages) > CACHED_PAGES:
+                self.pages.popitem(last=False)
+        else:
+            self.pages.move_to_end(page_number)
+        return page[message_index - page_number * PAGE_SIZE]
+
+    def insert_item(self, item: int):
+        self.text.mark_set(f"item_{item}", "end-1c")
+        self.text.mark_gravity(f"item_{item}", tk.LEFT)
+        if item == 0:
+            self.text.insert(tk.END, f"Current Chat: {self.title} \n\n", "bold")
+            return
+        message = self.entry(item - 1)
+        if message['role'] != 'user':
+            self.text.insert(tk.END, f"{message['model']}:\n ", "bold")
+            self.text.insert(tk.END, f"{message['content']}\n\n")
+            if message['reply_time'] is not None:
+                self.text.insert(tk.END, f"Response time: {message['reply_time']:.2f} seconds\n\n")
+        else:
+            self.text.insert(tk.END, "User:\n ", "bold")
+            self.text.insert(tk.END, f"{message['content']}\n\n")
+
+    def measure(self, start: int, end: int):
+        # Replaces estimates by the real wrapped heights of the materialized items
+        if self.text.winfo_width() <= 1:
+            return  # Not laid out yet, display lines would be meaningless
+        last_stop = "stream_start" if "stream_start" in self.text.mark_names() else "end-1c"
+        for item in range(start, end):
+            stop = f"item_{item + 1}" if item + 1 < end else last_stop
+            lines = self.text.count(f"item_{item}", stop, "displaylines")
+            lines = lines[0] if isinstance(lines, tuple) else lines
+            if lines:
+                self.index.set(item, lines)
+
+    def render(self):
+        self.render_pending = False
+        self.text.config(state=tk.NORMAL)
+        self.text.delete("1.0", tk.END)
+        for mark in self.text.mark_names():
+            if mark.startswith("item_") or mark == "stream_start":
+                self.text.mark_unset(mark)
+        if self.source is None:
+            self.text.insert(tk.END, self.placeholder)
+            self.text.config(state=tk.DISABLED)
+            self.scrollbar.set(0.0, 1.0)
+            self.window = (0, 0)
+            return
+
+        visible = self.visible_lines()
+        count = len(self.index)
+        total = self.index.total() + self.stream_lines()
+        self.top = max(0, min(self.top, total - visible))
+        first = self.index.find(self.top)
+        offset = self.top - self.index.prefix(first)
+        start = max(0, first - WINDOW_MARGIN)
+        end = first
+        while end < count and end - start < MAX_WINDOW and self.index.prefix(end) < self.top + visible:
+            end += 1
+        end = min(count, end + WINDOW_MARGIN, start + MAX_WINDOW)
+        for item in range(start, end):
+            self.insert_item(item)
+        if end == count and self.stream_header is not None:
+            self.text.mark_set("stream_start", "end-1c")
+            self.text.mark_gravity("stream_start", tk.LEFT)
+            self.text.insert(tk.END, f"{self.stream_header}:\n ", "bold")
+            self.text.insert(tk.END, self.stream_text)
+        self.window = (start, end)
+
+        self.measure(start, end)
+        total = self.index.total() + self.stream_lines()
+        if self.follow_end:
+            self.top = max(0, total - visible)
+            self.text.see(tk.END)
+        else:
+            offset = min(offset, self.index.heights[first] - 1)
+            self.top = self.index.prefix(first) + offset
+            self.text.yview(f"item_{first}")
+            if offset > 0:
+                self.text.yview_scroll(offset, "units")
+        self.text.config(state=tk.DISABLED)
+        self.scrollbar.set(self.top / max(1, total), min(1.0, (self.top + visible) / max(1, total)))
@@ -0,0 +1,188 @@
+"""
+Runs the code blocks of assistant replies in separate interpreters, with memory / CPU / output file limits and
+a wall clock timeout.
+
+Starting an interpreter takes tens of milliseconds, so a pool of interpreters is started ahead of time: each
+one has already applied its limits and waits for a snippet on stdin, and a replacement is started in the
+background as soon as one is taken (by a single refill thread, which counts the interpreters it is starting).
+Every interpreter runs a single snippet in its own temporary directory, in isolated mode (no user site-packages,
+no PYTHON* variables) with a minimal environment, in its own session so a timeout also kills the processes it
+started.
+
+This keeps runs apart from each other and from the app, it is not a security boundary: snippets can still read
+files and use the network with the user's permissions.
+"""
+import json
+import os
+import re
+import secrets
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+WORKER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "code_worker.py")
+PYTHON_LANGUAGES = {"python", "python3", "py"}
+CODE_BLOCK = re.compile(r"^```[ \t]*([\w+#.-]*)[^\n]*\n(.*?)^```", re.MULTILINE | re.DOTALL)
+
+
+def extract_code_blocks(text: str) -> list:
+    # [(language, code)] of the fenced blocks in a reply, language is lowercase ("" if not given)
+    return [(language.lower(), code) for language, code in CODE_BLOCK.findall(text)]
+
+
+def runnable_blocks(text: str) -> list:
+    return [code for language, code in extract_code_blocks(text) if language in PYTHON_LANGUAGES]
+
+
+class CodeRunner:
+    def __init__(self, pool_size: int = 2, timeout: float = 10.0, memory_mb: int = 512, cpu_seconds: int = 10,
+                 file_mb: int = 16, max_output: int = 20000):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.limits = {"memory_mb": memory_mb, "cpu_seconds": cpu_seconds, "file_mb": file_mb}
+        self.max_output = max_output
+        self.env = {name: os.environ[name] for name in ("PATH", "SYSTEMROOT", "LANG") if name in os.environ}
+        self.env["PYTHONIOENCODING"] = "utf-8"
+        self.idle = []  # Warm interpreters: (process, directory)
+        self.spawning = 0  # Interpreters being started for the pool
+        self.refilling = False  # A refill thread is running
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def start(self):
+        # Fills the pool in the background, unless a refill is already running (it will see the taken worker)
+        with self.lock:
+            if self.refilling or self.closed:
+                return
+            self.refilling = True
+        threading.Thread(target=self.refill, daemon=True).start()
+
+    def spawn(self):
+        directory = tempfile.mkdtemp(prefix="llama-code-")
+        process = subprocess.Popen([sys.executable, "-I", WORKER_PATH, json.dumps(self.limits)],
+                                   stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                   cwd=directory, env=self.env, start_new_session=os.name == "posix")
+        return process, directory
+
+    def refill(self):
+        while True:
+            with self.lock:
+                # Drop interpreters that died while waiting
+                for process, directory in [worker for worker in self.idle if worker[0].poll() is not None]:
+                    self.idle.remove((process, directory))
+                    shutil.rmtree(directory, ignore_errors=True)
+                if self.closed or len(self.idle) + self.spawning >= self.pool_size:
+                    self.refilling = False
+                    return
+                self.spawning += 1
+            try:
+                worker = self.spawn()
+            except OSError as e:
+                print(f"Could not start a code interpreter: {e}")
+                with self.lock:
+                    self.spawning -= 1
+                    self.refilling = False
+                return
+            with self.lock:
+                self.spawning -= 1
+                if not self.closed:
+                    self.idle.append(worker)
+                    continue
+                self.refilling = False
+            self.discard(*worker)
+            return
+
+    def take(self):
+        # A warm interpreter if one is ready, otherwise a new one. Returns (process, directory, warm)
+        with self.lock:
+            while self.idle:
+                process, directory = self.idle.pop()
+                if process.poll() is None:
+                    return process, directory, True
+                shutil.rmtree(directory, ignore_errors=True)
+        return (*self.spawn(), False)
+
+    def kill(self, process):
+        try:
+            if os.name == "posix":
+                os.killpg(process.pid, signal.SIGKILL)
+            else:
+                process.kill()
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    def discard(self, process, directory):
+        self.kill(process)
+        process.wait()
+        for stream in (process.stdin, process.stdout):
+            stream.close()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    def run(self, code: str) -> dict:
+        """
+        Runs one snippet. Returns {"output", "truncated", "error", "exit_code", "timed_out", "warm",
+        "duration" (seconds the snippet ran, measured inside the interpreter), "wall_time" (seconds until
+        the result was back), "start_latency" (seconds to get an interpreter: taken from the pool when warm,
+        otherwise just launched and its startup is part of wall_time)}.
+        """
+        start = time.perf_counter()
+        process, directory, warm = self.take()
+        ready = time.perf_counter()
+        if self.pool_size > 0:
+            self.start()
+        # The result line starts with a per-run nonce, so output the snippet manages to send to the pipe
+        # (e.g. from a forked child) can't pass for the result
+        nonce = secrets.token_hex(16)
+        job = json.dumps({"code": code, "max_output": self.max_output, "nonce": nonce}) + "\n"
+        timed_out = False
+        try:
+            stdout, _ = process.communicate(job.encode("utf-8"), timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            timed_out = True
+            self.kill(process)
+            stdout, _ = process.communicate()
+        wall_time = time.perf_counter() - start
+        shutil.rmtree(directory, ignore_errors=True)
+
+        result = {"output": "", "truncated": False, "error": None, "exit_code": None, "duration": None}
+        prefix = nonce + " "
+        lines = [line for line in stdout.decode("utf-8", "replace").splitlines() if line.startswith(prefix)]
+        try:
+            result.update(json.loads(lines[0][len(prefix):]))
+        except (IndexError, ValueError):
+            # No result: killed by the timeout or a limit, the output file went with the directory
+            if timed_out:
+                result["error"] = f"Timed out after {self.timeout:g} s"
+            elif os.name == "posix" and process.returncode in (-signal.SIGXCPU, -signal.SIGKILL):
+                result["error"] = f"Killed by the CPU or memory limit (signal {-process.returncode})"
+            else:
+                result["error"] = f"Interpreter exited with code {process.returncode}"
+            result["exit_code"] = process.returncode
+        result.update(timed_out=timed_out, warm=warm, wall_time=wall_time, start_latency=ready - start)
+        return result
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            idle, self.idle = self.idle, []
+        for worker in idle:
+            self.discard(*worker)
+
+
+def format_results(results: list) -> str:
+    # Chat message with the results of running the blocks of a reply, in order
+    parts = ["Output of running the code in your previous reply:"]
+    for number, result in enumerate(results, start=1):
+        status = "timed out" if result["timed_out"] else f"exit code {result['exit_code']}"
+        took = result["duration"] if result["duration"] is not None else result["wall_time"]
+        text = result["output"]
+        if result["truncated"]:
+            text += "\n[output truncated]"
+        if result["error"]:
+            text += ("\n" if text and not text.endswith("\n") else "") + result["error"]
+        parts.append(f"Block {number} ({status}, {took * 1000:.0f} ms):\n```\n{text.rstrip() or '(no output)'}\n```")
+    return "\n\n".join(parts)
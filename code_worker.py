@@ -0,0 +1,86 @@
+"""
+Runs one code snippet for code_runner.py.
+
+Started ahead of time with its limits as argument, it applies them, then waits on stdin for a single job
+{"code", "max_output", "nonce"}. The snippet's stdout / stderr (including output of its subprocesses) go to a
+file in the working directory; the result is written as one JSON line, prefixed with the job's nonce, to the
+original stdout (kept on a close-on-exec descriptor). One job per process, so no state leaks from one run to
+the next.
+"""
+import json
+import os
+import signal
+import sys
+import time
+import traceback
+
+
+def cpu_limit_exceeded(signum, frame):
+    raise TimeoutError("CPU time limit exceeded")
+
+
+def apply_limits(memory_mb: int, cpu_seconds: int, file_mb: int):
+    try:
+        import resource
+    except ImportError:  # Windows: only the wall clock timeout of the parent applies
+        return
+    # The CPU soft limit raises in the snippet (SIGXCPU), the hard limit one second later kills the process
+    for limit, soft, hard in ((resource.RLIMIT_AS, memory_mb * 1024 * 1024, memory_mb * 1024 * 1024),
+                              (resource.RLIMIT_CPU, cpu_seconds, cpu_seconds + 1),
+                              (resource.RLIMIT_FSIZE, file_mb * 1024 * 1024, file_mb * 1024 * 1024)):
+        if soft > 0:
+            try:
+                resource.setrlimit(limit, (soft, hard))
+            except (ValueError, OSError):
+                pass  # Not allowed to lower this limit here, the others still apply
+    signal.signal(signal.SIGXCPU, cpu_limit_exceeded)
+    signal.signal(signal.SIGXFSZ, signal.SIG_IGN)  # Writing past the file limit raises instead of killing
+
+
+def main():
+    limits = json.loads(sys.argv[1])
+    apply_limits(limits["memory_mb"], limits["cpu_seconds"], limits["file_mb"])
+    results_fd = os.dup(1)
+    os.set_inheritable(results_fd, False)  # Programs the snippet starts don't get the result pipe
+    results = os.fdopen(results_fd, "w", encoding="utf-8")
+    job = json.loads(sys.stdin.readline())
+    nonce = job.pop("nonce")
+
+    # From here on fd 0 is empty and fds 1 / 2 go to the output file
+    output_fd = os.open("output.txt", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    null_fd = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(null_fd, 0)
+    os.dup2(output_fd, 1)
+    os.dup2(output_fd, 2)
+    sys.stdout.reconfigure(line_buffering=True)  # Keeps prints and tracebacks in order in the file
+
+    error, exit_code = None, 0
+    namespace = {"__name__": "__main__", "__builtins__": __builtins__}
+    start = time.perf_counter()
+    try:
+        exec(compile(job["code"], "<code block>", "exec"), namespace)
+    except SystemExit as e:
+        exit_code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except BaseException as e:
+        # Leave this file's frame out of the traceback
+        error = "".join(traceback.format_exception(type(e), e, e.__traceback__.tb_next))
+        exit_code = 1
+    duration = time.perf_counter() - start
+    for stream in (sys.stdout, sys.stderr):
+        try:
+            stream.flush()
+        except (OSError, ValueError):
+            pass
+
+    max_output = job["max_output"]
+    with open("output.txt", "rb") as f:
+        output = f.read(max_output + 1)
+    truncated = len(output) > max_output
+    results.write(nonce + " " + json.dumps({"output": output[:max_output].decode("utf-8", "replace"), "truncated": truncated,
+                              "error": error, "exit_code": exit_code, "duration": duration}) + "\n")
+    results.flush()
+    os._exit(0)  # Skip interpreter teardown and whatever atexit handlers the snippet registered
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,373 @@
+"""
+Per chat document collections for retrieval augmented prompting.
+
+Attached text files are chunked, embedded and indexed once by a background worker; files are
+re-indexed only when their size / modification time (and then content hash) change. At prompt
+time only the top-k chunks closest to the new message are sent to the model.
+
+The vector file header records the embedding model and dimension. Vectors of another model can't be compared
+with the query, so when either differs the store is emptied and every document is indexed again.
+
+Re-indexing or detaching a document only drops its chunks from the table; the vector rows they leave behind are
+counted and the file is compacted like the semantic index's once they outnumber the live rows.
+"""
+import hashlib
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from semantic_index import COMPACT, COMPACT_MIN_ROWS, DEFAULT_EMBED_MODEL, VectorStore, normalize
+
+CHUNK_CHARS = 1000
+CHUNK_OVERLAP = 200
+EMBED_BATCH = 32
+
+
+def chunk_text(text: str, size: int = CHUNK_CHARS, overlap: int = CHUNK_OVERLAP) -> list:
+    # Fixed size windows, moved back to the last paragraph / line / word break when there is one nearby
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(len(text), start + size)
+        if end < len(text):
+            for separator in ("\n\n", "\n", " "):
+                cut = text.rfind(separator, start + size // 2, end)
+                if cut != -1:
+                    end = cut + len(separator)
+                    break
+        chunk = text[start:end].strip()
+        if chunk:
+            chunks.append(chunk)
+        if end >= len(text):
+            break
+        start = max(end - overlap, start + 1)
+    return chunks
+
+
+def file_signature(path: str):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime
+
+
+def file_hash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class DocumentIndex:
+    def __init__(self, embed_fn, db_path='chats.db', vectors_path='document_vectors.f16',
+                 model: str = DEFAULT_EMBED_MODEL, on_progress=None):
+        self.embed_fn = embed_fn  # embed_fn(texts, model) -> list of vectors
+        self.db_path = db_path
+        self.model = model
+        self.on_progress = on_progress  # on_progress(chat_id, done_chunks, total_chunks), from the worker thread
+        self.store = VectorStore(vectors_path)
+        self.lock = threading.Lock()
+        self.jobs = queue.Queue()
+        self._queued_paths = set()  # (chat id, path) waiting for or being indexed
+        self._thread = None
+        self._rebuilds = 0  # Bumped by _rebuild, a compaction started before one is discarded
+        self._initialize_database()
+        if self.store.model is not None and self.store.model != model:
+            with self.lock:
+                self._rebuild(f"embedding model changed from {self.store.model} to {model}")
+        self.dead_rows = self.store.count() - self._live_rows()  # Vector rows no chunk refers to
+
+    def _initialize_database(self):
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS chat_documents (
+                chat_id TEXT NOT NULL,
+                path TEXT NOT NULL,
+                size INTEGER,
+                mtime REAL,
+                sha256 TEXT,
+                PRIMARY KEY (chat_id, path)
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS document_chunks (
+                row_id INTEGER PRIMARY KEY,  -- Row in the vector file
+                chat_id TEXT NOT NULL,
+                path TEXT NOT NULL,
+                chunk_index INTEGER NOT NULL,
+                text TEXT NOT NULL
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS document_chunks_chat ON document_chunks (chat_id)')
+        conn.commit()
+        conn.close()
+
+    # ---- collection management ----
+    def list_documents(self, chat_id: str) -> list:
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('SELECT path FROM chat_documents WHERE chat_id = ? ORDER BY path', (chat_id,))
+        paths = [row[0] for row in cursor.fetchall()]
+        conn.close()
+        return paths
+
+    def has_documents(self, chat_id: str) -> bool:
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('SELECT 1 FROM chat_documents WHERE chat_id = ? LIMIT 1', (chat_id,))
+        found = cursor.fetchone() is not None
+        conn.close()
+        return found
+
+    def attach(self, chat_id: str, paths: list):
+        conn = sqlite3.connect(self.db_path)
+        conn.executemany('INSERT OR IGNORE INTO chat_documents (chat_id, path) VALUES (?, ?)',
+                         [(chat_id, os.path.abspath(path)) for path in paths])
+        conn.commit()
+        conn.close()
+        self.sync(chat_id)
+
+    def detach(self, chat_id: str, path: str = None):
+        # Detaches one document, or the whole collection when path is None
+        with self.lock:
+            conn = sqlite3.connect(self.db_path)
+            if path is None:
+                conn.execute('DELETE FROM chat_documents WHERE chat_id = ?', (chat_id,))
+                removed = conn.execute('DELETE FROM document_chunks WHERE chat_id = ?', (chat_id,)).rowcount
+            else:
+                conn.execute('DELETE FROM chat_documents WHERE chat_id = ? AND path = ?', (chat_id, path))
+                removed = conn.execute('DELETE FROM document_chunks WHERE chat_id = ? AND path = ?',
+                                       (chat_id, path)).rowcount
+            conn.commit()
+            conn.close()
+            self.dead_rows += removed
+            compact = self._needs_compaction()
+        if compact:
+            self.jobs.put(COMPACT)
+            self.start()
+
+    def _rebuild(self, reason: str):
+        # Caller holds the lock: drops all vectors and marks every document as changed, so that it is indexed
+        # again (retrieval syncs the chat's documents before every prompt)
+        print(f"Rebuilding the document index: {reason}")
+        self.store.clear()
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('DELETE FROM document_chunks')
+        conn.execute('UPDATE chat_documents SET size = NULL, mtime = NULL, sha256 = NULL')
+        conn.commit()
+        conn.close()
+        self.dead_rows = 0
+        self._rebuilds += 1
+
+    def _live_rows(self) -> int:
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('SELECT COUNT(*) FROM document_chunks')
+        count = cursor.fetchone()[0]
+        conn.close()
+        return count
+
+    def _needs_compaction(self) -> bool:
+        return self.dead_rows > COMPACT_MIN_ROWS and self.dead_rows > self.store.count() - self.dead_rows
+
+    def compact(self):
+        """
+        Rewrites the vector file with only the rows chunks refer to and renumbers the chunks, as
+        SemanticIndex.compact does. Runs on the worker thread, the only one appending rows; the copy is made
+        without the lock, chunks detached meanwhile stay deleted through the renumbering.
+        """
+        with self.lock:
+            if not self.dead_rows:
+                return
+            dropped, rebuilds = self.dead_rows, self._rebuilds
+        start = time.perf_counter()
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('SELECT row_id FROM document_chunks ORDER BY row_id')
+        rows = [row[0] for row in cursor.fetchall()]
+        self.store.write_rows(np.array(rows, dtype=np.int64))
+        cursor.execute('CREATE TEMP TABLE compact_rows (old_row INTEGER PRIMARY KEY, new_row INTEGER NOT NULL)')
+        cursor.executemany('INSERT INTO compact_rows (old_row, new_row) VALUES (?, ?)',
+                           [(old_row, new_row) for new_row, old_row in enumerate(rows)])
+        conn.commit()
+        with self.lock:
+            if rebuilds != self._rebuilds:  # Emptied meanwhile, the copy is of rows that are gone
+                self.store.discard_rows()
+                conn.close()
+                return
+            # Through negative numbers, so that no new number collides with an old one still in the table
+            cursor.execute('''
+                UPDATE document_chunks
+                SET row_id = -1 - (SELECT new_row FROM compact_rows WHERE old_row = document_chunks.row_id)
+            ''')
+            cursor.execute('UPDATE document_chunks SET row_id = -1 - row_id')
+            conn.commit()
+            self.store.replace_with_rows()
+            self.dead_rows -= dropped
+        conn.close()
+        print(f"Document index compacted: dropped {dropped} unreferenced rows, kept {len(rows)} "
+              f"in {time.perf_counter() - start:.2f}s")
+
+    def on_chat_changed(self, chat_id: str, chat_object=None):
+        # ChatMemory listener, drops the collection of deleted chats
+        if chat_object is None:
+            self.detach(chat_id)
+
+    def stale_documents(self, chat_id: str) -> list:
+        # Cheap check (one stat per file) for documents that changed since they were indexed
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('SELECT path, size, mtime FROM chat_documents WHERE chat_id = ?', (chat_id,))
+        rows = cursor.fetchall()
+        conn.close()
+        stale = []
+        for path, size, mtime in rows:
+            try:
+                if file_signature(path) != (size, mtime):
+                    stale.append(path)
+            except OSError:
+                continue  # Missing file, keep serving the chunks we have
+        return stale
+
+    def sync(self, chat_id: str):
+        # Queues re-indexing of changed documents, returns how many were queued
+        with self.lock:
+            stale = [path for path in self.stale_documents(chat_id) if (chat_id, path) not in self._queued_paths]
+            self._queued_paths.update((chat_id, path) for path in stale)
+        if stale:
+            self.jobs.put((chat_id, stale))
+            self.start()
+        return len(stale)
+
+    # ---- indexing ----
+    def _index_documents(self, chat_id: str, paths: list):
+        pending = []  # (path, signature, sha256, chunks)
+        for path in paths:
+            try:
+                signature = file_signature(path)
+                digest = file_hash(path)
+            except OSError as e:
+                print(f"Skipping document {path}: {e}")
+                continue
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            cursor.execute('SELECT sha256 FROM chat_documents WHERE chat_id = ? AND path = ?', (chat_id, path))
+            row = cursor.fetchone()
+            if row is not None and row[0] == digest:
+                # Touched but unchanged, only remember the new signature
+                cursor.execute('UPDATE chat_documents SET size = ?, mtime = ? WHERE chat_id = ? AND path = ?',
+                               (signature[0], signature[1], chat_id, path))
+                conn.commit()
+                conn.close()
+                continue
+            conn.close()
+            with open(path, 'r', encoding='utf-8', errors='replace') as f:
+                pending.append((path, signature, digest, chunk_text(f.read())))
+
+        total = sum(len(chunks) for _, _, _, chunks in pending)
+        done = 0
+        if self.on_progress:
+            self.on_progress(chat_id, done, total)
+        for path, signature, digest, chunks in pending:
+            rows = []
+            for start in range(0, len(chunks), EMBED_BATCH):
+                batch = chunks[start:start + EMBED_BATCH]
+                vectors = normalize(self.embed_fn(batch, self.model))
+                rows.append((vectors, batch))
+                done += len(batch)
+                if self.on_progress:
+                    self.on_progress(chat_id, done, total)
+            # Swap the document's chunks in one go so retrieval never sees a half indexed file
+            with self.lock:
+                if rows and self.store.dim is not None and rows[0][0].shape[1] != self.store.dim:
+                    self._rebuild(f"{self.model} returns {rows[0][0].shape[1]} dimensions, "
+                                  f"the store holds {self.store.dim}")
+                conn = sqlite3.connect(self.db_path)
+                self.dead_rows += conn.execute('DELETE FROM document_chunks WHERE chat_id = ? AND path = ?',
+                                               (chat_id, path)).rowcount
+                chunk_index = 0
+                for vectors, batch in rows:
+                    first_row = self.store.append(vectors, self.model)
+                    conn.executemany('INSERT INTO document_chunks (row_id, chat_id, path, chunk_index, text) '
+                                     'VALUES (?, ?, ?, ?, ?)',
+                                     [(first_row + i, chat_id, path, chunk_index + i, text)
+                                      for i, text in enumerate(batch)])
+                    chunk_index += len(batch)
+                conn.execute('UPDATE chat_documents SET size = ?, mtime = ?, sha256 = ? WHERE chat_id = ? AND path = ?',
+                             (signature[0], signature[1], digest, chat_id, path))
+                conn.commit()
+                conn.close()
+        if self._needs_compaction():
+            self.compact()
+
+    def _worker(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            if job == COMPACT:
+                try:
+                    self.compact()
+                except Exception as e:
+                    print(f"Document index compaction failed: {e}")
+                continue
+            try:
+                self._index_documents(*job)
+            except Exception as e:
+                print(f"Document indexing failed: {e}")
+            finally:
+                with self.lock:
+                    self._queued_paths.difference_update((job[0], path) for path in job[1])
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._worker, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self.jobs.put(None)
+            self._thread.join(timeout=1.0)
+            self._thread = None
+
+    # ---- retrieval ----
+    def retrieve(self, chat_id: str, query: str, k: int = 4) -> list:
+        # Returns [{"score", "path", "text"}] best first
+        if not self._chunks(chat_id):
+            return []
+        query_vector = normalize(np.asarray(self.embed_fn([query], self.model)[0]).reshape(1, -1))[0]
+        with self.lock:  # Chunks and vectors read together, a rebuild can't empty the store in between
+            if len(query_vector) == self.store.dim:
+                chunks = self._chunks(chat_id)
+                row_ids = np.array([row[0] for row in chunks], dtype=np.int64)
+                scores = np.asarray(self.store.matrix()[row_ids], dtype=np.float32) @ query_vector
+            else:
+                # Indexed with another model, no excerpts until the documents are indexed again
+                self._rebuild(f"{self.model} returns {len(query_vector)} dimensions, the store holds {self.store.dim}")
+                chunks = []
+        if not chunks:
+            self.sync(chat_id)
+            return []
+        best = np.argsort(-scores)[:k]
+        return [{"score": float(scores[i]), "path": chunks[i][1], "text": chunks[i][2]} for i in best]
+
+    def _chunks(self, chat_id: str) -> list:
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('SELECT row_id, path, text FROM document_chunks WHERE chat_id = ?', (chat_id,))
+        chunks = cursor.fetchall()
+        conn.close()
+        return chunks
+
+    def retriever(self, k: int = 4):
+        # Adapter for utils.get_response: retriever(chat, query) -> chunks, also re-syncs changed files
+        def retrieve(chat_object, query):
+            if not self.has_documents(chat_object.creation_time):
+                return []
+            self.sync(chat_object.creation_time)
+            return self.retrieve(chat_object.creation_time, query, k)
+        return retrieve
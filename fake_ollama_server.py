@@ -0,0 +1,480 @@
+"""
+Stand-in for `ollama serve` used for deterministic performance testing.
+
+Implements the subset of the Ollama REST API the app talks to
+(/api/chat, /api/generate, /api/tags, /api/embeddings, /api/embed, /api/ps, /api/version)
+with NDJSON streaming, simulated model load / prompt eval / per-token latency and failure injection.
+Only the standard library is used so it runs on CI boxes without ollama installed.
+
+Run standalone:
+    python fake_ollama_server.py --port 11435 --load-delay 0.5 --token-latency 0.02
+or point the app at it with OLLAMA_FAKE_SERVER=1 (see utils.start_ollama_server).
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_MODELS = ["llama3.1:latest", "llama3.2:3b", "gemma2:latest", "nomic-embed-text:latest"]
+VOCAB = ["the", "model", "answer", "is", "a", "simple", "local", "reply", "with", "some",
+         "tokens", "for", "testing", "latency", "and", "throughput", "of", "chat", "server", "ok"]
+TOKEN_PATTERN = re.compile(r"\S+")
+
+
+class FakeServerConfig:
+    def __init__(self,
+                 models: list = None,
+                 load_delay: float = 0.0,
+                 prompt_eval_latency: float = 0.0,
+                 token_latency: float = 0.0,
+                 reply_tokens: int = 32,
+                 embedding_dim: int = 64,
+                 failure_rate: float = 0.0,
+                 stream_failure_rate: float = 0.0,
+                 failure_status: int = 500,
+                 keep_alive: float = 300.0,
+                 max_concurrency: int = 0,
+                 prompt_cache: bool = False,
+                 seed: int = 0):
+        self.models = models if models is not None else list(DEFAULT_MODELS)
+        self.load_delay = load_delay  # Seconds to "load" a model that isn't resident
+        self.prompt_eval_latency = prompt_eval_latency  # Seconds per prompt token evaluated
+        self.token_latency = token_latency  # Seconds per generated token
+        self.reply_tokens = reply_tokens  # Default number of tokens generated per reply
+        self.embedding_dim = embedding_dim
+        self.failure_rate = failure_rate  # Probability of failing a request before any output
+        self.stream_failure_rate = stream_failure_rate  # Probability of cutting a stream midway
+        self.failure_status = failure_status
+        self.keep_alive = keep_alive  # Seconds a model stays loaded after its last use
+        self.max_concurrency = max_concurrency  # Generations processed at once (like OLLAMA_NUM_PARALLEL), 0 = unlimited
+        # Keep the tokens of the last /api/chat request per loaded model, a request only pays prompt eval for what
+        # comes after the prefix it shares with them (like a runner with one slot)
+        self.prompt_cache = prompt_cache
+        self.seed = seed
+
+
+def tokenize(text: str) -> list:
+    # Whitespace "tokenizer" with stable ids, good enough to count and to build context arrays
+    return [zlib.crc32(word.encode("utf-8")) % 32000 for word in TOKEN_PATTERN.findall(text or "")]
+
+
+def fake_embedding(text: str, dim: int) -> list:
+    # Deterministic unit vector derived from the text, so identical texts embed identically
+    values = []
+    counter = 0
+    while len(values) < dim:
+        digest = hashlib.sha256(f"{counter}:{text}".encode("utf-8")).digest()
+        values.extend((byte - 127.5) / 127.5 for byte in digest)
+        counter += 1
+    values = values[:dim]
+    norm = sum(v * v for v in values) ** 0.5 or 1.0
+    return [v / norm for v in values]
+
+
+def model_digest(name: str) -> str:
+    return hashlib.sha256(name.encode("utf-8")).hexdigest()
+
+
+def now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+class FakeOllamaState:
+    def __init__(self, config: FakeServerConfig):
+        self.config = config
+        self.random = random.Random(config.seed)
+        self.lock = threading.Lock()
+        self.loaded_models = {}  # model name -> expiry timestamp
+        self.slots = threading.Semaphore(config.max_concurrency) if config.max_concurrency > 0 else None
+        self.request_count = 0
+        self.prompt_caches = {}  # model name -> tokens of the last chat request and its reply
+
+    def should_fail(self, rate: float) -> bool:
+        if rate <= 0:
+            return False
+        with self.lock:
+            return self.random.random() < rate
+
+    def ensure_loaded(self, model: str, keep_alive=None) -> float:
+        # Returns the load duration in seconds (0 when the model is already resident)
+        keep_alive = self.config.keep_alive if keep_alive is None else parse_keep_alive(keep_alive)
+        with self.lock:
+            now = time.time()
+            expiry = self.loaded_models.get(model)
+            resident = expiry is not None and expiry > now
+        load_duration = 0.0
+        if not resident:
+            with self.lock:
+                self.prompt_caches.pop(model, None)
+        if not resident and self.config.load_delay > 0:
+            time.sleep(self.config.load_delay)
+            load_duration = self.config.load_delay
+        with self.lock:
+            if keep_alive == 0:
+                self.loaded_models.pop(model, None)
+            else:
+                self.loaded_models[model] = time.time() + (keep_alive if keep_alive > 0 else 10 ** 9)
+        return load_duration
+
+    def cached_prefix(self, model: str, tokens: list) -> int:
+        # Number of leading tokens already in the model's prompt cache
+        with self.lock:
+            cached = self.prompt_caches.get(model, [])
+        count = 0
+        for cached_token, token in zip(cached, tokens):
+            if cached_token != token:
+                break
+            count += 1
+        return count
+
+    def running_models(self) -> list:
+        with self.lock:
+            now = time.time()
+            return [name for name, expiry in self.loaded_models.items() if expiry > now]
+
+    def reply_words(self, seed_text: str, count: int) -> list:
+        rng = random.Random(f"{self.config.seed}:{seed_text}")
+        return [rng.choice(VOCAB) for _ in range(count)]
+
+
+def parse_keep_alive(value) -> float:
+    # Accepts numbers (seconds) and duration strings like "5m", "30s", "1h"
+    if isinstance(value, (int, float)):
+        return float(value)
+    match = re.fullmatch(r"\s*(-?\d+(?:\.\d+)?)\s*([smh]?)\s*", str(value))
+    if not match:
+        return 300.0
+    amount, unit = float(match.group(1)), match.group(2)
+    return amount * {"": 1, "s": 1, "m": 60, "h": 3600}[unit]
+
+
+class FakeOllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "FakeOllama/0.1"
+
+    @property
+    def state(self) -> FakeOllamaState:
+        return self.server.state
+
+    def log_message(self, format, *args):
+        pass  # Keep benchmark output clean
+
+    # ---- plumbing ----
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length", 0) or 0)
+        if length == 0:
+            return {}
+        return json.loads(self.rfile.read(length).decode("utf-8"))
+
+    def _send_json(self, payload, status=200):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, message, status):
+        self._send_json({"error": message}, status=status)
+
+    def _start_stream(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def _write_chunk(self, payload):
+        data = (json.dumps(payload) + "\n").encode("utf-8")
+        self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _end_stream(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    # ---- routing ----
+    def do_GET(self):
+        if self.path in ("/", "/api/version"):
+            if self.path == "/":
+                body = b"Ollama is running"
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            else:
+                self._send_json({"version": "0.0.0-fake"})
+        elif self.path == "/api/tags":
+            self._send_json({"models": [self._model_entry(name) for name in self.state.config.models]})
+        elif self.path == "/api/ps":
+            self._send_json({"models": [self._model_entry(name) for name in self.state.running_models()]})
+        else:
+            self._send_error("not found", 404)
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        try:
+            request = self._read_json()
+        except (ValueError, UnicodeDecodeError):
+            self._send_error("invalid JSON body", 400)
+            return
+        with self.state.lock:
+            self.state.request_count += 1
+
+        routes = {
+            "/api/chat": self._handle_chat,
+            "/api/generate": self._handle_generate,
+            "/api/embeddings": self._handle_embeddings,
+            "/api/embed": self._handle_embed,
+        }
+        handler = routes.get(self.path)
+        if handler is None:
+            self._send_error("not found", 404)
+            return
+        model = request.get("model", "")
+        if model not in self.state.config.models:
+            self._send_error(f"model '{model}' not found, try pulling it first", 404)
+            return
+        if self.state.should_fail(self.state.config.failure_rate):
+            self._send_error("injected failure", self.state.config.failure_status)
+            return
+        handler(request)
+
+    def _model_entry(self, name):
+        return {
+            "name": name,
+            "model": name,
+            "modified_at": "2024-09-26T21:09:19.4304411+03:00",
+            "size": 4661230766,
+            "digest": model_digest(name),
+            "details": {"parent_model": "", "format": "gguf", "family": name.split(":")[0],
+                        "families": [name.split(":")[0]], "parameter_size": "8.0B",
+                        "quantization_level": "Q4_0"},
+        }
+
+    # ---- generation ----
+    def _generate(self, request, prompt_tokens: int, seed_text: str, make_chunk, make_final, cache_tokens=None):
+        if self.state.slots is None:
+            self._run_generation(request, prompt_tokens, seed_text, make_chunk, make_final, cache_tokens)
+            return
+        with self.state.slots:
+            self._run_generation(request, prompt_tokens, seed_text, make_chunk, make_final, cache_tokens)
+
+    def _run_generation(self, request, prompt_tokens: int, seed_text: str, make_chunk, make_final,
+                        cache_tokens=None):
+        config = self.state.config
+        options = request.get("options") or {}
+        stream = request.get("stream", True)
+        start = time.perf_counter()
+        load_duration = self.state.ensure_loaded(request["model"], request.get("keep_alive"))
+        use_cache = config.prompt_cache and cache_tokens is not None
+        if use_cache:
+            prompt_tokens = len(cache_tokens) - self.state.cached_prefix(request["model"], cache_tokens)
+
+        prompt_start = time.perf_counter()
+        if config.prompt_eval_latency > 0 and prompt_tokens > 0:
+            time.sleep(config.prompt_eval_latency * prompt_tokens)
+        prompt_eval_duration = time.perf_counter() - prompt_start
+
+        num_predict = options.get("num_predict", config.reply_tokens)
+        if num_predict is None or num_predict < 0:
+            num_predict = config.reply_tokens
+        words = self.state.reply_words(seed_text, num_predict)
+        cut_at = None
+        if stream and words and self.state.should_fail(config.stream_failure_rate):
+            cut_at = len(words) // 2
+
+        if stream:
+            self._start_stream()
+        eval_start = time.perf_counter()
+        pieces = []
+        for index, word in enumerate(words):
+            if config.token_latency > 0:
+                time.sleep(config.token_latency)
+            piece = word if index == 0 else " " + word
+            pieces.append(piece)
+            if stream:
+                if index == cut_at:
+                    self._write_chunk({"error": "injected stream failure"})
+                    self._end_stream()
+                    return
+                self._write_chunk(make_chunk(piece))
+        eval_duration = time.perf_counter() - eval_start
+        if use_cache:
+            with self.state.lock:
+                self.state.prompt_caches[request["model"]] = cache_tokens + tokenize("".join(pieces))
+
+        final = make_final("".join(pieces), stream)
+        final.update({
+            "done": True,
+            "done_reason": "stop" if num_predict == config.reply_tokens else "length",
+            "total_duration": int((time.perf_counter() - start) * 1e9),
+            "load_duration": int(load_duration * 1e9),
+            "prompt_eval_count": prompt_tokens,
+            "prompt_eval_duration": int(prompt_eval_duration * 1e9),
+            "eval_count": len(words),
+            "eval_duration": int(eval_duration * 1e9),
+        })
+        if stream:
+            self._write_chunk(final)
+            self._end_stream()
+        else:
+            self._send_json(final)
+
+    def _handle_chat(self, request):
+        model = request["model"]
+        messages = request.get("messages") or []
+        tokens = [token for message in messages for token in tokenize(message.get("content", ""))]
+        last_user = next((m.get("content", "") for m in reversed(messages) if m.get("role") == "user"), "")
+
+        def make_chunk(piece):
+            return {"model": model, "created_at": now_iso(),
+                    "message": {"role": "assistant", "content": piece}, "done": False}
+
+        def make_final(content, stream):
+            return {"model": model, "created_at": now_iso(),
+                    "message": {"role": "assistant", "content": "" if stream else content}}
+
+        self._generate(request, len(tokens), last_user, make_chunk, make_final, tokens)
+
+    def _handle_generate(self, request):
+        model = request["model"]
+        prompt = request.get("prompt", "")
+        context = request.get("context") or []
+        # Tokens already present in the supplied context are treated as cached and cost nothing
+        new_tokens = tokenize(prompt)
+        if not context and request.get("system"):
+            new_tokens = tokenize(request["system"]) + new_tokens
+        if not prompt and not context and not request.get("system"):
+            # An empty generate request only loads the model
+            self.state.ensure_loaded(model, request.get("keep_alive"))
+            self._send_json({"model": model, "created_at": now_iso(), "response": "", "done": True,
+                             "done_reason": "load"})
+            return
+        seed_text = prompt
+
+        def make_chunk(piece):
+            return {"model": model, "created_at": now_iso(), "response": piece, "done": False}
+
+        def make_final(content, stream):
+            return {"model": model, "created_at": now_iso(), "response": "" if stream else content,
+                    "context": list(context) + new_tokens + tokenize(content)}
+
+        self._generate(request, len(new_tokens), seed_text, make_chunk, make_final)
+
+    def _handle_embeddings(self, request):
+        self.state.ensure_loaded(request["model"], request.get("keep_alive"))
+        prompt = request.get("prompt", "")
+        if self.state.config.prompt_eval_latency > 0:
+            time.sleep(self.state.config.prompt_eval_latency * len(tokenize(prompt)))
+        self._send_json({"embedding": fake_embedding(prompt, self.state.config.embedding_dim)})
+
+    def _handle_embed(self, request):
+        self.state.ensure_loaded(request["model"], request.get("keep_alive"))
+        inputs = request.get("input", "")
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        if self.state.config.prompt_eval_latency > 0:
+            time.sleep(self.state.config.prompt_eval_latency * sum(len(tokenize(text)) for text in inputs))
+        self._send_json({"model": request["model"],
+                         "embeddings": [fake_embedding(text, self.state.config.embedding_dim) for text in inputs]})
+
+
+class FakeOllamaServer:
+    """Runs the fake server on a background thread, for use inside benchmarks."""
+
+    def __init__(self, host="127.0.0.1", port=0, config: FakeServerConfig = None):
+        self.config = config if config is not None else FakeServerConfig()
+        self.httpd = ThreadingHTTPServer((host, port), FakeOllamaHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.state = FakeOllamaState(self.config)
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def state(self) -> FakeOllamaState:
+        return self.httpd.state
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="Fake Ollama server for deterministic performance testing")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--models", default=",".join(DEFAULT_MODELS), help="Comma separated model names")
+    parser.add_argument("--load-delay", type=float, default=0.0, help="Seconds to load a non resident model")
+    parser.add_argument("--prompt-eval-latency", type=float, default=0.0, help="Seconds per prompt token")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="Seconds per generated token")
+    parser.add_argument("--reply-tokens", type=int, default=32)
+    parser.add_argument("--embedding-dim", type=int, default=64)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--stream-failure-rate", type=float, default=0.0)
+    parser.add_argument("--failure-status", type=int, default=500)
+    parser.add_argument("--keep-alive", type=float, default=300.0)
+    parser.add_argument("--max-concurrency", type=int, default=0, help="Parallel generations, 0 for unlimited")
+    parser.add_argument("--prompt-cache", action="store_true", help="Reuse the prompt prefix of the last chat request")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser
+
+
+def config_from_args(args) -> FakeServerConfig:
+    return FakeServerConfig(models=[name.strip() for name in args.models.split(",") if name.strip()],
+                            load_delay=args.load_delay,
+                            prompt_eval_latency=args.prompt_eval_latency,
+                            token_latency=args.token_latency,
+                            reply_tokens=args.reply_tokens,
+                            embedding_dim=args.embedding_dim,
+                            failure_rate=args.failure_rate,
+                            stream_failure_rate=args.stream_failure_rate,
+                            failure_status=args.failure_status,
+                            keep_alive=args.keep_alive,
+                            max_concurrency=args.max_concurrency,
+                            prompt_cache=args.prompt_cache,
+                            seed=args.seed)
+
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    server = FakeOllamaServer(args.host, args.port, config_from_args(args))
+    print(f"Fake Ollama server listening on {server.url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
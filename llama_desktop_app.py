@@ -1,11 +1,48 @@
+from startup_timeline import TIMELINE, watch_imports
+watch_imports()  # Before the other imports, so that the heavy ones are timed
 import customtkinter as ctk
 import tkinter as tk
-from tkinter import messagebox, scrolledtext,filedialog
+from tkinter import messagebox, filedialog, ttk
 import json
+import threading
+import time
 from utils import *
-import ollama
+from dialogs import CenteredTextInputDialog
 from ChatFileSystem import ChatMemory  # Add this import
+from model_discovery import ModelDiscovery
+from api_client import ApiClient
+from chat_view import ChatMemorySource, ChatObjectSource, VirtualChatView
+from chat_list_view import ChatListView
+from backend_process import ProcessBackend
+from ui_watchdog import UiWatchdog
+from tracing import NULL_TRACE, SPAN_KIND_CLIENT, Tracer
+from profiling import Profiler
+from code_runner import CodeRunner, format_results, runnable_blocks
+from resource_monitor import ResourceMonitor
+from chat_import import ImportCancelled, import_chat_file
+from bulk_import import bulk_import
+try:
+    from semantic_index import SemanticIndex
+    from document_index import DocumentIndex
+except ImportError:  # numpy is optional, semantic search and document retrieval are disabled without it
+    SemanticIndex = DocumentIndex = None
 from concurrent.futures import ThreadPoolExecutor
+TIMELINE.mark("imports done")
+
+API_URL = os.environ.get("LLAMA_API_URL")  # Thin client of a running api_server.py instead of a local backend
+BACKEND_PROCESS = parse_flag(os.environ.get("LLAMA_BACKEND_PROCESS", "0"))  # Inference and storage in a worker process
+UI_WATCHDOG = parse_flag(os.environ.get("LLAMA_UI_WATCHDOG", "1"))  # Log callbacks that block the window
+UI_STALL_MS = float(os.environ.get("LLAMA_UI_STALL_MS", "200"))  # Event loop lag counted as a stall
+TRACE_SAMPLE_RATE = float(os.environ.get("LLAMA_TRACE_SAMPLE", "0"))  # Fraction of prompts traced, 0 disables tracing
+TRACE_FILE = os.environ.get("LLAMA_TRACE_FILE", "traces.jsonl")
+TRACE_FORMAT = os.environ.get("LLAMA_TRACE_FORMAT", "otlp")  # otlp or chrome
+PROFILE_DIR = os.environ.get("LLAMA_PROFILE_DIR", "profiles")
+CODE_WORKERS = int(os.environ.get("LLAMA_CODE_WORKERS", "2"))  # Warm interpreters for Run Code, 0 starts one per run
+CODE_TIMEOUT = float(os.environ.get("LLAMA_CODE_TIMEOUT", "10"))  # Seconds per code block
+CODE_MEMORY_MB = int(os.environ.get("LLAMA_CODE_MEMORY_MB", "512"))
+PREFILL = parse_flag(os.environ.get("LLAMA_PREFILL", "0"))  # Evaluate the chat history while a prompt is typed
+MONITOR_INTERVAL = float(os.environ.get("LLAMA_MONITOR_INTERVAL", "1"))  # Seconds between samples of the Ollama processes, 0 disables
+MONITOR_GPU_INTERVAL = float(os.environ.get("LLAMA_MONITOR_GPU_INTERVAL", "5"))  # nvidia-smi is a subprocess, 0 disables it
 
 ctk.set_appearance_mode("dark") # We don't  believe in light mode
 ctk.set_default_color_theme("blue")
@@ -13,7 +50,24 @@ ctk.set_default_color_theme("blue")
 class LlamaDesktopApp(ctk.CTk):
     def __init__(self):
         super().__init__()
-        self.ollama_server = start_ollama_server()
+        TIMELINE.mark("window created")
+        self.startup_start = time.perf_counter()
+        self.startup_report = None  # None, "-" to print the startup timeline, or a JSON file path
+        self.exit_after_startup = False
+        self.startup_pending = {"first paint", "backend ready"}
+        # Installed first so the callbacks of every widget created below are timed
+        self.watchdog = None
+        if UI_WATCHDOG:
+            self.watchdog = UiWatchdog(self, threshold=UI_STALL_MS / 1000,
+                                       on_stall=self.on_ui_stall).start()
+        # The server is started / reused in the background, the window shows a "connecting" state meanwhile
+        self.ollama_server = None
+        self.device_servers = []  # Extra per device servers, see OLLAMA_LOCAL_DEVICES
+        # Samples the local server processes, a remote backend (LLAMA_API_URL) can't be watched from here
+        self.resource_monitor = None
+        if MONITOR_INTERVAL > 0 and not API_URL:
+            self.resource_monitor = ResourceMonitor(MONITOR_INTERVAL, MONITOR_GPU_INTERVAL, self.server_pids)
+        self.backend_ready = False
         self.title("Llama Desktop App")
         # Set the window size
         self.window_width = 900
@@ -21,16 +75,207 @@ class LlamaDesktopApp(ctk.CTk):
         self.font_size = 14 #Default font size
         self.slider_value_vars = {}
         self.executor = ThreadPoolExecutor(max_workers=2)
-        self.chat_memory = ChatMemory()  # Initialize ChatMemory
-        self.chat_keys = self.chat_memory.list_chat_ids()
+        self.tracer = Tracer(TRACE_FILE, TRACE_SAMPLE_RATE, TRACE_FORMAT)
+        self.profiler = Profiler(PROFILE_DIR)
+        self.code_runner = CodeRunner(CODE_WORKERS, timeout=CODE_TIMEOUT, memory_mb=CODE_MEMORY_MB,
+                                      cpu_seconds=max(1, int(CODE_TIMEOUT)))
+        self.prefill_key = None  # (chat id, message count, model, gpu, instructions) of the last prefill started
+        self.prefill_result = None  # Its timings once done
+        # chat id -> [chat object, replies pending] of the chats a reply is being generated for
+        self.generating = {}
+        # With a separate backend (API server or worker process) chats, options and generation all go through it
+        self.backend_client = None
+        if API_URL:
+            self.backend_client = ApiClient(API_URL)
+        elif BACKEND_PROCESS:
+            self.backend_client = ProcessBackend().start()
+            # Writes don't wait for the worker, their failures are reported when they come back
+            self.backend_client.add_error_listener(
+                lambda method, message: self.after(0, self.on_backend_write_failed, method, message))
+        with TIMELINE.phase("open chat storage"):
+            self.chat_memory = self.backend_client or ChatMemory()  # Initialize ChatMemory
+        self.semantic_index = None
+        if SemanticIndex is not None and self.backend_client is None:
+            self.semantic_index = SemanticIndex(embed_texts, db_path=self.chat_memory.db_path)
+            self.chat_memory.add_change_listener(self.semantic_index.on_chat_changed)
+        self.document_index = None
+        if DocumentIndex is not None and self.backend_client is None:
+            self.document_index = DocumentIndex(embed_texts, db_path=self.chat_memory.db_path,
+                                                on_progress=lambda chat_id, done, total: self.after(
+                                                    0, self.on_document_progress, done, total))
+            self.chat_memory.add_change_listener(self.document_index.on_chat_changed)
         self.current_chat = None
-        self.available_models = get_available_models()
+        self.rendered_chat = None  # Chat shown in chat_display
+        # Models and GPUs come from the discovery cache right away and are refreshed in the background
+        self.discovery = ModelDiscovery(get_ollama_pool(), check_gpu_availability,
+                                        on_models_changed=lambda models: self.after(0, self.on_models_changed, models),
+                                        on_gpus_changed=lambda gpus: self.after(0, self.on_gpus_changed, gpus))
+        self.available_models = self.discovery.cached_models()
         self.selected_model = None
-        self.gpus = check_gpu_availability()
+        self.gpus = self.discovery.cached_gpus()
         self.selected_gpu = None
-        self.create_widgets()
-        self.load_chats_from_memory()  # Load existing chats from memory
+        with TIMELINE.phase("create widgets"):
+            self.create_widgets()
+        # Hidden profiling menu
+        self.bind("<Control-Alt-KeyPress-p>", self.show_profiling_menu)
+        with TIMELINE.phase("load chat list"):
+            self.load_chats_from_memory()  # Load existing chats from memory
         self.config_window_geometry()
+        if self.backend_client is not None:
+            self.set_status("Connecting to the backend...")
+            threading.Thread(target=self.connect_backend_client_async, daemon=True).start()
+        else:
+            self.set_status("Connecting to Ollama...")
+            self.discovery.start()
+            threading.Thread(target=self.connect_backend_async, daemon=True).start()
+        self.after_idle(self.on_window_interactive)
+
+    def on_window_interactive(self):
+        elapsed = (time.perf_counter() - self.startup_start) * 1000
+        print(f"Window interactive after {elapsed:.0f} ms")
+        TIMELINE.mark("first paint")
+        self.on_startup_step("first paint")
+        if CODE_WORKERS > 0:
+            self.code_runner.start()  # Warm interpreters start after the window is up
+
+    def on_startup_step(self, step):
+        self.startup_pending.discard(step)
+        if self.startup_pending:
+            return
+        if self.startup_report:
+            self.emit_startup_report(self.startup_report)
+        if self.exit_after_startup:
+            self.after(0, self.on_closing)
+
+    def emit_startup_report(self, destination="-"):
+        if destination == "-":
+            print(TIMELINE.report())
+        else:
+            TIMELINE.write(destination)
+            print(f"Startup timeline written to {destination}")
+
+    def connect_backend_async(self):
+        self.ollama_server = start_ollama_server()
+        self.device_servers = start_local_device_servers()
+        ready = wait_for_server(process=self.ollama_server)
+        if ready:
+            get_ollama_pool().start_health_checks()
+            self.discovery.refresh_now()
+            if self.semantic_index is not None:
+                self.semantic_index.start()
+                # Catch up on messages written before the index existed or while the app was closed
+                self.semantic_index.catch_up(self.chat_memory)
+        self.after(0, self.on_backend_ready, ready)
+
+    def connect_backend_client_async(self):
+        ready = False
+        for _ in range(20):
+            if self.backend_client.is_alive():
+                ready = True
+                break
+            time.sleep(0.5)
+        if ready:
+            try:
+                models = self.backend_client.list_models()
+                self.after(0, self.on_models_changed, models)
+            except Exception as e:
+                print(f"Could not list models from the backend: {e}")
+        self.after(0, self.on_backend_ready, ready)
+
+    def on_backend_ready(self, ready):
+        elapsed = (time.perf_counter() - self.startup_start) * 1000
+        self.backend_ready = ready
+        TIMELINE.mark("backend ready" if ready else "backend unreachable")
+        self.on_startup_step("backend ready")
+        if not ready:
+            self.set_status(f"Could not reach {API_URL or OLLAMA_HOST}")
+            print(f"Ollama server not reachable after {elapsed:.0f} ms")
+            return
+        reused = " (reused running server)" if self.ollama_server is None and self.backend_client is None else ""
+        self.set_status(f"Connected{reused}")
+        if self.resource_monitor is not None:
+            self.resource_monitor.add_listener(lambda sample: self.after(0, self.on_resource_sample, sample))
+            self.resource_monitor.start()
+        print(f"Ollama server ready after {elapsed:.0f} ms{reused}")
+
+    def on_backend_write_failed(self, method, message):
+        self.set_status(f"Backend {method} failed")
+        messagebox.showerror("Error", f"The backend could not save the change ({method}): {message}")
+
+    def server_pids(self):
+        # Servers started by the app, none when it reused a running one or a worker process started it
+        return [process.pid for process in [self.ollama_server] + self.device_servers if process is not None]
+
+    def on_resource_sample(self, sample):
+        if not sample["processes"]:
+            self.resource_var.set("Ollama: no local server process")
+            return
+        text = (f"Ollama: CPU {sample['cpu_percent']:.0f}%, {sample['rss_mb'] / 1024:.1f} GB, "
+                f"{sample['threads']} threads")
+        if "gpu_utilization" in sample:
+            memory = sample.get("server_gpu_memory_mb", sample["gpu_memory_mb"])
+            text += (f"\nGPU {sample['gpu_utilization']:.0f}%, "
+                     f"{memory / 1024:.1f} / {sample['gpu_memory_total_mb'] / 1024:.1f} GB")
+        self.resource_var.set(text)
+
+    def on_models_changed(self, models):
+        added = set(models) - set(self.available_models)
+        removed = set(self.available_models) - set(models)
+        self.available_models = models
+        self.model_dropdown.configure(values=self.available_models)
+        if self.model_var.get() in removed:
+            self.model_var.set("Choose a model")
+        if added or removed:
+            print(f"Models updated: +{sorted(added)} -{sorted(removed)}")
+
+    def on_gpus_changed(self, gpus):
+        self.gpus = gpus
+        self.gpu_dropdown.configure(values=self.gpus)
+
+    def set_status(self, text):
+        self.status_var.set(text)
+
+    def on_ui_stall(self, stall):
+        # Details (callback and stack sample) are in ui_stalls.log
+        self.stall_var.set(f"UI stalls: {self.watchdog.stall_count}")
+        print(f"UI stalled {stall['duration'] * 1000:.0f} ms in {stall['callback']}")
+
+    def show_profiling_menu(self, event):
+        profiler = self.profiler
+        menu = tk.Menu(self, tearoff=0)
+        if profiler.cpu_running:
+            menu.add_command(label="Stop CPU profile (Tk thread)", command=lambda: self.save_profile(profiler.stop_cpu))
+        else:
+            menu.add_command(label="Start CPU profile (Tk thread)", command=profiler.start_cpu)
+        if profiler.sampling:
+            menu.add_command(label="Stop sampling (all threads)",
+                             command=lambda: self.save_profile(profiler.stop_sampling))
+        else:
+            menu.add_command(label="Start sampling (all threads)", command=profiler.start_sampling)
+        menu.add_separator()
+        if profiler.memory_running:
+            menu.add_command(label="Take memory snapshot (diff)", command=self.take_memory_snapshot)
+            menu.add_command(label="Stop memory tracking", command=profiler.stop_memory)
+        else:
+            menu.add_command(label="Start memory tracking", command=profiler.start_memory)
+        menu.add_separator()
+        menu.add_command(label="Print startup timeline", command=self.emit_startup_report)
+        menu.tk_popup(event.x_root, event.y_root)
+
+    def save_profile(self, stop):
+        path = stop()
+        if path:
+            self.set_status(f"Profile written to {path}")
+
+    def take_memory_snapshot(self):
+        # Walking the heap takes a moment with large chats, the report is written off the Tk thread
+        self.set_status("Taking memory snapshot...")
+
+        def run():
+            path = self.profiler.snapshot_memory()
+            self.after(0, self.set_status, f"Memory report written to {path}")
+
+        threading.Thread(target=run, daemon=True).start()
 
     def config_window_geometry(self):
         # Get screen width and height
@@ -66,9 +311,11 @@ class LlamaDesktopApp(ctk.CTk):
         new_chat_button = ctk.CTkButton(self.sidebar, text="New Chat", command=self.prompt_new_chat)
         new_chat_button.grid(row=0, column=0, padx=20, pady=(20, 10))
 
-        self.chat_list = tk.Listbox(self.sidebar, bg='#2b2b2b', fg='white', selectbackground='#4a4a4a')
+        # Chat list with a filter box, only the visible rows are in the widget
+        self.chat_list = ChatListView(self.sidebar, on_select=self.on_chat_select,
+                                      entry_options={'bg': '#2b2b2b', 'fg': 'white', 'insertbackground': 'white'},
+                                      bg='#2b2b2b', fg='white', selectbackground='#4a4a4a')
         self.chat_list.grid(row=1, column=0, padx=20, pady=(10, 20), sticky="nsew")
-        self.chat_list.bind('<<ListboxSelect>>', self.on_chat_select)
 
         # Add Remove Chat button
         remove_chat_button = ctk.CTkButton(self.sidebar, text="Remove Chat", command=self.remove_chat)
@@ -94,6 +341,36 @@ class LlamaDesktopApp(ctk.CTk):
         set_instructions_button = ctk.CTkButton(self.sidebar, text="Set Instructions", command=self.set_instructions)
         set_instructions_button.grid(row=5, column=0, padx=20, pady=(10, 20))
 
+        # Add Search History button
+        search_button = ctk.CTkButton(self.sidebar, text="Search History", command=self.search_history)
+        search_button.grid(row=6, column=0, padx=20, pady=(10, 20))
+
+        # Add Attach Documents button
+        attach_button = ctk.CTkButton(self.sidebar, text="Attach Documents", command=self.attach_documents)
+        attach_button.grid(row=7, column=0, padx=20, pady=(10, 20))
+
+        # Add Run Code button
+        run_code_button = ctk.CTkButton(self.sidebar, text="Run Code", command=self.run_code)
+        run_code_button.grid(row=8, column=0, padx=20, pady=(10, 20))
+
+        # Add Branches button
+        branches_button = ctk.CTkButton(self.sidebar, text="Branches", command=self.show_branches)
+        branches_button.grid(row=9, column=0, padx=20, pady=(10, 20))
+
+        # Add Bulk Import button
+        bulk_import_button = ctk.CTkButton(self.sidebar, text="Bulk Import", command=self.bulk_import_chats)
+        bulk_import_button.grid(row=10, column=0, padx=20, pady=(10, 20))
+
+        # Event loop stalls seen by the watchdog
+        self.stall_var = tk.StringVar(value="UI stalls: 0" if self.watchdog is not None else "")
+        stall_label = ctk.CTkLabel(self.sidebar, textvariable=self.stall_var, anchor="w")
+        stall_label.grid(row=11, column=0, padx=20, pady=(0, 10), sticky="ew")
+
+        # Live resource use of the Ollama server processes
+        self.resource_var = tk.StringVar(value="")
+        resource_label = ctk.CTkLabel(self.sidebar, textvariable=self.resource_var, anchor="w", justify="left")
+        resource_label.grid(row=12, column=0, padx=20, pady=(0, 10), sticky="ew")
+
         self.create_chat_tab()
         self.create_settings_tab()
 
@@ -107,6 +384,8 @@ class LlamaDesktopApp(ctk.CTk):
 
         self.prompt_entry = ctk.CTkEntry(self.chat_tab, height=30)
         self.prompt_entry.grid(row=1, column=0, sticky="ew", pady=(0, 10))
+        if PREFILL:
+            self.prompt_entry.bind("<KeyRelease>", self.on_prompt_typed)
 
         # Create a frame for 2x2 grid (dropdowns and buttons)
         selection_frame = ctk.CTkFrame(self.chat_tab)
@@ -118,7 +397,8 @@ class LlamaDesktopApp(ctk.CTk):
 
         # Model dropdown in first row, first column
         self.model_var = tk.StringVar(value="Choose a model")
-        self.model_dropdown = ctk.CTkOptionMenu(selection_frame, variable=self.model_var, values=self.available_models)
+        self.model_dropdown = ctk.CTkOptionMenu(selection_frame, variable=self.model_var, values=self.available_models,
+                                                command=lambda _: self.load_generation_options_fields())
         self.model_dropdown.grid(row=0, column=0, sticky="nsew", padx=(0, 5), pady=(0, 5))
 
         # GPU dropdown in first row, second column
@@ -134,16 +414,17 @@ class LlamaDesktopApp(ctk.CTk):
         clear_button = ctk.CTkButton(selection_frame, text="Clear Chat", command=self.clear_chat)
         clear_button.grid(row=1, column=1, sticky="nsew", padx=(5, 0), pady=(5, 0))
 
-        # Chat display
-        self.chat_display = scrolledtext.ScrolledText(self.chat_tab, wrap=tk.WORD, bg='#2b2b2b', fg='white')
-        self.chat_display.grid(row=4, column=0, sticky="nsew", pady=(10, 0))
-        self.chat_display.config(state=tk.DISABLED)
+        # Backend connection status
+        self.status_var = tk.StringVar(value="")
+        status_label = ctk.CTkLabel(self.chat_tab, textvariable=self.status_var, anchor="w")
+        status_label.grid(row=3, column=0, sticky="ew")
 
-        # Access and configure the scrollbar
-        for child in self.chat_display.winfo_children():
-            if isinstance(child, tk.Scrollbar):
-                child.config(bg='#1e1e1e', troughcolor='#1e1e1e')  # Change scrollbar and trough color
-                break  # Stop after finding the scrollbar
+        # Chat display, only the messages near the viewport are in the widget so long chats stay fast
+        self.chat_display = VirtualChatView(self.chat_tab, scrollbar_color='#1e1e1e', bg='#2b2b2b', fg='white')
+        self.chat_display.grid(row=4, column=0, sticky="nsew", pady=(10, 0))
+        self.chat_display.tag_configure("bold", font=("Arial", self.font_size + 2, "bold"))
+        # Right click on a message to branch the chat from there
+        self.chat_display.text.bind("<Button-2>" if sys.platform == "darwin" else "<Button-3>", self.show_message_menu)
 
     def create_settings_tab(self):
         self.settings_tab.grid_columnconfigure(1, weight=1)  # Add weight to column 1
@@ -164,6 +445,68 @@ class LlamaDesktopApp(ctk.CTk):
         apply_button = ctk.CTkButton(self.settings_tab, text="Apply Changes", command=self.apply_changes)
         apply_button.grid(row=6, column=0, columnspan=2, pady=(20, 0))
 
+        self.create_generation_options_section(self.settings_tab, 7)
+
+    def create_generation_options_section(self, parent, row):
+        ctk.CTkLabel(parent, text="Generation Options", font=("Arial", 16)).grid(row=row, column=0, columnspan=2, pady=(20, 5))
+
+        frame = ctk.CTkFrame(parent)
+        frame.grid(row=row + 1, column=0, columnspan=2, sticky="ew", pady=(0, 10))
+        frame.grid_columnconfigure(1, weight=1)
+
+        # Options are edited either for the current chat or as the profile of the selected model
+        self.options_scope_var = tk.StringVar(value="Current chat")
+        scope_menu = ctk.CTkOptionMenu(frame, variable=self.options_scope_var, values=["Current chat", "Selected model"],
+                                       command=lambda _: self.load_generation_options_fields())
+        scope_menu.grid(row=0, column=0, columnspan=2, sticky="ew", pady=(0, 5))
+
+        self.option_entries = {}
+        for index, key in enumerate(GENERATION_OPTIONS, start=1):
+            ctk.CTkLabel(frame, text=f"{key}:").grid(row=index, column=0, sticky="w", padx=(0, 10))
+            entry = ctk.CTkEntry(frame, placeholder_text="default")
+            entry.grid(row=index, column=1, sticky="ew", pady=2)
+            self.option_entries[key] = entry
+
+        save_options_button = ctk.CTkButton(frame, text="Save Options", command=self.save_generation_options)
+        save_options_button.grid(row=len(GENERATION_OPTIONS) + 1, column=0, columnspan=2, pady=(10, 0))
+
+    def get_options_scope_target(self):
+        # Returns ("chat", None) or ("model", model name), or None when nothing is selected
+        if self.options_scope_var.get() == "Current chat":
+            return ("chat", None) if self.current_chat else None
+        model = self.model_var.get()
+        return None if model == "Choose a model" else ("model", model)
+
+    def load_generation_options_fields(self):
+        target = self.get_options_scope_target()
+        if target is None:
+            options = {}
+        elif target[0] == "chat":
+            options = self.current_chat.options
+        else:
+            options = self.chat_memory.get_model_options(target[1])
+        for key, entry in self.option_entries.items():
+            entry.delete(0, tk.END)
+            if key in options:
+                entry.insert(0, str(options[key]))
+
+    def save_generation_options(self):
+        target = self.get_options_scope_target()
+        if target is None:
+            messagebox.showerror("Error", "Select a chat or a model before saving options.")
+            return
+        try:
+            options = parse_generation_options({key: entry.get() for key, entry in self.option_entries.items()})
+        except ValueError as e:
+            messagebox.showerror("Error", str(e))
+            return
+        if target[0] == "chat":
+            self.current_chat.options = options
+            self.chat_memory.update_chat(self.current_chat)
+        else:
+            self.chat_memory.set_model_options(target[1], options)
+        messagebox.showinfo("Success", "Generation options have been saved.")
+
     def create_slider(self, parent, name, row, from_, to, number_of_steps):
         frame = ctk.CTkFrame(parent)
         frame.grid(row=row, column=0, columnspan=2, sticky="ew", pady=(0, 10))
@@ -194,9 +537,7 @@ class LlamaDesktopApp(ctk.CTk):
             self.slider_value_vars[name].set(f"{int(value)}")
 
     def load_chats_from_memory(self):
-        chat_names = self.chat_memory.list_chat_names()
-        for name in chat_names:
-            self.chat_list.insert(tk.END,name)
+        self.chat_list.set_chats(self.chat_memory.list_chats())
     def prompt_new_chat(self):
         dialog = CenteredTextInputDialog(text="Enter a name for the new chat:",
                                      title="New Chat",
@@ -218,33 +559,30 @@ class LlamaDesktopApp(ctk.CTk):
                           messages=messages,
                           reply_times=reply_times,
                           addressed_models= addressed_models)
-        self.chat_keys.append(chat.creation_time)
-        self.chat_list.insert(tk.END, chat.name)
-        self.chat_list.selection_clear(0, tk.END)
-        self.chat_list.selection_set(tk.END)
+        self.chat_list.add_chat(chat.creation_time, chat.name)
+        self.chat_list.select(chat.creation_time)
         self.current_chat = chat
         self.update_chat_display()
+        self.load_generation_options_fields()
         self.chat_memory.add_chat(chat)  # Adding the new chat to memory
 
     def remove_chat(self):
-        selection = self.chat_list.curselection()
-        if selection:
-            index = selection[0]
-            removed_chat_id = self.chat_keys.pop(index)
-            removed_chat_name = self.chat_memory.get_chat_name(chat_id = removed_chat_id)
-            self.chat_list.delete(index)
+        removed_chat_id = self.chat_list.selected_id
+        if removed_chat_id:
+            removed_chat_name = self.chat_list.name_of(removed_chat_id)
+            # The list picks the chat now shown in its place (next one, or previous at the end)
+            next_chat_id = self.chat_list.remove_chat(removed_chat_id)
 
             self.chat_memory.delete_chat_by_timestamp(removed_chat_id)  # Remove chat from memory by timestamp
 
-            # Select the next chat, or the last one if we removed the last chat
-            if self.chat_keys:
-                new_index = min(index, len(self.chat_keys) - 1)
-                self.chat_list.selection_set(new_index)
-                self.current_chat = self.chat_memory.get_chat_by_timestamp(self.chat_keys[new_index])
+            if next_chat_id:
+                self.chat_list.select(next_chat_id)
+                self.current_chat = self.load_chat(next_chat_id)
             else:
                 self.current_chat = None
 
             self.update_chat_display()
+            self.load_generation_options_fields()
             print(f"Removed chat: {removed_chat_name} , with timestamp id: {removed_chat_id}")
         else:
             messagebox.showinfo("Info", "Please select a chat to remove.")
@@ -305,12 +643,88 @@ class LlamaDesktopApp(ctk.CTk):
     def rgb_to_hex(self, r, g, b):
         return f'#{int(r * 255):02x}{int(g * 255):02x}{int(b * 255):02x}'
 
-    def on_chat_select(self, event):
-        selection = self.chat_list.curselection()
-        if selection:
-            index = selection[0]
-            self.current_chat = self.chat_memory.get_chat_by_timestamp(self.chat_keys[index])
-            self.update_chat_display()
+    def load_chat(self, chat_id):
+        # A chat waiting for a reply stays the same object, so that the reply (and its stream) shows up in it.
+        # Others are opened without their history, which is shown from storage a page at a time and only read
+        # in full once the chat is changed (see LazyChatObject)
+        if chat_id in self.generating:
+            return self.generating[chat_id][0]
+        return LazyChatObject.open(self.chat_memory, chat_id)
+
+    def on_chat_select(self, chat_id):
+        self.current_chat = self.load_chat(chat_id)
+        self.update_chat_display()
+        self.load_generation_options_fields()
+
+    def show_message_menu(self, event):
+        message_index = self.chat_display.message_at(event.x, event.y)
+        menu = tk.Menu(self, tearoff=0)
+        menu.add_command(label="Branch from here", state=tk.DISABLED if message_index is None else tk.NORMAL,
+                         command=lambda: self.branch_chat(message_index + 1))
+        menu.add_command(label="Show branches", command=self.show_branches)
+        menu.tk_popup(event.x_root, event.y_root)
+
+    def branch_chat(self, message_count):
+        # New chat continuing from the first message_count messages, which stay stored once (see ChatMemory.fork_chat)
+        parent = self.current_chat
+        if parent is None:
+            return
+        dialog = CenteredTextInputDialog(text="Enter a name for the branch:", title="Branch Chat",
+                                         height=250, width=350, max_length=50)
+        name = dialog.get_input()
+        if name is None:
+            return
+        try:
+            branch = self.chat_memory.fork_chat(parent.creation_time, message_count, name or f"{parent.name} (branch)")
+        except (KeyError, ValueError) as e:
+            messagebox.showerror("Error", f"Could not branch the chat: {e}")
+            return
+        self.chat_list.add_chat(branch.creation_time, branch.name)
+        self.chat_list.select(branch.creation_time)
+        self.current_chat = branch
+        self.update_chat_display()
+        self.load_generation_options_fields()
+
+    def show_branches(self):
+        # Tree of the branches the current chat belongs to, double click to switch
+        if not self.current_chat:
+            messagebox.showerror("Error", "No chat selected.")
+            return
+        chats = {chat_id: (name, parent_id, fork_point)
+                 for chat_id, name, parent_id, fork_point in self.chat_memory.list_chat_tree()}
+        root_id = self.current_chat.creation_time
+        while chats.get(root_id, (None, None))[1] in chats:
+            root_id = chats[root_id][1]
+        children = {}
+        for chat_id, (_, parent_id, _) in sorted(chats.items()):
+            children.setdefault(parent_id, []).append(chat_id)
+
+        window = ctk.CTkToplevel(self)
+        window.title(f"Branches of {chats.get(root_id, ('?',))[0]}")
+        window.geometry("500x400")
+        tree = ttk.Treeview(window, columns=("fork",), selectmode="browse")
+        tree.heading("#0", text="Chat")
+        tree.heading("fork", text="Branched after message")
+        tree.column("fork", width=160, anchor="center")
+        tree.pack(fill="both", expand=True, padx=10, pady=10)
+        pending = [("", root_id)]
+        while pending:
+            parent_item, chat_id = pending.pop()
+            name, parent_id, fork_point = chats.get(chat_id, (self.current_chat.name, None, 0))
+            tree.insert(parent_item, tk.END, iid=chat_id, text=name, open=True,
+                        values=(fork_point if parent_id else "",))
+            pending.extend((chat_id, child_id) for child_id in reversed(children.get(chat_id, [])))
+        if tree.exists(self.current_chat.creation_time):
+            tree.selection_set(self.current_chat.creation_time)
+            tree.see(self.current_chat.creation_time)
+
+        def open_branch(event):
+            selection = tree.selection()
+            if selection:
+                self.open_chat_at(selection[0])
+
+        tree.bind('<Double-Button-1>', open_branch)
+        tree.bind('<Return>', open_branch)
 
     def set_instructions(self):
         if not self.current_chat:
@@ -335,41 +749,123 @@ class LlamaDesktopApp(ctk.CTk):
             self.current_chat.instructions = dialog.result
             messagebox.showinfo("Success", "Instructions have been updated.")
 
-    def update_chat_display(self):
-        # Clear and prepare the chat display
-        self.chat_display.config(state=tk.NORMAL)
-        self.chat_display.delete(1.0, tk.END)
-        # Define the bold tag if it doesn't already exist
-        self.chat_display.tag_configure("bold", font=("Arial", self.font_size + 2, "bold"))
+    def attach_documents(self):
+        if self.document_index is None:
+            messagebox.showerror("Error", "Document retrieval needs numpy installed.")
+            return
+        if not self.current_chat:
+            messagebox.showerror("Error", "No chat selected. Please select or create a chat first.")
+            return
+        file_paths = filedialog.askopenfilenames(
+            filetypes=[("Text files", "*.txt *.md *.py *.json *.csv"), ("All files", "*.*")],
+            title="Select documents to attach to this chat"
+        )
+        if file_paths:
+            # Indexing runs on the document worker, progress shows in the status line
+            self.document_index.attach(self.current_chat.creation_time, list(file_paths))
+            attached = len(self.document_index.list_documents(self.current_chat.creation_time))
+            self.set_status(f"Indexing documents... ({attached} attached to this chat)")
+
+    def on_document_progress(self, done, total):
+        if done >= total:
+            self.set_status(f"Documents indexed ({total} chunks)")
+        else:
+            self.set_status(f"Indexing documents: {done}/{total} chunks")
 
-        if self.current_chat:
-            self.chat_display.insert(tk.END, f"Current Chat: {self.current_chat.name} \n\n", "bold")
-            # Loop through messages and display them
-            for i in range(len(self.current_chat.messages)):
-                if self.current_chat.messages[i]['role'] != 'user':
-                    # Insert the header in bold
-                    self.chat_display.insert(tk.END, f"{self.current_chat.addressed_models[i//2]}:\n ", "bold")
-                    # Insert the message content normally
-                    self.chat_display.insert(tk.END, f"{self.current_chat.messages[i]['content']}\n\n")
-
-                    if i // 2 < len(self.current_chat.reply_times):
-                        self.chat_display.insert(tk.END,
-                                                 f"Response time: {self.current_chat.reply_times[i // 2]:.2f} seconds\n\n")
-                else:
-                    self.chat_display.insert(tk.END, "User:\n ", "bold")
-                    # Insert the message content normally
-                    self.chat_display.insert(tk.END, f"{self.current_chat.messages[i]['content']}\n\n")
+    def search_history(self):
+        if self.semantic_index is None:
+            messagebox.showerror("Error", "Semantic search needs numpy installed.")
+            return
+        dialog = CenteredTextInputDialog(self, text="Search chat history:", title="Search History",
+                                         height=250, width=450, max_length=500)
+        query = dialog.get_input()
+        if not query:
+            return
+        self.set_status("Searching...")
+
+        def run_search():
+            try:
+                start = time.perf_counter()
+                hits = self.semantic_index.search(query, k=20)
+                elapsed = time.perf_counter() - start
+                self.after(0, self.show_search_results, query, hits, elapsed)
+            except Exception as e:
+                self.after(0, messagebox.showerror, "Error", f"Search failed: {str(e)}")
+
+        self.executor.submit(run_search)
+
+    def show_search_results(self, query, hits, elapsed):
+        pending = self.semantic_index.pending()
+        self.set_status(f"{len(hits)} results in {elapsed * 1000:.0f} ms"
+                        + (f" ({pending} messages still indexing)" if pending else ""))
+        window = ctk.CTkToplevel(self)
+        window.title(f"Results for: {query[:40]}")
+        window.geometry("600x400")
+        results_list = tk.Listbox(window, bg='#2b2b2b', fg='white', selectbackground='#4a4a4a')
+        results_list.pack(fill="both", expand=True, padx=10, pady=10)
+        names = {}
+        for score, chat_id, message_index in hits:
+            if chat_id not in names:
+                names[chat_id] = self.chat_memory.get_chat_name(chat_id) or "?"
+            results_list.insert(tk.END, f"{score:.2f}  {names[chat_id]}  (message {message_index + 1})")
+
+        def open_hit(event):
+            selection = results_list.curselection()
+            if selection:
+                _, chat_id, message_index = hits[selection[0]]
+                self.open_chat_at(chat_id, message_index)
+
+        results_list.bind('<Double-Button-1>', open_hit)
+        results_list.bind('<Return>', open_hit)
+
+    def open_chat_at(self, chat_id, message_index=None):
+        if not self.chat_list.has_chat(chat_id):
+            return
+        self.chat_list.select(chat_id)
+        self.current_chat = self.load_chat(chat_id)
+        self.update_chat_display()
+        self.load_generation_options_fields()
+        if message_index is not None:
+            self.chat_display.scroll_to_message(message_index)
+
+    def update_chat_display(self):
+        # The view is rebuilt when another chat is shown or the history got shorter (cleared),
+        # otherwise only the messages added since the last call are indexed
+        chat = self.current_chat
+        if chat is None:
+            self.rendered_chat = None
+            self.chat_display.show_placeholder("No chat selected. Create a new chat or select an existing one.")
+        elif chat is not self.rendered_chat:
+            self.rendered_chat = chat
+            self.chat_display.set_source(self.display_source(chat), chat.name)
+        elif isinstance(self.chat_display.source, ChatMemorySource):
+            if chat.loaded:
+                # The history was read for a change, show it from memory from now on (without a full redraw)
+                self.chat_display.replace_source(ChatObjectSource(chat))
+            else:
+                self.chat_display.refresh()
+        elif len(chat.messages) < self.chat_display.message_count():
+            self.chat_display.set_source(ChatObjectSource(chat), chat.name)
         else:
-            self.chat_display.insert(tk.END, "No chat selected. Create a new chat or select an existing one.")
+            self.chat_display.refresh()
+
+    def display_source(self, chat):
+        if isinstance(chat, LazyChatObject) and not chat.loaded:
+            return ChatMemorySource(self.chat_memory, chat.creation_time)
+        return ChatObjectSource(chat)
 
-        self.chat_display.config(state=tk.DISABLED)
-        self.chat_display.see(tk.END)
+    def append_streamed_piece(self, chat, model, piece):
+        # Reply text arriving while the model generates, replaced by the final message once it is complete
+        if chat is self.rendered_chat:
+            self.chat_display.append_stream(model, piece)
 
     def clear_chat(self):
         if self.current_chat:
             self.current_chat.messages.clear()
             self.current_chat.reply_times.clear()
             self.current_chat.addressed_models.clear()
+            self.current_chat.turn_metrics.clear()
+            self.current_chat.kv_context = {}
             # Updating memory
             self.chat_memory.update_chat(self.current_chat)
             # Updating display
@@ -384,10 +880,12 @@ class LlamaDesktopApp(ctk.CTk):
         # Prepare chat data
         chat_data = {
             "name": self.current_chat.name,
-            "messages": self.current_chat.messages,
-            "reply_times": self.current_chat.reply_times,
+            "messages": self.current_chat.messages.tolist(),
+            "reply_times": list(self.current_chat.reply_times),
             "addressed_models": self.current_chat.addressed_models,
-            "instructions": self.current_chat.instructions  # Add instructions to saved data
+            "instructions": self.current_chat.instructions,  # Add instructions to saved data
+            "options": self.current_chat.options,
+            "turn_metrics": self.current_chat.turn_metrics
         }
 
         # Open file dialog to choose save location
@@ -405,91 +903,369 @@ class LlamaDesktopApp(ctk.CTk):
             except Exception as e:
                 messagebox.showerror("Error", f"Failed to save chat: {str(e)}")
 
+    def open_progress_window(self, title, text, cancelled):
+        # Small window with a progress bar, Cancel (or closing it) sets the cancelled event
+        window = ctk.CTkToplevel(self)
+        window.title(title)
+        window.geometry("400x140")
+        window.transient(self)
+        label = ctk.CTkLabel(window, text=text)
+        label.pack(padx=20, pady=(20, 10))
+        progress_bar = ctk.CTkProgressBar(window, width=360)
+        progress_bar.set(0)
+        progress_bar.pack(padx=20)
+        cancel_button = ctk.CTkButton(window, text="Cancel", command=cancelled.set)
+        cancel_button.pack(pady=15)
+        window.protocol("WM_DELETE_WINDOW", cancelled.set)
+        return window, label, progress_bar
+
     def import_chat(self):
         file_path = filedialog.askopenfilename(
             filetypes=[("JSON files", "*.json"), ("All files", "*.*")],
             title="Select a chat file to import"
         )
-        if file_path:
+        if not file_path:
+            return
+
+        # The file is streamed into the database in the background (see chat_import.py), large exports
+        # show their progress and can be cancelled
+        cancelled = threading.Event()
+        window, label, progress_bar = self.open_progress_window("Importing Chat",
+                                                                f"Importing {os.path.basename(file_path)}...", cancelled)
+
+        def on_progress(done, total):
+            self.after(0, progress_bar.set, done / total if total else 1.0)
+
+        def run_import():
             try:
-                # Attempt to load and parse the JSON file
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    chat_data = json.load(f)
-
-                # Check if chat_data is a dictionary
-                if not isinstance(chat_data, dict):
-                    raise ValueError("Invalid chat data format: expected a dictionary")
-
-                # Validate that 'name', 'messages', 'reply_times', 'addressed_models', and 'instructions' are present
-                if not all(key in chat_data for key in ["name", "messages", "reply_times", "addressed_models", "instructions"]):
-                    raise ValueError("Invalid chat data format: Missing some required keys")
-
-                # Validate chat_data types
-                result = validate_data_structure(chat_data)
-                if result:
-                    raise result
-
-            except json.JSONDecodeError:
-                messagebox.showerror("Error", "Invalid JSON file. Please ensure the file is properly formatted.")
-                return
-            except ValueError as e:
-                messagebox.showerror("Error", str(e))
-                return
+                result = import_chat_file(file_path, self.chat_memory, on_progress, cancelled)
+            except BaseException as e:
+                self.after(0, self.on_import_done, window, None, e)
+            else:
+                self.after(0, self.on_import_done, window, result, None)
+
+        self.executor.submit(run_import)
+
+    def on_import_done(self, window, result, error):
+        window.destroy()
+        if isinstance(error, ImportCancelled):
+            return
+        if isinstance(error, json.JSONDecodeError):
+            messagebox.showerror("Error", "Invalid JSON file. Please ensure the file is properly formatted.")
+            return
+        if isinstance(error, ValueError):
+            messagebox.showerror("Error", str(error))
+            return
+        if error is not None:
+            messagebox.showerror("Error", f"Failed to import chat: {str(error)}")
+            return
+
+        # Add the new chat to the list and show it
+        chat_id, name = result
+        self.chat_list.add_chat(chat_id, name)
+        self.open_chat_at(chat_id)
+        messagebox.showinfo("Success", f"Chat '{name}' imported successfully")
+
+    def bulk_import_chats(self):
+        if not self.chat_memory.db_path:
+            messagebox.showerror("Error", "Bulk import writes to a local chat database. Run "
+                                          "python bulk_import.py <folder> --db <database> where the backend runs.")
+            return
+        choice = messagebox.askyesnocancel("Bulk Import", "Import a folder of chat files?\n\n"
+                                                          "Yes picks a folder, No picks a .zip / .tar archive.")
+        if choice is None:
+            return
+        if choice:
+            path = filedialog.askdirectory(title="Select a folder of chat files")
+        else:
+            path = filedialog.askopenfilename(
+                filetypes=[("Archives", "*.zip *.tar *.tar.gz *.tgz"), ("All files", "*.*")],
+                title="Select an archive of chat files"
+            )
+        if not path:
+            return
+
+        # Files are parsed in a process pool and written by this worker thread (see bulk_import.py)
+        cancelled = threading.Event()
+        window, label, progress_bar = self.open_progress_window("Bulk Import", "Reading files...", cancelled)
+
+        def on_progress(summary):
+            text = (f"{summary['done']} / {summary['files']} files: {summary['imported']} imported, "
+                    f"{summary['duplicates']} duplicates, {len(summary['errors'])} errors")
+            self.after(0, label.configure, {"text": text})
+            self.after(0, progress_bar.set, summary['done'] / summary['files'])
+
+        def add_chats(chats):
+            for chat_id, name in chats:
+                self.chat_list.add_chat(chat_id, name)
+
+        def on_chats(chats):
+            self.after(0, add_chats, chats)
+
+        def run_import():
+            try:
+                summary = bulk_import(path, self.chat_memory, on_progress=on_progress,
+                                      on_chats=on_chats, cancelled=cancelled)
             except Exception as e:
-                messagebox.showerror("Error", f"Failed to import chat: {str(e)}")
-                return
-
-            # Only create a new chat if no exceptions occurred
-            new_chat = ChatObject(chat_data["name"])
-            new_chat.messages = chat_data["messages"]
-            new_chat.reply_times = chat_data["reply_times"]
-            new_chat.addressed_models = chat_data["addressed_models"]
-            new_chat.instructions = chat_data["instructions"]
-
-            # Add the new chat to the list and update the UI
-            self.chat_keys.append(new_chat)
-            self.chat_list.insert(tk.END, new_chat.name)
-            self.chat_list.selection_clear(0, tk.END)
-            self.chat_list.selection_set(tk.END)
-            self.current_chat = new_chat
-            self.update_chat_display()
-            self.chat_memory.add_chat(new_chat)
-            messagebox.showinfo("Success", f"Chat '{new_chat.name}' imported successfully")
+                self.after(0, window.destroy)
+                self.after(0, messagebox.showerror, "Error", f"Bulk import failed: {str(e)}")
+            else:
+                self.after(0, self.on_bulk_import_done, window, summary)
+
+        self.executor.submit(run_import)
+
+    def on_bulk_import_done(self, window, summary):
+        window.destroy()
+        text = (f"{summary['imported']} chats imported, {summary['duplicates']} duplicates skipped, "
+                f"{len(summary['errors'])} files failed{' (cancelled)' if summary['cancelled'] else ''}.\n"
+                f"{summary['done']} files, {summary['bytes'] / (1 << 20):.1f} MB in {summary['seconds']:.1f} s "
+                f"({summary['files_per_second']:.0f} files/s, {summary['workers']} workers)")
+        print(f"Bulk import: {text}")
+        if summary["errors"]:
+            errors = "\n".join(f"{source}: {error}" for source, error in summary["errors"][:10])
+            more = len(summary["errors"]) - 10
+            messagebox.showwarning("Bulk Import", f"{text}\n\n{errors}" + (f"\n... and {more} more" if more > 0 else ""))
+        else:
+            messagebox.showinfo("Bulk Import", text)
 
-    def generate_response(self):
+    def ready_to_generate(self):
+        # Picks up the selected model and GPU, or shows why nothing can be generated yet
         if not self.current_chat:
             messagebox.showerror("Error", "No chat selected.")
-            return
+            return False
+
+        if not self.backend_ready:
+            messagebox.showerror("Error", "Still connecting to the Ollama server, please wait.")
+            return False
 
         self.selected_model = self.model_var.get()
         self.selected_gpu = self.gpu_var.get()
+        if self.selected_gpu not in self.gpus:
+            self.selected_gpu = "CPU"  # Placeholder text still showing, nothing was picked
 
         if self.selected_model == 'Choose a model':
             messagebox.showerror("Error", "Please choose a model first.")
+            return False
+        return True
+
+    def generate_response(self):
+        if not self.ready_to_generate():
             return
 
         prompt = self.prompt_entry.get()
         if not prompt:
             messagebox.showerror("Error", "Please enter a prompt.")
             return
+        self.send_message(prompt)
 
-        self.current_chat.messages.append({"role": "user", "content": prompt})
-        self.update_chat_display()
+    def prefill_key_of(self, chat, model, gpu):
+        return chat.creation_time, len(chat.messages), model, gpu, chat.instructions
+
+    def on_prompt_typed(self, event=None):
+        # With LLAMA_PREFILL the history is evaluated in the background as soon as a prompt is being typed, so
+        # that on submit only the new message is left to evaluate
+        chat = self.current_chat
+        model = self.model_var.get()
+        if chat is None or not self.backend_ready or model == 'Choose a model' or not self.prompt_entry.get():
+            return
+        gpu = self.gpu_var.get() if self.gpu_var.get() in self.gpus else "CPU"
+        key = self.prefill_key_of(chat, model, gpu)
+        if key == self.prefill_key:
+            return
+        self.prefill_key, self.prefill_result = key, None
+        # A snapshot, the history may grow on the Tk thread while the request runs
+        snapshot = ChatObject(chat.name, chat.messages.tolist(), instructions=chat.instructions,
+                              creation_time=chat.creation_time, options=dict(chat.options),
+                              kv_context=chat.kv_context)
+        self.executor.submit(self.prefill_async, snapshot, model, gpu, key)
+
+    def prefill_async(self, chat, model, gpu, key):
+        start = time.perf_counter()
+        try:
+            if self.backend_client is not None:
+                result = self.backend_client.prefill(chat, model, gpu)
+            else:
+                result = prefill_chat(chat, model, gpu, self.chat_memory.get_model_options(model))
+        except Exception as e:
+            print(f"Prefill failed: {e}")
+            return
+        result["wall_time"] = time.perf_counter() - start
+        self.after(0, self.on_prefill_done, key, result)
+
+    def on_prefill_done(self, key, result):
+        if key != self.prefill_key:
+            return  # The chat, model or history changed meanwhile
+        self.prefill_result = result
+        if result["prefilled"] == "history":
+            self.set_status(f"History evaluated ahead: {result.get('prompt_eval_count', 0)} tokens in "
+                            f"{result['wall_time'] * 1000:.0f} ms")
+
+    def prefill_metrics(self):
+        # How the history of the message being sent was prefilled, for the turn metrics
+        if not PREFILL:
+            return {}
+        key = self.prefill_key_of(self.current_chat, self.selected_model, self.selected_gpu)
+        if key != self.prefill_key:
+            return {"prefill": {"state": "none"}}
+        result = self.prefill_result
+        self.prefill_key, self.prefill_result = None, None
+        if result is None:
+            return {"prefill": {"state": "running"}}  # The request queues behind it on the server
+        return {"prefill": {"state": result["prefilled"], "prompt_eval_count": result.get("prompt_eval_count", 0),
+                            "wall_time_ms": round(result["wall_time"] * 1000, 1)}}
+
+    def send_message(self, prompt, extra_metrics=None):
+        # Adds the user message to the current chat and asks the selected model for the reply
+        extra_metrics = dict(extra_metrics or {}, **self.prefill_metrics())
+        # The reply goes to this chat with this model, even if another one is selected while it is generated
+        chat, model, gpu = self.current_chat, self.selected_model, self.selected_gpu
+        trace = self.tracer.start_trace("prompt", model=model, gpu=gpu, chat_id=chat.creation_time,
+                                        history_messages=len(chat.messages), prompt_chars=len(prompt))
+        chat.messages.append({"role": "user", "content": prompt})
+        self.generating.setdefault(chat.creation_time, [chat, 0])[1] += 1
+        with trace.span("render_prompt"):
+            self.update_chat_display()
 
-        self.executor.submit(self.fetch_response_async, prompt)
+        queued = trace.start_span("queue_wait")
+        self.executor.submit(self.fetch_response_async, chat, model, gpu, len(chat.messages), trace, queued,
+                             extra_metrics)
 
-    def fetch_response_async(self, prompt):
-        response, time_taken = get_response(self.current_chat, self.selected_model, self.selected_gpu)
-        self.after(0, self.update_ui_with_response, response, time_taken)
+    def run_code(self):
+        # Runs the Python blocks of the last reply, the output goes back to the model as the next message
+        if not self.ready_to_generate():
+            return
+        messages = self.current_chat.messages
+        blocks = runnable_blocks(messages[-1]["content"]) if messages and messages[-1]["role"] == "assistant" else []
+        if not blocks:
+            messagebox.showerror("Error", "The last reply has no Python code block to run.")
+            return
+        self.set_status(f"Running {len(blocks)} code block{'s' if len(blocks) > 1 else ''}...")
+        self.executor.submit(self.run_code_async, self.current_chat, blocks)
+
+    def run_code_async(self, chat, blocks):
+        results = [self.code_runner.run(code) for code in blocks]
+        self.after(0, self.on_code_results, chat, results)
+
+    def on_code_results(self, chat, results):
+        wall_time = sum(result["wall_time"] for result in results)
+        warm = all(result["warm"] for result in results)
+        print(f"Ran {len(results)} code blocks in {wall_time * 1000:.0f} ms "
+              f"({'warm' if warm else 'cold'} start, {max(result['start_latency'] for result in results) * 1000:.1f} ms)")
+        if chat is not self.current_chat:
+            self.set_status("Code output dropped, another chat was selected")
+            return
+        self.set_status(f"Code ran in {wall_time * 1000:.0f} ms, sending the output to {self.selected_model}")
+        # Stored with the reply to the output, durations in nanoseconds like Ollama's
+        metrics = {"code_execution": {
+            "blocks": len(results),
+            "duration": int(sum(result["duration"] or 0 for result in results) * 1e9),
+            "wall_time": int(wall_time * 1e9),
+            "start_latency": int(sum(result["start_latency"] for result in results) * 1e9),
+            "warm_start": warm,
+            "exit_codes": [result["exit_code"] for result in results],
+        }}
+        self.send_message(format_results(results), metrics)
+
+    def fetch_response_async(self, chat, model, gpu, message_count, trace=NULL_TRACE, queued=None,
+                             extra_metrics=None):
+        # message_count: length of the history with the prompt, which the reply is added after
+        trace.end_span(queued)
+        # Peak use of the server processes while this reply is generated
+        window = self.resource_monitor.begin_window() if self.resource_monitor is not None else None
+        try:
+            with trace.span("load_model_options"):
+                model_options = self.chat_memory.get_model_options(model)
+            first_piece = []
+            request_start = time.time_ns()
+
+            def on_piece(piece):
+                if not first_piece:
+                    first_piece.append(time.time_ns())
+                self.after(0, self.append_streamed_piece, chat, model, piece)
+
+            with trace.span("ollama_request", kind=SPAN_KIND_CLIENT,
+                            backend=type(self.backend_client).__name__ if self.backend_client else "local") as request:
+                if self.backend_client is not None:
+                    response, time_taken = self.backend_client.get_response(chat, model, gpu, on_piece)
+                else:
+                    retriever = self.document_index.retriever() if self.document_index is not None else None
+                    response, time_taken = get_response(chat, model, gpu, model_options, retriever, on_piece)
+                if first_piece and trace.sampled:
+                    request.set(time_to_first_piece_ms=round((first_piece[0] - request.start_ns) / 1e6, 1))
+        except Exception as e:
+            trace.finish(error=f"{type(e).__name__}: {e}")
+            print(f"Request to {model} failed: {type(e).__name__}: {e}")
+            self.after(0, self.on_response_failed, chat, message_count, e)
+            return
+        finally:
+            peaks = self.resource_monitor.end_window(window) if window is not None else None
+        trace.add_ollama_spans(request, response)
+        if peaks:
+            extra_metrics = dict(extra_metrics or {}, server_resources=peaks)
+        if first_piece:
+            extra_metrics = dict(extra_metrics or {},
+                                 time_to_first_token_ms=round((first_piece[0] - request_start) / 1e6, 1))
+        options = recorded_options(model_options, chat.options)
+        dispatch = trace.start_span("ui_dispatch")
+        self.after(0, self.update_ui_with_response, chat, model, message_count, response, time_taken, options, trace,
+                   dispatch, extra_metrics)
+
+    def update_ui_with_response(self, chat, model, message_count, response, time_taken, options=None,
+                                trace=NULL_TRACE, dispatch=None, extra_metrics=None):
+        trace.end_span(dispatch)
+        self.reply_done(chat)
+        if len(chat.messages) != message_count:
+            # Cleared (or changed) while the reply was generated, it no longer follows its prompt
+            self.set_status(f"Reply of {model} dropped, the chat changed meanwhile")
+            trace.finish(error="chat changed")
+            if chat is self.rendered_chat:
+                self.update_chat_display()
+            return
+        chat.messages.append({"role": "assistant", "content": response['message']['content']})
+        chat.reply_times.append(time_taken)
+        chat.addressed_models.append(model)
+        metrics = extract_turn_metrics(response, options)
+        metrics.update(extra_metrics or {})
+        chat.turn_metrics.append(metrics)
+        if chat is not self.current_chat:
+            self.set_status(f"Reply of {model} added to \"{chat.name}\"")
+        elif metrics.get("retrieved_chunks"):
+            self.set_status(f"Used {metrics['retrieved_chunks']} document excerpts, "
+                            f"retrieval took {metrics['retrieval_duration'] / 1e6:.0f} ms")
+        elif "time_to_first_token_ms" in metrics:
+            prefilled = metrics.get("prefill", {}).get("state") == "history"
+            self.set_status(f"First token after {metrics['time_to_first_token_ms']:.0f} ms"
+                            + (" (history evaluated ahead)" if prefilled else ""))
+        with trace.span("persist"):
+            self.chat_memory.update_chat(chat)  # Update chat in memory
+
+        render = trace.start_span("render")
+        if chat is self.rendered_chat:
+            self.update_chat_display()
+        if trace.sampled:
+            # The view draws on idle, this runs right after it
+            self.after_idle(self.finish_trace, trace, render, len(response['message']['content']))
+
+    def on_response_failed(self, chat, message_count, error):
+        # Takes back the prompt that got no reply, the streamed part of the reply goes with the redraw
+        self.reply_done(chat)
+        if len(chat.messages) == message_count and chat.messages[-1]["role"] == "user":
+            del chat.messages[-1]
+        if chat is self.rendered_chat:
+            self.update_chat_display()
+        self.set_status("Request failed")
+        messagebox.showerror("Error", f"Failed to get a response: {type(error).__name__}: {error}")
 
-    def update_ui_with_response(self, response, time_taken):
-        self.current_chat.messages.append({"role": "assistant", "content": response['message']['content']})
-        self.current_chat.reply_times.append(time_taken)
-        self.current_chat.addressed_models.append(self.selected_model)
-        self.chat_memory.update_chat(self.current_chat)  # Update chat in memory
+    def reply_done(self, chat):
+        entry = self.generating.get(chat.creation_time)
+        if entry is not None:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.generating[chat.creation_time]
 
-        self.update_chat_display()
-        self.chat_display.see(tk.END)
+    def finish_trace(self, trace, render, reply_chars):
+        trace.end_span(render)
+        trace.finish(reply_chars=reply_chars)
 
     def stop_ollama_server(self):
         if self.ollama_server:
@@ -502,11 +1278,53 @@ class LlamaDesktopApp(ctk.CTk):
                 print(f"Error terminating Ollama server process: {e}")
 
             self.ollama_server = None
+        for process in self.device_servers:
+            try:
+                terminate_with_children(process)
+            except Exception as e:
+                print(f"Error terminating device server process: {e}")
+        self.device_servers = []
     def on_closing(self):
+        for path in self.profiler.stop_all():
+            print(f"Profile written to {path}")
+        if self.watchdog is not None:
+            summary = self.watchdog.summary()
+            print(f"UI event loop: lag p50 <= {summary['lag_p50_ms']} ms, p99 <= {summary['lag_p99_ms']} ms, "
+                  f"max {summary['lag_max_ms']:.0f} ms, {summary['stalls']} stalls ({summary['stall_time_s']:.1f} s)")
+            self.watchdog.stop()
+        if self.resource_monitor is not None and self.resource_monitor.started:
+            stats = self.resource_monitor.stats()
+            print(f"Resource monitor: {stats['samples']} samples, {stats['overhead_percent']}% of the time sampling")
+            self.resource_monitor.stop()
+        self.discovery.stop()
+        self.code_runner.close()
+        if self.backend_client is not None:
+            self.backend_client.close()
+        if self.semantic_index is not None:
+            self.semantic_index.stop()
+        if self.document_index is not None:
+            self.document_index.stop()
+        get_ollama_pool().stop_health_checks()
         self.stop_ollama_server()
         self.destroy()
 
 if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--profile", action="append", choices=["cpu", "sample", "memory"], default=[],
+                        help="Profile from startup (reports are written on exit or from the Ctrl+Alt+P menu)")
+    parser.add_argument("--startup-report", nargs="?", const="-", metavar="PATH",
+                        help="Print the startup timeline once the window and the backend are ready, or write it as JSON")
+    parser.add_argument("--exit-after-startup", action="store_true", help="Quit once started (for benchmarks)")
+    args = parser.parse_args()
     app = LlamaDesktopApp()
+    app.startup_report = args.startup_report
+    app.exit_after_startup = args.exit_after_startup
+    if "cpu" in args.profile:
+        app.profiler.start_cpu()
+    if "sample" in args.profile:
+        app.profiler.start_sampling()
+    if "memory" in args.profile:
+        app.profiler.start_memory()
     app.protocol("WM_DELETE_WINDOW", app.on_closing)
     app.mainloop()
\ No newline at end of file
@@ -0,0 +1,120 @@
+"""
+Background model and hardware discovery with an on-disk cache.
+
+The cache has the same entries as `ollama list` (see models_json.json) but keyed by model digest
+(a digest maps to a list since several tags can point to the same weights),
+so the dropdowns can be filled instantly on startup and refreshed once the server answers.
+"""
+import json
+import os
+import threading
+import time
+
+DEFAULT_CACHE_PATH = "models_cache.json"
+DEFAULT_TTL = 24 * 3600  # Seconds before cached hardware info is probed again
+DEFAULT_POLL_INTERVAL = 15.0  # Seconds between model list refreshes (picks up newly pulled models)
+
+
+class DiscoveryCache:
+    def __init__(self, path: str = DEFAULT_CACHE_PATH):
+        self.path = path
+        self.data = {"models": {}, "models_updated_at": 0.0, "gpus": [], "gpus_updated_at": 0.0}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                loaded = json.load(f)
+        except (OSError, ValueError):
+            return  # Missing or corrupt cache just means a cold start
+        if isinstance(loaded, dict) and isinstance(loaded.get("models"), dict):
+            self.data.update(loaded)
+
+    def save(self):
+        # Write to a temporary file first so a crash never leaves a half written cache
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.data, f, indent=2)
+        os.replace(temp_path, self.path)
+
+    def model_names(self) -> list:
+        return sorted(entry["name"] for entries in self.data["models"].values() for entry in entries)
+
+    def is_fresh(self, key: str, ttl: float) -> bool:
+        return time.time() - self.data.get(f"{key}_updated_at", 0.0) < ttl
+
+
+class ModelDiscovery:
+    def __init__(self, pool, gpu_probe, cache_path: str = DEFAULT_CACHE_PATH, ttl: float = DEFAULT_TTL,
+                 poll_interval: float = DEFAULT_POLL_INTERVAL, on_models_changed=None, on_gpus_changed=None):
+        self.pool = pool
+        self.gpu_probe = gpu_probe  # Callable returning the GPU dropdown entries (slow: spawns nvidia-smi)
+        self.cache = DiscoveryCache(cache_path)
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+        self.on_models_changed = on_models_changed  # Called from the discovery thread with the model names
+        self.on_gpus_changed = on_gpus_changed
+        self._stop_event = threading.Event()
+        self._wake_event = threading.Event()
+        self._thread = None
+
+    def cached_models(self) -> list:
+        return self.cache.model_names()
+
+    def cached_gpus(self) -> list:
+        return self.cache.data["gpus"] or ["CPU"]
+
+    def refresh_gpus(self, force: bool = False):
+        if not force and self.cache.data["gpus"] and self.cache.is_fresh("gpus", self.ttl):
+            return False
+        gpus = self.gpu_probe()
+        changed = gpus != self.cache.data["gpus"]
+        self.cache.data["gpus"] = gpus
+        self.cache.data["gpus_updated_at"] = time.time()
+        self.cache.save()
+        if changed and self.on_gpus_changed:
+            self.on_gpus_changed(gpus)
+        return changed
+
+    def refresh_models(self) -> bool:
+        # Returns True when the server reported new or removed models
+        self.pool.check_all()
+        if not any(endpoint.healthy for endpoint in self.pool.endpoints):
+            return False  # Keep showing the cached list while the server is unreachable
+        entries = {}
+        for name, entry in self.pool.list_model_entries().items():
+            entries.setdefault(entry.get("digest") or name, []).append(entry)
+        names = sorted(entry["name"] for group in entries.values() for entry in group)
+        changed = names != self.cache.model_names()
+        self.cache.data["models"] = entries
+        self.cache.data["models_updated_at"] = time.time()
+        self.cache.save()
+        if changed and self.on_models_changed:
+            self.on_models_changed(self.cache.model_names())
+        return changed
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop_event.clear()
+
+        def loop():
+            self.refresh_gpus()
+            while not self._stop_event.is_set():
+                self.refresh_models()
+                self._wake_event.wait(self.poll_interval)
+                self._wake_event.clear()
+
+        self._thread = threading.Thread(target=loop, daemon=True)
+        self._thread.start()
+
+    def refresh_now(self):
+        # Wakes the discovery thread for an immediate model refresh (e.g. right after the server came up)
+        self._wake_event.set()
+
+    def stop(self):
+        self._stop_event.set()
+        self._wake_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=1.0)  # Daemon thread, don't hold up closing on a slow request
+            self._thread = None
@@ -0,0 +1,240 @@
+"""
+Pool of Ollama endpoints with health checks, model affinity and least-outstanding-requests routing.
+
+Endpoints are either remote hosts or local `ollama serve` instances pinned to one device each
+(the device must be selected in the server's environment, setting CUDA_VISIBLE_DEVICES in the
+client process has no effect on an already running server).
+"""
+import json
+import os
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.request
+from contextlib import contextmanager
+
+import httpx
+import ollama
+
+HEALTH_CHECK_TIMEOUT = 2.0
+LATENCY_SMOOTHING = 0.2  # Weight of the newest sample in the per endpoint latency moving average
+# Errors meaning the node itself is unreachable (depending on the ollama version, httpx errors leak through)
+TRANSPORT_ERRORS = (ConnectionError, OSError, httpx.TransportError)
+
+
+class OllamaEndpoint:
+    def __init__(self, url: str, device: str = None):
+        self.url = url.rstrip("/")
+        self.device = device  # Device the server was started on, None for remote / unpinned servers
+        self.client = ollama.Client(host=self.url)
+        self.healthy = True  # Optimistic until the first health check says otherwise
+        self.outstanding = 0
+        self.loaded_models = set()
+        self.available_models = []
+        self.model_entries = {}  # name -> /api/tags entry (digest, size, details...)
+        self.latency = None  # Moving average of request latency in seconds
+        self.requests = 0
+        self.failures = 0
+        self.last_check = 0.0
+
+    def record_latency(self, seconds: float):
+        self.requests += 1
+        if self.latency is None:
+            self.latency = seconds
+        else:
+            self.latency = LATENCY_SMOOTHING * seconds + (1 - LATENCY_SMOOTHING) * self.latency
+
+    def stats(self) -> dict:
+        return {
+            "url": self.url,
+            "device": self.device,
+            "healthy": self.healthy,
+            "outstanding": self.outstanding,
+            "loaded_models": sorted(self.loaded_models),
+            "latency": self.latency,
+            "requests": self.requests,
+            "failures": self.failures,
+        }
+
+
+def _get_json(url: str, timeout: float = HEALTH_CHECK_TIMEOUT):
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        return json.loads(response.read().decode("utf-8"))
+
+
+class NoHealthyEndpointError(RuntimeError):
+    pass
+
+
+class OllamaPool:
+    def __init__(self, endpoints: list, health_interval: float = 10.0):
+        self.endpoints = endpoints
+        self.health_interval = health_interval
+        self.lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._health_thread = None
+
+    @classmethod
+    def from_urls(cls, urls: list, devices: list = None, **kwargs):
+        devices = devices if devices is not None else [None] * len(urls)
+        return cls([OllamaEndpoint(url, device) for url, device in zip(urls, devices)], **kwargs)
+
+    def add_endpoint(self, endpoint: OllamaEndpoint):
+        with self.lock:
+            self.endpoints.append(endpoint)
+
+    # ---- health ----
+    def check_endpoint(self, endpoint: OllamaEndpoint):
+        try:
+            tags = _get_json(f"{endpoint.url}/api/tags")
+            running = _get_json(f"{endpoint.url}/api/ps")
+        except (urllib.error.URLError, OSError, ValueError):
+            healthy, entries, loaded = False, endpoint.model_entries, set()
+        else:
+            healthy = True
+            entries = {model["name"]: model for model in tags.get("models", [])}
+            loaded = {model["name"] for model in running.get("models", [])}
+        with self.lock:
+            endpoint.healthy = healthy
+            endpoint.model_entries = entries
+            endpoint.available_models = list(entries)
+            endpoint.loaded_models = loaded
+            endpoint.last_check = time.time()
+        return healthy
+
+    def check_all(self):
+        threads = [threading.Thread(target=self.check_endpoint, args=(endpoint,), daemon=True)
+                   for endpoint in self.endpoints]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return [endpoint.healthy for endpoint in self.endpoints]
+
+    def start_health_checks(self):
+        if self._health_thread is not None:
+            return
+        self._stop_event.clear()
+
+        def loop():
+            while not self._stop_event.is_set():
+                self.check_all()
+                self._stop_event.wait(self.health_interval)
+
+        self._health_thread = threading.Thread(target=loop, daemon=True)
+        self._health_thread.start()
+
+    def stop_health_checks(self):
+        self._stop_event.set()
+        if self._health_thread is not None:
+            self._health_thread.join()
+            self._health_thread = None
+
+    # ---- routing ----
+    def list_models(self) -> list:
+        with self.lock:
+            models = []
+            for endpoint in self.endpoints:
+                if endpoint.healthy:
+                    models.extend(name for name in endpoint.available_models if name not in models)
+            return models
+
+    def list_model_entries(self) -> dict:
+        # Merged /api/tags entries of all healthy endpoints, name -> entry
+        with self.lock:
+            entries = {}
+            for endpoint in self.endpoints:
+                if endpoint.healthy:
+                    for name, entry in endpoint.model_entries.items():
+                        entries.setdefault(name, entry)
+            return entries
+
+    def _pick(self, model: str, device: str = None, exclude=()) -> OllamaEndpoint:
+        candidates = [endpoint for endpoint in self.endpoints if endpoint.healthy and endpoint not in exclude]
+        if not candidates:
+            # Nothing passed its last check or survived its last request: try the others anyway instead of failing
+            # every request until the next health check (or forever without a health thread). A request that
+            # succeeds marks its endpoint healthy again
+            candidates = [endpoint for endpoint in self.endpoints if endpoint not in exclude]
+        if device is not None:
+            pinned = [endpoint for endpoint in candidates if endpoint.device == device]
+            candidates = pinned or candidates
+        # Only consider nodes that serve the model, when we know what they serve
+        serving = [endpoint for endpoint in candidates if not endpoint.available_models or model in endpoint.available_models]
+        candidates = serving or candidates
+        if not candidates:
+            raise NoHealthyEndpointError("No Ollama endpoint left to try")
+
+        def score(endpoint):
+            # Model already loaded first (avoids a load), then fewest requests in flight, then fastest
+            return (model not in endpoint.loaded_models,
+                    endpoint.outstanding,
+                    endpoint.latency if endpoint.latency is not None else 0.0)
+
+        return min(candidates, key=score)
+
+    @contextmanager
+    def lease(self, model: str, device: str = None, exclude=()):
+        with self.lock:
+            endpoint = self._pick(model, device, exclude)
+            endpoint.outstanding += 1
+        start = time.perf_counter()
+        try:
+            yield endpoint
+        except TRANSPORT_ERRORS + (ollama.ResponseError,) as e:
+            with self.lock:
+                endpoint.failures += 1
+                if not isinstance(e, ollama.ResponseError):
+                    endpoint.healthy = False  # Health checks or a later successful request bring it back
+            raise
+        else:
+            with self.lock:
+                endpoint.record_latency(time.perf_counter() - start)
+                endpoint.loaded_models.add(model)
+                endpoint.healthy = True
+        finally:
+            with self.lock:
+                endpoint.outstanding -= 1
+
+    def request(self, model: str, call, device: str = None, retries: int = 1):
+        # Runs call(client) on the best endpoint, retrying on another endpoint if the node is unreachable.
+        # Meant for non streaming calls, streaming callers should hold a lease() while consuming the stream
+        tried = []
+        last_error = None
+        for _ in range(retries + 1):
+            try:
+                with self.lease(model, device, exclude=tried) as endpoint:
+                    tried.append(endpoint)
+                    return call(endpoint.client)
+            except TRANSPORT_ERRORS as e:
+                last_error = e
+            except NoHealthyEndpointError:
+                if last_error is None:
+                    raise
+                break
+        raise last_error
+
+    def chat(self, model: str, messages: list, device: str = None, **kwargs):
+        return self.request(model, lambda client: client.chat(model=model, messages=messages, **kwargs), device)
+
+    def generate(self, model: str, device: str = None, **kwargs):
+        return self.request(model, lambda client: client.generate(model=model, **kwargs), device)
+
+    def stats(self) -> list:
+        with self.lock:
+            return [endpoint.stats() for endpoint in self.endpoints]
+
+
+def start_device_servers(devices: list, base_port: int, command_factory=None):
+    """Spawns one server per device, each bound to its own port. Returns (urls, processes)."""
+    command_factory = command_factory if command_factory is not None else (lambda address: ["ollama", "serve"])
+    urls, processes = [], []
+    for index, device in enumerate(devices):
+        address = f"127.0.0.1:{base_port + index}"
+        visible_devices = "-1" if str(device).upper() == "CPU" else str(device)  # "-1" hides every GPU
+        env = dict(os.environ, OLLAMA_HOST=address, CUDA_VISIBLE_DEVICES=visible_devices)
+        processes.append(subprocess.Popen(command_factory(address), env=env,
+                                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+        urls.append(f"http://{address}")
+    return urls, processes
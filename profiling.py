@@ -0,0 +1,192 @@
+"""
+On-demand profiling of a running app, every part can be started and stopped at any time.
+
+- CPU (cProfile): deterministic profile of the Tk thread, where UI work runs. Written as a .prof file
+  (pstats, snakeviz) plus a text summary.
+- Sampling: a thread samples the stacks of all threads every `sample_interval` seconds, so inference, storage
+  and indexing workers show up too. Written as collapsed stacks (flamegraph.pl, speedscope) plus a summary.
+- Memory (tracemalloc + gc): every snapshot is diffed against the previous one, by allocation site and by the
+  number of live objects per type, which shows leaked windows or retained chats growing between snapshots.
+
+Reports go to `directory` with a timestamp in their name.
+"""
+import cProfile
+import gc
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+TOP_ENTRIES = 40  # Lines per section in the text reports
+
+
+def type_counts() -> Counter:
+    counts = Counter()
+    for obj in gc.get_objects():
+        cls = type(obj)
+        counts[f"{cls.__module__}.{cls.__qualname__}"] += 1
+    return counts
+
+
+class Profiler:
+    def __init__(self, directory: str = "profiles", sample_interval: float = 0.005):
+        self.directory = directory
+        self.sample_interval = sample_interval
+        self.cpu_profile = None
+        self.sampler = None
+        self.sampling = False
+        self.samples = Counter()  # Collapsed stack -> number of samples
+        self.sample_count = 0
+        self.memory_snapshot = None  # Previous tracemalloc snapshot
+        self.memory_types = None  # Previous live object counts per type
+        self.lock = threading.Lock()
+
+    def report_path(self, kind: str, extension: str) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        return os.path.join(self.directory, f"{kind}-{stamp}-{os.getpid()}.{extension}")
+
+    @property
+    def cpu_running(self) -> bool:
+        return self.cpu_profile is not None
+
+    @property
+    def memory_running(self) -> bool:
+        return tracemalloc.is_tracing()
+
+    # ---- cProfile ----
+    def start_cpu(self):
+        # Profiles the calling thread only, call it from the Tk thread
+        if self.cpu_profile is None:
+            self.cpu_profile = cProfile.Profile()
+            self.cpu_profile.enable()
+
+    def stop_cpu(self) -> str:
+        if self.cpu_profile is None:
+            return None
+        profile, self.cpu_profile = self.cpu_profile, None
+        profile.disable()
+        path = self.report_path("cpu", "prof")
+        profile.dump_stats(path)
+        summary = io.StringIO()
+        stats = pstats.Stats(profile, stream=summary).strip_dirs()
+        stats.sort_stats("cumulative").print_stats(TOP_ENTRIES)
+        stats.sort_stats("tottime").print_stats(TOP_ENTRIES)
+        with open(path[:-len(".prof")] + ".txt", "w", encoding="utf-8") as f:
+            f.write(summary.getvalue())
+        return path
+
+    # ---- sampling ----
+    def start_sampling(self):
+        if self.sampling:
+            return
+        self.sampling = True
+        self.samples = Counter()
+        self.sample_count = 0
+        self.sampler = threading.Thread(target=self.sample_loop, daemon=True)
+        self.sampler.start()
+
+    def sample_loop(self):
+        own = threading.get_ident()
+        while self.sampling:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                with self.lock:
+                    self.samples[";".join(reversed(stack))] += 1
+            self.sample_count += 1
+            time.sleep(self.sample_interval)
+
+    def stop_sampling(self) -> str:
+        if not self.sampling:
+            return None
+        self.sampling = False
+        self.sampler.join(timeout=1.0)
+        with self.lock:
+            samples = self.samples
+        path = self.report_path("samples", "collapsed")
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in samples.most_common():
+                f.write(f"{stack} {count}\n")
+        # Summary: where threads spend their time (own frame) and what they are inside of (any frame)
+        own_time, inclusive = Counter(), Counter()
+        for stack, count in samples.items():
+            frames = stack.split(";")
+            thread = frames[0]
+            own_time[f"{thread}: {frames[-1]}"] += count
+            for frame in set(frames[1:]):
+                inclusive[f"{thread}: {frame}"] += count
+        total = max(1, self.sample_count)
+        with open(path[:-len(".collapsed")] + ".txt", "w", encoding="utf-8") as f:
+            f.write(f"{self.sample_count} samples every {self.sample_interval * 1000:.0f} ms\n\nSelf (% of samples):\n")
+            for name, count in own_time.most_common(TOP_ENTRIES):
+                f.write(f"{100 * count / total:6.1f}%  {name}\n")
+            f.write("\nInclusive (% of samples):\n")
+            for name, count in inclusive.most_common(TOP_ENTRIES):
+                f.write(f"{100 * count / total:6.1f}%  {name}\n")
+        return path
+
+    # ---- memory ----
+    def start_memory(self, frames: int = 25):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+            self.memory_snapshot = self.take_snapshot()
+            self.memory_types = type_counts()
+
+    def take_snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*"),
+        ])
+
+    def snapshot_memory(self) -> str:
+        # Diffs against the previous snapshot (or the start of tracing) and writes the report
+        if not tracemalloc.is_tracing():
+            self.start_memory()
+        snapshot = self.take_snapshot()
+        types = type_counts()
+        current, peak = tracemalloc.get_traced_memory()
+        path = self.report_path("memory", "txt")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(f"Traced memory: {current / 1e6:.1f} MB (peak {peak / 1e6:.1f} MB)\n")
+            f.write("\nGrowth by allocation site since the previous snapshot:\n")
+            for stat in snapshot.compare_to(self.memory_snapshot, "lineno")[:TOP_ENTRIES]:
+                f.write(f"{stat}\n")
+            f.write("\nLive objects per type, change since the previous snapshot:\n")
+            growth = Counter({name: count - self.memory_types.get(name, 0) for name, count in types.items()})
+            for name, delta in growth.most_common(TOP_ENTRIES):
+                if delta <= 0:
+                    break
+                f.write(f"{delta:+8d}  {types[name]:8d}  {name}\n")
+            f.write("\nLargest allocation sites (traceback):\n")
+            for stat in snapshot.statistics("traceback")[:5]:
+                f.write(f"{stat.size / 1e6:.1f} MB in {stat.count} blocks\n")
+                for line in stat.traceback.format(limit=10):
+                    f.write(f"{line}\n")
+        snapshot.dump(path[:-len(".txt")] + ".tracemalloc")  # For offline comparison with tracemalloc.Snapshot.load
+        self.memory_snapshot, self.memory_types = snapshot, types
+        return path
+
+    def stop_memory(self):
+        tracemalloc.stop()
+        self.memory_snapshot = self.memory_types = None
+
+    def stop_all(self) -> list:
+        # Writes the reports of whatever is still running
+        paths = [self.stop_cpu(), self.stop_sampling()]
+        if tracemalloc.is_tracing():
+            paths.append(self.snapshot_memory())
+            self.stop_memory()
+        return [path for path in paths if path]
@@ -0,0 +1,224 @@
+"""
+Resource monitor for the Ollama server processes.
+
+A background thread samples the server processes every `interval` seconds: the ones the app started, or the
+running `ollama` processes when it reused a server (or a worker process started it), each with all of its
+children (the model runners). CPU percent (100 = one core), RSS and thread counts are summed over the trees.
+When nvidia-smi is on the PATH, GPU utilization and memory are read every `gpu_interval` seconds, as it is a
+subprocess and much more expensive, with the memory of the server's own processes when the driver reports it.
+
+Listeners get every sample. A window (begin_window / end_window) collects the peak values over a span of time,
+e.g. one generation.
+
+The sampler keeps its own cost bounded: a sample that takes longer than a tenth of the interval stretches the
+wait before the next one, so the sampling thread is busy at most about 10% of the time. Its busy time is
+reported as overhead_percent.
+"""
+import shutil
+import subprocess
+import threading
+import time
+
+SERVER_NAMES = {"ollama", "ollama.exe", "ollama_llama_server", "ollama_llama_server.exe"}
+RESCAN_INTERVAL = 10.0  # Seconds between searches for running servers when the app didn't start them
+MAX_BUSY_FRACTION = 0.1  # Share of the time the sampler may spend sampling
+GPU_FIELDS = ("gpu_utilization", "gpu_memory_mb", "server_gpu_memory_mb")
+
+
+def query_nvidia_smi(timeout: float = 2.0) -> dict:
+    # {"gpu_utilization" (busiest GPU), "gpu_memory_mb", "gpu_memory_total_mb" (all GPUs), "memory_by_pid"},
+    # {} when nvidia-smi fails
+    try:
+        gpus = subprocess.run(["nvidia-smi", "--query-gpu=utilization.gpu,memory.used,memory.total",
+                               "--format=csv,noheader,nounits"], capture_output=True, text=True, timeout=timeout)
+        apps = subprocess.run(["nvidia-smi", "--query-compute-apps=pid,used_memory", "--format=csv,noheader,nounits"],
+                              capture_output=True, text=True, timeout=timeout)
+    except (OSError, subprocess.TimeoutExpired):
+        return {}
+    if gpus.returncode != 0:
+        return {}
+    rows = [[field.strip() for field in line.split(",")] for line in gpus.stdout.strip().splitlines() if line.strip()]
+    try:
+        result = {"gpu_utilization": max(float(row[0]) for row in rows),
+                  "gpu_memory_mb": sum(float(row[1]) for row in rows),
+                  "gpu_memory_total_mb": sum(float(row[2]) for row in rows)}
+    except (ValueError, IndexError):  # [N/A] fields on some GPUs, or no GPU at all
+        return {}
+    memory_by_pid = {}
+    if apps.returncode == 0:
+        for line in apps.stdout.strip().splitlines():
+            try:
+                pid, memory = (field.strip() for field in line.split(","))
+                memory_by_pid[int(pid)] = memory_by_pid.get(int(pid), 0.0) + float(memory)
+            except ValueError:
+                continue
+    result["memory_by_pid"] = memory_by_pid
+    return result
+
+
+class ResourceMonitor:
+    def __init__(self, interval: float = 1.0, gpu_interval: float = 5.0, server_pids=None):
+        # server_pids() -> pids of the servers the app started, [] to look for running ones
+        self.interval = interval
+        self.gpu_interval = gpu_interval
+        self.server_pids = server_pids or (lambda: [])
+        self.nvidia_smi = gpu_interval > 0 and shutil.which("nvidia-smi") is not None
+        self.processes = {}  # pid -> psutil.Process, kept so cpu_percent measures since the previous sample
+        self.found_pids, self.found_time = [], 0.0
+        self.gpu, self.gpu_time = {}, 0.0
+        self.latest = None
+        self.listeners = []
+        self.windows = {}  # window id -> (start time, peaks)
+        self.window_ids = 0
+        self.sample_count = 0
+        self.busy = 0.0  # Seconds spent sampling
+        self.started = None
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def add_listener(self, listener):
+        # listener(sample) runs on the sampler thread
+        self.listeners.append(listener)
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout=2.0)
+
+    def run(self):
+        while not self.stop_event.is_set():
+            start = time.perf_counter()
+            try:
+                sample = self.sample()
+            except Exception as e:
+                print(f"Resource monitor sample failed: {e}")
+                sample = None
+            duration = time.perf_counter() - start
+            if sample is not None:
+                for listener in self.listeners:
+                    listener(sample)
+            self.stop_event.wait(max(self.interval, duration / MAX_BUSY_FRACTION) - duration)
+
+    def root_pids(self) -> list:
+        pids = [pid for pid in self.server_pids() if pid]
+        if pids:
+            return pids
+        now = time.monotonic()
+        if not self.found_pids or now - self.found_time > RESCAN_INTERVAL:
+            import psutil
+            self.found_time = now
+            found = [process.info["pid"] for process in psutil.process_iter(["pid", "name"])
+                     if (process.info["name"] or "").lower() in SERVER_NAMES]
+            # Runners are children of the server, count each tree once
+            self.found_pids = [pid for pid in found if not self._has_ancestor_in(pid, set(found))]
+        return self.found_pids
+
+    def _has_ancestor_in(self, pid: int, pids: set) -> bool:
+        import psutil
+        try:
+            return any(parent.pid in pids for parent in psutil.Process(pid).parents())
+        except psutil.Error:
+            return False
+
+    def _process(self, pid: int):
+        import psutil
+        process = self.processes.get(pid)
+        if process is None:
+            process = self.processes[pid] = psutil.Process(pid)
+            process.cpu_percent(None)  # The first call only sets the starting point
+        return process
+
+    def sample(self) -> dict:
+        """
+        Samples the server processes now. Returns {"time", "processes", "cpu_percent", "rss_mb", "threads"} plus
+        "gpu_utilization", "gpu_memory_mb", "gpu_memory_total_mb", "server_gpu_memory_mb" (if reported) and
+        "gpu_time" when nvidia-smi is available (the GPU fields can be up to gpu_interval old).
+        """
+        import psutil
+        start = time.perf_counter()
+        with self.lock:
+            totals = {"time": time.time(), "processes": 0, "cpu_percent": 0.0, "rss_mb": 0.0, "threads": 0}
+            seen = set()
+            for root_pid in self.root_pids():
+                try:
+                    tree = [self._process(root_pid)] + self._process(root_pid).children(recursive=True)
+                except psutil.Error:
+                    continue
+                for member in tree:
+                    if member.pid in seen:
+                        continue
+                    seen.add(member.pid)
+                    try:
+                        process = self._process(member.pid)
+                        with process.oneshot():
+                            cpu = process.cpu_percent(None)
+                            rss = process.memory_info().rss
+                            threads = process.num_threads()
+                    except psutil.Error:
+                        continue
+                    totals["processes"] += 1
+                    totals["cpu_percent"] += cpu
+                    totals["rss_mb"] += rss / (1 << 20)
+                    totals["threads"] += threads
+            for pid in set(self.processes) - seen:
+                del self.processes[pid]  # Exited
+            totals["cpu_percent"] = round(totals["cpu_percent"], 1)
+            totals["rss_mb"] = round(totals["rss_mb"], 1)
+
+            if self.nvidia_smi and time.monotonic() - self.gpu_time >= self.gpu_interval:
+                self.gpu, self.gpu_time = query_nvidia_smi(), time.monotonic()
+                if self.gpu:
+                    self.gpu["time"] = totals["time"]
+            if self.gpu:
+                totals.update((field, self.gpu[field]) for field in ("gpu_utilization", "gpu_memory_mb",
+                                                                     "gpu_memory_total_mb"))
+                if self.gpu["memory_by_pid"]:
+                    totals["server_gpu_memory_mb"] = sum(memory for pid, memory in self.gpu["memory_by_pid"].items()
+                                                         if pid in seen)
+                totals["gpu_time"] = self.gpu["time"]
+
+            for window_start, peaks in self.windows.values():
+                self._add_peaks(peaks, totals, window_start)
+            self.latest = totals
+            self.sample_count += 1
+            self.busy += time.perf_counter() - start
+        return totals
+
+    def _add_peaks(self, peaks: dict, sample: dict, window_start: float):
+        peaks["samples"] = peaks.get("samples", 0) + 1
+        for field in ("cpu_percent", "rss_mb", "threads", "processes"):
+            peaks[field] = max(peaks.get(field, 0), sample[field])
+        # GPU readings taken before the window started don't belong to it
+        if sample.get("gpu_time", 0) >= window_start:
+            for field in GPU_FIELDS:
+                if field in sample:
+                    peaks[field] = max(peaks.get(field, 0), sample[field])
+
+    def begin_window(self) -> int:
+        with self.lock:
+            self.window_ids += 1
+            self.windows[self.window_ids] = (time.time(), {})
+            return self.window_ids
+
+    def end_window(self, window: int) -> dict:
+        # Peak values seen since begin_window, sampled once now if the window was too short for a sample
+        with self.lock:
+            _, peaks = self.windows[window]
+            needs_sample = not peaks
+        if needs_sample:
+            self.sample()
+        with self.lock:
+            _, peaks = self.windows.pop(window)
+        return peaks
+
+    def stats(self) -> dict:
+        elapsed = time.perf_counter() - self.started if self.started else 0.0
+        return {"samples": self.sample_count, "busy_seconds": round(self.busy, 3),
+                "overhead_percent": round(100 * self.busy / elapsed, 2) if elapsed else 0.0}
@@ -0,0 +1,455 @@
+"""
+Semantic search over chat history.
+
+Messages are embedded through Ollama in background batches. Vectors are normalized and appended to a
+float16 file read back through a NumPy memory map; which chat/message a vector row belongs to is kept in
+the `message_vectors` table of the ChatMemory database.
+
+Converting a large float16 matrix for a full scan is too slow for interactive search, so every vector also
+gets a 1 bit per dimension sign code. A query ranks all rows by Hamming distance on the codes and only the
+closest candidates are rescored exactly from the float16 vectors.
+
+Deleting a chat only drops its rows from the table; once the unreferenced rows outnumber the live ones the
+files are rewritten without them (compact). The copy is made without holding the locks the ChatMemory listeners
+take, only the swap to the new files and row numbers waits for searches.
+"""
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+DEFAULT_EMBED_MODEL = os.environ.get("OLLAMA_EMBED_MODEL", "nomic-embed-text:latest")
+MAX_EMBED_CHARS = 4000  # Longer messages are embedded by their beginning
+RESCORE_CANDIDATES = 2000  # Rows rescored exactly after the Hamming prefilter
+COMPACT_MIN_ROWS = 10000  # Unreferenced rows tolerated in the vector file before it is compacted
+COPY_ROWS = 65536  # Rows copied at a time while compacting
+COMPACT = "compact"  # Queue item asking the worker to compact the vector file
+POPCOUNT_TABLE = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+
+
+def sign_codes(vectors: np.ndarray) -> np.ndarray:
+    # Packs the sign of every dimension, padded to whole uint64 words
+    codes = np.packbits(np.asarray(vectors) > 0, axis=1)
+    padding = (-codes.shape[1]) % 8
+    if padding:
+        codes = np.pad(codes, ((0, 0), (0, padding)))
+    return codes
+
+
+def hamming_distances(codes: np.ndarray, query_code: np.ndarray) -> np.ndarray:
+    if hasattr(np, "bitwise_count"):  # numpy >= 2.0
+        return np.bitwise_count(codes.view(np.uint64) ^ query_code.view(np.uint64)).sum(axis=1, dtype=np.int32)
+    return POPCOUNT_TABLE[codes ^ query_code].sum(axis=1, dtype=np.int32)
+
+
+class VectorStore:
+    """Append only float16 matrix on disk, read through a memory map."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.codes_path = f"{path}.bits"
+        self.info_path = f"{path}.json"
+        self.dim = None
+        self.model = None
+        self._maps = {}  # path -> (rows, memmap)
+        if os.path.exists(self.info_path):
+            with open(self.info_path, 'r', encoding='utf-8') as f:
+                info = json.load(f)
+            self.dim, self.model = info["dim"], info["model"]
+
+    def count(self) -> int:
+        if self.dim is None or not os.path.exists(self.path):
+            return 0
+        return os.path.getsize(self.path) // (self.dim * 2)
+
+    def append(self, vectors: np.ndarray, model: str) -> int:
+        # Returns the row number of the first appended vector
+        if self.dim is None:
+            self.dim, self.model = vectors.shape[1], model
+            with open(self.info_path, 'w', encoding='utf-8') as f:
+                json.dump({"dim": self.dim, "model": self.model}, f)
+        first_row = self.count()
+        # Codes first: count() is derived from the vector file, so readers never see a row without its code
+        with open(self.codes_path, 'ab') as f:
+            f.write(sign_codes(vectors).tobytes())
+        with open(self.path, 'ab') as f:
+            f.write(np.ascontiguousarray(vectors, dtype=np.float16).tobytes())
+        return first_row
+
+    def code_bytes(self) -> int:
+        return ((self.dim + 63) // 64) * 8
+
+    def _map(self, path, dtype, width, rows):
+        cached = self._maps.get(path)
+        if cached is None or cached[0] != rows:
+            cached = (rows, np.memmap(path, dtype=dtype, mode='r', shape=(rows, width)))
+            self._maps[path] = cached
+        return cached[1]
+
+    def matrix(self) -> np.ndarray:
+        rows = self.count()
+        if rows == 0:
+            return np.zeros((0, self.dim or 0), dtype=np.float16)
+        return self._map(self.path, np.float16, self.dim, rows)
+
+    def codes(self, rows: int) -> np.ndarray:
+        return self._map(self.codes_path, np.uint8, self.code_bytes(), rows)
+
+    def write_rows(self, rows: np.ndarray):
+        # Copies the given rows (in that order) next to the files, replace_with_rows() then swaps them in.
+        # Reads through its own maps, searches keep using the cached ones meanwhile
+        count = self.count()
+        for path, dtype, width in ((self.codes_path, np.uint8, self.code_bytes()),
+                                   (self.path, np.float16, self.dim)):
+            source = np.memmap(path, dtype=dtype, mode='r', shape=(count, width))
+            with open(f"{path}.tmp", 'wb') as f:
+                for first in range(0, len(rows), COPY_ROWS):
+                    f.write(np.ascontiguousarray(source[rows[first:first + COPY_ROWS]]).tobytes())
+            del source
+
+    def replace_with_rows(self):
+        self._maps = {}  # Open maps would keep the old files (and block replacing them on Windows)
+        # Codes first, as in append: count() follows the vector file
+        os.replace(f"{self.codes_path}.tmp", self.codes_path)
+        os.replace(f"{self.path}.tmp", self.path)
+
+    def discard_rows(self):
+        for path in (self.codes_path, self.path):
+            if os.path.exists(f"{path}.tmp"):
+                os.remove(f"{path}.tmp")
+
+    def clear(self):
+        self._maps = {}
+        for path in (self.path, self.codes_path, self.info_path):
+            if os.path.exists(path):
+                os.remove(path)
+        self.dim = self.model = None
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class SemanticIndex:
+    def __init__(self, embed_fn, db_path='chats.db', vectors_path='chat_vectors.f16',
+                 model: str = DEFAULT_EMBED_MODEL, batch_size: int = 32):
+        self.embed_fn = embed_fn  # embed_fn(texts, model) -> list of vectors
+        self.db_path = db_path
+        self.model = model
+        self.batch_size = batch_size
+        self.store = VectorStore(vectors_path)
+        self.lock = threading.Lock()  # Serializes writers (vector file + table) and guards the queue state
+        self.rows_lock = threading.Lock()  # Held by searches and the compaction swap, row numbers don't move inside
+        self._resets = 0  # Bumped by reset, a compaction started before one is discarded
+        self.queue = queue.Queue()
+        self._queued = {}  # chat id -> next message index already queued
+        # chat id -> generation, bumped when the chat's rows are dropped so that its items still in the queue
+        # (with the generation they were queued with) are not written
+        self._generations = {}
+        self._thread = None
+        self._initialize_database()
+        if self.store.model is not None and self.store.model != model:
+            self.reset()  # Vectors from another embedding model are not comparable
+        self.dead_rows = self.store.count() - self._live_rows()
+
+    def _initialize_database(self):
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS message_vectors (
+                row_id INTEGER PRIMARY KEY,  -- Row in the vector file
+                chat_id TEXT NOT NULL,
+                message_index INTEGER NOT NULL
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS message_vectors_chat ON message_vectors (chat_id, message_index)')
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'indexed_chats'")
+        migrate = cursor.fetchone() is None
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS indexed_chats (
+                chat_id TEXT PRIMARY KEY,
+                message_count INTEGER NOT NULL  -- Messages 0 .. message_count - 1 are indexed
+            )
+        ''')
+        if migrate:  # Indexes built before the table existed
+            cursor.execute('''
+                INSERT INTO indexed_chats (chat_id, message_count)
+                SELECT chat_id, MAX(message_index) + 1 FROM message_vectors GROUP BY chat_id
+            ''')
+        conn.commit()
+        conn.close()
+
+    def reset(self):
+        with self.lock, self.rows_lock:
+            conn = sqlite3.connect(self.db_path)
+            conn.execute('DELETE FROM message_vectors')
+            conn.execute('DELETE FROM indexed_chats')
+            conn.commit()
+            conn.close()
+            self.store.clear()
+            self._resets += 1
+            for chat_id in set(self._queued) | set(self._generations):
+                self._forget(chat_id)
+            self.dead_rows = 0
+
+    def _live_rows(self) -> int:
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('SELECT COUNT(*) FROM message_vectors')
+        count = cursor.fetchone()[0]
+        conn.close()
+        return count
+
+    def _forget(self, chat_id: str):
+        # Caller holds the lock: the chat's queued items are dropped, its next update queues it again
+        self._queued.pop(chat_id, None)
+        self._generations[chat_id] = self._generations.get(chat_id, 0) + 1
+
+    # ---- indexing ----
+    def indexed_count(self, chat_id: str) -> int:
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('SELECT message_count FROM indexed_chats WHERE chat_id = ?', (chat_id,))
+        row = cursor.fetchone()
+        conn.close()
+        return 0 if row is None else row[0]
+
+    def indexed_counts(self) -> dict:
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('SELECT chat_id, message_count FROM indexed_chats')
+        counts = dict(cursor.fetchall())
+        conn.close()
+        return counts
+
+    def _enqueue(self, chat_id: str, count: int, read_messages, indexed: int = None):
+        # Queues messages start .. count - 1 of the chat that aren't indexed (or queued) yet,
+        # read_messages(start) returns them
+        with self.lock:
+            start = self._queued.get(chat_id)
+        if start is None:
+            start = self.indexed_count(chat_id) if indexed is None else indexed
+        if start > count:
+            # History got shorter (cleared), index it again from scratch
+            self.remove_chat(chat_id)
+            start = 0
+        if start == count:
+            return
+        with self.lock:
+            # Marked as queued before the items are, the worker drops items of chats that aren't
+            self._queued[chat_id] = count
+            generation = self._generations.get(chat_id, 0)
+        for index, message in enumerate(read_messages(start), start):
+            self.queue.put((chat_id, generation, index, message["content"][:MAX_EMBED_CHARS]))
+
+    def enqueue_chat(self, chat_object):
+        self._enqueue(chat_object.creation_time, len(chat_object.messages),
+                      lambda start: chat_object.messages[start:])
+
+    def catch_up(self, chat_memory):
+        # Queues the messages written before the index existed or while the app was closed. Only the message
+        # counts are compared, the messages missing from the index are read as a page
+        counts = chat_memory.list_message_counts()
+        indexed = self.indexed_counts()
+        for chat_id in set(indexed) - set(counts):
+            self.remove_chat(chat_id)  # Deleted while the index wasn't listening
+        for chat_id, count in counts.items():
+            if indexed.get(chat_id, 0) != count:
+                self._enqueue(chat_id, count, lambda start, chat_id=chat_id, count=count:
+                              chat_memory.get_message_page(chat_id, start, count - start),
+                              indexed.get(chat_id, 0))
+
+    def remove_chat(self, chat_id: str):
+        # Vector rows stay in the file but are no longer referenced, search skips them until the file is compacted.
+        # Forgotten first: a batch being written finishes under the lock and is deleted below, later ones are
+        # dropped. Deleting by chat id works the same before and after a compaction renumbers the rows
+        with self.lock:
+            self._forget(chat_id)
+        conn = sqlite3.connect(self.db_path)
+        removed = conn.execute('DELETE FROM message_vectors WHERE chat_id = ?', (chat_id,)).rowcount
+        conn.execute('DELETE FROM indexed_chats WHERE chat_id = ?', (chat_id,))
+        conn.commit()
+        conn.close()
+        with self.lock:
+            self.dead_rows += removed
+            if self._needs_compaction():
+                self.queue.put(COMPACT)
+
+    def _needs_compaction(self) -> bool:
+        return self.dead_rows > COMPACT_MIN_ROWS and self.dead_rows > self.store.count() - self.dead_rows
+
+    def compact(self):
+        """
+        Rewrites the vector files with only the referenced rows and renumbers them in the table. Runs on the
+        worker thread, the only one appending rows, so the file doesn't grow meanwhile. The copy and the row
+        mapping are made without the locks; chats deleted meanwhile only lose table rows, so they stay deleted
+        through the renumbering and their rows are counted for the next compaction.
+        """
+        with self.lock:
+            if not self.dead_rows:
+                return
+            dropped, resets = self.dead_rows, self._resets
+        start = time.perf_counter()
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('SELECT row_id FROM message_vectors ORDER BY row_id')
+        rows = [row[0] for row in cursor.fetchall()]
+        self.store.write_rows(np.array(rows, dtype=np.int64))
+        cursor.execute('CREATE TEMP TABLE compact_rows (old_row INTEGER PRIMARY KEY, new_row INTEGER NOT NULL)')
+        cursor.executemany('INSERT INTO compact_rows (old_row, new_row) VALUES (?, ?)',
+                           [(old_row, new_row) for new_row, old_row in enumerate(rows)])
+        conn.commit()
+        with self.rows_lock:
+            if resets != self._resets:  # The index was reset meanwhile, the copy is of rows that are gone
+                self.store.discard_rows()
+                conn.close()
+                return
+            # Through negative numbers, so that no new number collides with an old one still in the table
+            cursor.execute('''
+                UPDATE message_vectors
+                SET row_id = -1 - (SELECT new_row FROM compact_rows WHERE old_row = message_vectors.row_id)
+            ''')
+            cursor.execute('UPDATE message_vectors SET row_id = -1 - row_id')
+            conn.commit()
+            self.store.replace_with_rows()
+        conn.close()
+        with self.lock:
+            self.dead_rows -= dropped
+        print(f"Semantic index compacted: dropped {dropped} unreferenced rows, kept {len(rows)} "
+              f"in {time.perf_counter() - start:.2f}s")
+
+    def on_chat_changed(self, chat_id: str, chat_object=None):
+        # ChatMemory listener: chat_object is None when the chat was deleted
+        if chat_object is None:
+            self.remove_chat(chat_id)
+        else:
+            self.enqueue_chat(chat_object)
+
+    def pending(self) -> int:
+        return self.queue.qsize()
+
+    def _next_batch(self) -> list:
+        batch = [self.queue.get()]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _current(self, item) -> bool:
+        # Caller holds the lock: False for items of a chat removed (or failed) since they were queued
+        chat_id, generation, _, _ = item
+        return chat_id in self._queued and self._generations.get(chat_id, 0) == generation
+
+    def _index_batch(self, batch: list):
+        with self.lock:
+            batch = [item for item in batch if self._current(item)]
+        if not batch:
+            return
+        vectors = normalize(self.embed_fn([text for _, _, _, text in batch], self.model))
+        with self.lock:
+            # Drop items whose chat was removed while they were being embedded
+            keep = [i for i, item in enumerate(batch) if self._current(item)]
+            if not keep:
+                return
+            first_row = self.store.append(vectors[keep], self.model)
+            counts = {}
+            for i in keep:
+                counts[batch[i][0]] = max(counts.get(batch[i][0], 0), batch[i][2] + 1)
+            conn = sqlite3.connect(self.db_path)
+            conn.executemany('INSERT INTO message_vectors (row_id, chat_id, message_index) VALUES (?, ?, ?)',
+                             [(first_row + offset, batch[i][0], batch[i][2]) for offset, i in enumerate(keep)])
+            conn.executemany('''
+                INSERT INTO indexed_chats (chat_id, message_count) VALUES (?, ?)
+                ON CONFLICT (chat_id) DO UPDATE SET message_count = MAX(message_count, excluded.message_count)
+            ''', list(counts.items()))
+            conn.commit()
+            conn.close()
+
+    def _worker(self):
+        while True:
+            batch = self._next_batch()
+            stopping = None in batch
+            compact = COMPACT in batch
+            batch = [item for item in batch if item is not None and item != COMPACT]
+            try:
+                if batch:
+                    self._index_batch(batch)
+                if compact:
+                    self.compact()
+            except Exception as e:
+                print(f"Semantic indexing failed for {len(batch)} messages: {e}")
+                with self.lock:
+                    for chat_id, _, _, _ in batch:
+                        self._forget(chat_id)  # Re-queued on the chat's next update
+                time.sleep(1.0)
+            if stopping:
+                return
+
+    def start(self):
+        if self._needs_compaction():
+            self.queue.put(COMPACT)
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._worker, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self.queue.put(None)
+            self._thread.join(timeout=1.0)
+            self._thread = None
+
+    # ---- search ----
+    def search_vector(self, query_vector, k: int = 10) -> list:
+        # Returns [(score, chat_id, message_index)] best first.
+        # Holds the rows lock so that a compaction can't renumber the rows in between
+        with self.rows_lock:
+            return self._search_vector(query_vector, k)
+
+    def _search_vector(self, query_vector, k: int) -> list:
+        matrix = self.store.matrix()
+        rows = matrix.shape[0]
+        if rows == 0:
+            return []
+        query = normalize(np.asarray(query_vector).reshape(1, -1))[0]
+        if rows > RESCORE_CANDIDATES:
+            distances = hamming_distances(self.store.codes(rows), sign_codes(query.reshape(1, -1))[0])
+            rows_to_score = np.sort(np.argpartition(distances, RESCORE_CANDIDATES - 1)[:RESCORE_CANDIDATES])
+            scores = np.asarray(matrix[rows_to_score], dtype=np.float32) @ query
+        else:
+            rows_to_score = np.arange(rows)
+            scores = np.asarray(matrix, dtype=np.float32) @ query
+
+        # Over fetch to make up for rows of deleted chats, and fetch more while too few of them survive
+        fetch = k * 4
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        while True:
+            fetch = min(len(scores), fetch)
+            best = np.argpartition(-scores, fetch - 1)[:fetch]
+            best = best[np.argsort(-scores[best])]
+            candidates = rows_to_score[best]
+            scores_by_row = dict(zip(candidates.tolist(), scores[best].tolist()))
+            meta = {}
+            for first in range(0, len(candidates), 500):  # Stays under SQLite's variable limit
+                chunk = [int(row) for row in candidates[first:first + 500]]
+                cursor.execute(f'SELECT row_id, chat_id, message_index FROM message_vectors '
+                               f'WHERE row_id IN ({",".join("?" * len(chunk))})', chunk)
+                meta.update((row[0], (row[1], row[2])) for row in cursor.fetchall())
+            results = [(scores_by_row[row],) + meta[row] for row in candidates.tolist() if row in meta]
+            if len(results) >= k or fetch == len(scores):
+                break
+            fetch *= 4
+        conn.close()
+        return results[:k]
+
+    def search(self, text: str, k: int = 10) -> list:
+        return self.search_vector(self.embed_fn([text], self.model)[0], k)
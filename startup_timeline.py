@@ -0,0 +1,116 @@
+"""
+Startup timeline of the desktop app: when the main startup steps happened and how long the imports of heavy
+dependencies took, including the ones imported lazily later on (they show when they are first used).
+
+Import this module before anything else so its clock starts with the app. The report is printed or written
+as JSON on demand (`--startup-report` in llama_desktop_app.py, or the Ctrl+Alt+P menu).
+"""
+import importlib.util
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Top-level packages whose import time is worth watching
+HEAVY_MODULES = ("customtkinter", "tkinter", "ollama", "httpx", "psutil", "numpy", "aiohttp", "torch", "PIL")
+
+
+class StartupTimeline:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.events = []  # {"name", "at" (seconds since start), "duration" (None for a point in time), "kind"}
+        self.lock = threading.Lock()
+
+    def add(self, name: str, at: float, duration: float = None, kind: str = "step"):
+        with self.lock:
+            self.events.append({"name": name, "at": at, "duration": duration, "kind": kind})
+
+    def mark(self, name: str):
+        self.add(name, time.perf_counter() - self.start)
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, start - self.start, time.perf_counter() - start)
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            events = sorted(self.events, key=lambda event: event["at"])
+        return {"events": [dict(event, at_ms=round(event["at"] * 1000, 2),
+                                duration_ms=None if event["duration"] is None else round(event["duration"] * 1000, 2))
+                           for event in events]}
+
+    def report(self) -> str:
+        lines = ["Startup timeline (ms since launch)", "      at_ms  duration_ms  step"]
+        for event in self.to_dict()["events"]:
+            duration = "" if event["duration_ms"] is None else f"{event['duration_ms']:.1f}"
+            name = f"import {event['name']}" if event["kind"] == "import" else event["name"]
+            lines.append(f"{event['at_ms']:11.1f}  {duration:>11s}  {name}")
+        return "\n".join(lines)
+
+    def write(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+
+class TimedLoader:
+    # Wraps the loader of a watched module to time its execution (which includes the imports it makes)
+    def __init__(self, loader, name: str, timeline: StartupTimeline):
+        self.loader = loader
+        self.name = name
+        self.timeline = timeline
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module):
+        # The module only ever sees its real loader
+        module.__loader__ = self.loader
+        if module.__spec__ is not None:
+            module.__spec__.loader = self.loader
+        start = time.perf_counter()
+        try:
+            self.loader.exec_module(module)
+        finally:
+            self.timeline.add(self.name, start - self.timeline.start, time.perf_counter() - start, kind="import")
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+
+class ImportTimer:
+    # Meta path finder that lets the regular finders locate watched top-level modules and times their loading
+    def __init__(self, timeline: StartupTimeline, names):
+        self.timeline = timeline
+        self.names = set(names)
+        self.finding = set()
+
+    def find_spec(self, name, path=None, target=None):
+        if name not in self.names or name in self.finding:
+            return None
+        self.finding.add(name)
+        try:
+            spec = importlib.util.find_spec(name)
+        finally:
+            self.finding.discard(name)
+        if spec is None or spec.loader is None or not hasattr(spec.loader, "exec_module"):
+            return spec
+        spec.loader = TimedLoader(spec.loader, name, self.timeline)
+        return spec
+
+
+TIMELINE = StartupTimeline()
+_import_timer = None
+
+
+def watch_imports(names=HEAVY_MODULES):
+    # Times the first import of these modules from now on (modules already imported are not timed)
+    global _import_timer
+    if _import_timer is None:
+        _import_timer = ImportTimer(TIMELINE, names)
+        sys.meta_path.insert(0, _import_timer)
+    return _import_timer
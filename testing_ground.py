@@ -3,6 +3,7 @@ import tkinter as tk
 from tkinter import messagebox, scrolledtext,filedialog
 import json
 from utils import *
+from dialogs import CenteredTextInputDialog
 import ollama
 from ChatFileSystem import ChatMemory  # Add this import
 from concurrent.futures import ThreadPoolExecutor
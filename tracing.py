@@ -0,0 +1,224 @@
+"""
+Per-request tracing for the desktop app.
+
+A trace follows one prompt from the button press to the rendered reply. Spans share the trace id and are
+written when the trace finishes, one trace per line, as OTLP/JSON (the format of the OpenTelemetry collector
+file exporter, which Jaeger / Tempo / otel-desktop-viewer can load) or as Chrome trace events (chrome://tracing,
+ui.perfetto.dev). Only a `sample_rate` fraction of the prompts is traced, the others get NULL_TRACE whose
+methods do nothing.
+
+Model stages (load, prompt eval, decode) come from the durations Ollama reports, so they are laid out inside
+the request span rather than measured on this side; they are marked with derived=true.
+"""
+import json
+import os
+import random
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_CLIENT = 3
+
+
+class Span:
+    __slots__ = ("name", "span_id", "parent_id", "start_ns", "end_ns", "kind", "attributes")
+
+    def __init__(self, name: str, parent_id: str = None, start_ns: int = None, kind: int = SPAN_KIND_INTERNAL,
+                 attributes: dict = None):
+        self.name = name
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.start_ns = start_ns if start_ns is not None else time.time_ns()
+        self.end_ns = None
+        self.kind = kind
+        self.attributes = dict(attributes or {})
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+
+class Trace:
+    sampled = True
+
+    def __init__(self, tracer, name: str, attributes: dict = None):
+        self.tracer = tracer
+        self.trace_id = secrets.token_hex(16)
+        self.spans = []
+        self.finished = False
+        self.root = self.start_span(name, parent=None, **(attributes or {}))
+
+    def start_span(self, name: str, parent: Span = "root", start_ns: int = None, kind: int = SPAN_KIND_INTERNAL,
+                   **attributes) -> Span:
+        # Spans hang under the root span unless a parent (or None for the root itself) is given
+        if parent == "root":
+            parent = self.root
+        span = Span(name, parent.span_id if parent is not None else None, start_ns, kind, attributes)
+        self.spans.append(span)
+        return span
+
+    def end_span(self, span: Span, end_ns: int = None, **attributes):
+        if span is None or span.end_ns is not None:
+            return
+        span.attributes.update(attributes)
+        span.end_ns = end_ns if end_ns is not None else time.time_ns()
+
+    @contextmanager
+    def span(self, name: str, parent: Span = "root", kind: int = SPAN_KIND_INTERNAL, **attributes):
+        span = self.start_span(name, parent, kind=kind, **attributes)
+        try:
+            yield span
+        except Exception as e:
+            span.set(error=f"{type(e).__name__}: {e}")
+            raise
+        finally:
+            self.end_span(span)
+
+    def add_span(self, name: str, start_ns: int, end_ns: int, parent: Span = "root", **attributes) -> Span:
+        span = self.start_span(name, parent, start_ns=start_ns, **attributes)
+        span.end_ns = end_ns
+        return span
+
+    def add_ollama_spans(self, request: Span, response: dict):
+        # Lays the stages Ollama timed inside the request span: retrieval at its start, then load, prompt
+        # eval and decode back to back ending at the end of the request
+        if request is None or request.end_ns is None:
+            return
+        if response.get("retrieval_duration"):
+            self.add_span("retrieval", request.start_ns, request.start_ns + response["retrieval_duration"],
+                          parent=request, retrieved_chunks=response.get("retrieved_chunks", 0))
+        end = request.end_ns
+        for name, field, count_field in (("model.decode", "eval_duration", "eval_count"),
+                                         ("model.prompt_eval", "prompt_eval_duration", "prompt_eval_count"),
+                                         ("model.load", "load_duration", None)):
+            duration = response.get(field)
+            if not duration:
+                continue
+            start = max(request.start_ns, end - duration)
+            attributes = {"derived": True}
+            if count_field and response.get(count_field) is not None:
+                attributes["tokens"] = response[count_field]
+                attributes["tokens_per_second"] = round(response[count_field] / (duration / 1e9), 2)
+            self.add_span(name, start, end, parent=request, **attributes)
+            end = start
+
+    def finish(self, **attributes):
+        if self.finished:
+            return
+        self.finished = True
+        self.end_span(self.root, **attributes)
+        end = self.root.end_ns
+        for span in self.spans:  # Spans left open (e.g. after an error) end with the trace
+            if span.end_ns is None:
+                span.end_ns = end
+        self.tracer.export(self)
+
+
+class NullSpan:
+    def set(self, **attributes):
+        pass
+
+
+class NullTrace:
+    # Stand-in for traces that were not sampled
+    sampled = False
+    trace_id = None
+
+    def start_span(self, *args, **kwargs):
+        return None
+
+    def end_span(self, *args, **kwargs):
+        pass
+
+    @contextmanager
+    def span(self, *args, **kwargs):
+        yield NULL_SPAN
+
+    def add_span(self, *args, **kwargs):
+        return None
+
+    def add_ollama_spans(self, *args, **kwargs):
+        pass
+
+    def finish(self, **attributes):
+        pass
+
+
+NULL_SPAN = NullSpan()
+NULL_TRACE = NullTrace()
+
+
+def otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}  # int64 is a string in OTLP/JSON
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def otlp_payload(trace: Trace, service_name: str) -> dict:
+    spans = []
+    for span in trace.spans:
+        entry = {
+            "traceId": trace.trace_id,
+            "spanId": span.span_id,
+            "name": span.name,
+            "kind": span.kind,
+            "startTimeUnixNano": str(span.start_ns),
+            "endTimeUnixNano": str(span.end_ns),
+            "attributes": [{"key": key, "value": otlp_value(value)} for key, value in span.attributes.items()],
+        }
+        if span.parent_id:
+            entry["parentSpanId"] = span.parent_id
+        if "error" in span.attributes:
+            entry["status"] = {"code": 2, "message": str(span.attributes["error"])}
+        spans.append(entry)
+    return {"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": service_name}}]},
+        "scopeSpans": [{"scope": {"name": "llama_desktop_app"}, "spans": spans}],
+    }]}
+
+
+def chrome_events(trace: Trace, track: int) -> list:
+    # Complete ("X") events in microseconds, one track per trace
+    return [{"name": span.name, "cat": "llama", "ph": "X", "pid": os.getpid(), "tid": track,
+             "ts": span.start_ns / 1000, "dur": (span.end_ns - span.start_ns) / 1000,
+             "args": dict(span.attributes, trace_id=trace.trace_id)} for span in trace.spans]
+
+
+class Tracer:
+    def __init__(self, path: str = "traces.jsonl", sample_rate: float = 1.0, format: str = "otlp",
+                 service_name: str = "llama-desktop-app"):
+        if format not in ("otlp", "chrome"):
+            raise ValueError(f"Unknown trace format {format}, expected otlp or chrome")
+        self.path = path
+        self.sample_rate = sample_rate
+        self.format = format
+        self.service_name = service_name
+        self.lock = threading.Lock()
+        self.traces = 0
+
+    def start_trace(self, name: str, **attributes):
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return NULL_TRACE
+        return Trace(self, name, attributes)
+
+    def export(self, trace: Trace):
+        with self.lock:
+            self.traces += 1
+            try:
+                if self.format == "otlp":
+                    line = json.dumps(otlp_payload(trace, self.service_name)) + "\n"
+                else:
+                    # JSON array format, the closing bracket may be left out so traces can be appended
+                    events = chrome_events(trace, self.traces)
+                    line = "".join(json.dumps(event) + ",\n" for event in events)
+                    if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+                        line = "[\n" + line
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(line)
+            except OSError as e:
+                print(f"Could not write trace {trace.trace_id}: {e}")
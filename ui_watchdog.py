@@ -0,0 +1,201 @@
+"""
+Tk event-loop stall watchdog.
+
+A heartbeat is scheduled on the Tk loop every `interval` seconds and its lag (how much later than planned it ran)
+is recorded in a small histogram. Every Tk callback (after, bind, command...) is timed through a wrapped
+tkinter.CallWrapper, so a stall can be attributed to the callback that was running. When the heartbeat is
+late by more than `threshold`, a monitor thread samples the main thread's stack once; the stall is then written
+to a rotating log and reported through on_stall(stall) on the Tk thread.
+
+The cost with no stalls is two perf_counter calls per callback, one heartbeat per interval and a monitor thread
+that wakes up twice per interval.
+"""
+import logging
+import logging.handlers
+import sys
+import threading
+import time
+import tkinter
+import traceback
+
+LAG_BUCKETS_MS = (16, 33, 50, 100, 200, 500, 1000, 2000, 5000)  # Upper bounds, the last bucket is open
+STACK_LIMIT = 20  # Frames kept in a stall sample
+
+
+def callback_name(func) -> str:
+    func = getattr(func, "__func__", func)
+    code = getattr(func, "__code__", None)
+    # after() registers a local callit() wrapper, attribute the stall to the function it calls
+    if code is not None and code.co_name == "callit" and "func" in code.co_freevars and func.__closure__:
+        func = func.__closure__[code.co_freevars.index("func")].cell_contents
+        func = getattr(func, "__func__", func)
+        code = getattr(func, "__code__", None)
+    name = getattr(func, "__qualname__", None) or getattr(func, "__name__", None) or repr(func)
+    module = getattr(func, "__module__", None)
+    if module and module != "__main__":
+        name = f"{module}.{name}"
+    if code is not None and "<lambda>" in name:
+        name += f":{code.co_firstlineno}"
+    return name
+
+
+class UiWatchdog:
+    def __init__(self, root, threshold: float = 0.2, interval: float = 0.1, log_path: str = "ui_stalls.log",
+                 on_stall=None, max_log_bytes: int = 1_000_000, log_backups: int = 3):
+        self.root = root
+        self.threshold = threshold
+        self.interval = interval
+        self.on_stall = on_stall  # on_stall(stall dict), called on the Tk thread
+        self.main_thread_id = threading.get_ident()  # Must be created on the Tk thread
+        self.running = False
+        self.monitor = None
+        self.original_call_wrapper = None
+
+        # Callbacks currently on the Tk stack (nested loops such as dialogs can stack them)
+        self.active = []
+        self.slowest = (None, 0.0)  # Slowest callback since the last heartbeat
+        self.last_beat = time.perf_counter()
+        self.expected_beat = self.last_beat
+        self.sample = None  # (callback, stack) taken by the monitor during the current stall
+
+        self.beats = 0
+        self.lag_counts = [0] * (len(LAG_BUCKETS_MS) + 1)
+        self.max_lag = 0.0
+        self.stall_count = 0
+        self.stall_time = 0.0
+
+        self.logger = None
+        if log_path:
+            self.logger = logging.getLogger(f"ui_watchdog.{id(self)}")
+            self.logger.propagate = False
+            self.logger.setLevel(logging.INFO)
+            handler = logging.handlers.RotatingFileHandler(log_path, maxBytes=max_log_bytes,
+                                                           backupCount=log_backups, encoding="utf-8", delay=True)
+            handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+            self.logger.addHandler(handler)
+
+    def start(self):
+        if self.running:
+            return self
+        self.running = True
+        self.install_call_wrapper()
+        self.last_beat = self.expected_beat = time.perf_counter()
+        self.root.after(int(self.interval * 1000), self.beat)
+        self.monitor = threading.Thread(target=self.watch, daemon=True)
+        self.monitor.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.original_call_wrapper is not None:
+            tkinter.CallWrapper = self.original_call_wrapper
+            self.original_call_wrapper = None
+        if self.logger is not None:
+            for handler in self.logger.handlers:
+                handler.close()
+
+    # ---- callback timing ----
+    def install_call_wrapper(self):
+        # Tk callbacks registered from now on go through TimedCallWrapper (tkinter looks the class up at register time)
+        watchdog = self
+        original = tkinter.CallWrapper
+
+        class TimedCallWrapper(original):
+            def __init__(self, func, subst, widget):
+                super().__init__(func, subst, widget)
+                self.name = None
+
+            def __call__(self, *args):
+                if self.name is None:
+                    self.name = callback_name(self.func)
+                watchdog.active.append(self.name)
+                start = time.perf_counter()
+                try:
+                    return super().__call__(*args)
+                finally:
+                    duration = time.perf_counter() - start
+                    watchdog.active.pop()
+                    if duration > watchdog.slowest[1]:
+                        watchdog.slowest = (self.name, duration)
+
+        self.original_call_wrapper = original
+        tkinter.CallWrapper = TimedCallWrapper
+
+    # ---- heartbeat (Tk thread) ----
+    def beat(self):
+        if not self.running:
+            return
+        now = time.perf_counter()
+        lag = max(0.0, now - self.expected_beat)
+        self.record_lag(lag)
+        if lag >= self.threshold:
+            self.report_stall(lag)
+        self.slowest = (None, 0.0)
+        self.sample = None
+        self.last_beat = now
+        self.expected_beat = now + self.interval
+        self.root.after(int(self.interval * 1000), self.beat)
+
+    def record_lag(self, lag: float):
+        self.beats += 1
+        self.max_lag = max(self.max_lag, lag)
+        lag_ms = lag * 1000
+        for i, bound in enumerate(LAG_BUCKETS_MS):
+            if lag_ms <= bound:
+                self.lag_counts[i] += 1
+                return
+        self.lag_counts[-1] += 1
+
+    def report_stall(self, lag: float):
+        # The monitor's sample names the callback that was running mid-stall, otherwise use the slowest one
+        callback, stack = self.sample or (None, None)
+        if callback is None:
+            name, duration = self.slowest
+            # A callback shorter than half the lag didn't cause it, Tk itself was busy (layout, redraw...)
+            callback = name if name and duration >= lag / 2 else "Tk (no Python callback, e.g. layout or redraw)"
+        stall = {"duration": lag, "callback": callback, "stack": stack, "time": time.time()}
+        self.stall_count += 1
+        self.stall_time += lag
+        if self.logger is not None:
+            message = f"stall {lag * 1000:.0f} ms in {callback}"
+            if stack:
+                message += "\n" + "".join(stack).rstrip()
+            self.logger.info(message)
+        if self.on_stall is not None:
+            self.on_stall(stall)
+
+    # ---- monitor thread ----
+    def watch(self):
+        while self.running:
+            time.sleep(self.interval / 2)
+            if self.sample is not None:
+                continue
+            if time.perf_counter() - self.expected_beat < self.threshold:
+                continue
+            # Heartbeat overdue: the Tk thread is busy right now, see where
+            frame = sys._current_frames().get(self.main_thread_id)
+            if frame is None:
+                continue
+            stack = traceback.format_stack(frame, limit=STACK_LIMIT)
+            self.sample = (self.active[-1] if self.active else None, stack)
+
+    # ---- reporting ----
+    def lag_percentile(self, fraction: float) -> float:
+        # Upper bound of the histogram bucket holding the percentile, in ms (inf for the open bucket)
+        target = fraction * self.beats
+        seen = 0
+        for i, count in enumerate(self.lag_counts):
+            seen += count
+            if count and seen >= target:
+                return LAG_BUCKETS_MS[i] if i < len(LAG_BUCKETS_MS) else float("inf")
+        return 0.0
+
+    def summary(self) -> dict:
+        return {
+            "beats": self.beats,
+            "lag_p50_ms": self.lag_percentile(0.5),
+            "lag_p99_ms": self.lag_percentile(0.99),
+            "lag_max_ms": self.max_lag * 1000,
+            "stalls": self.stall_count,
+            "stall_time_s": self.stall_time,
+        }
@@ -1,114 +1,452 @@
-import platform
-import subprocess
 import os
-import psutil
-import customtkinter as ctk
-import ollama
+import re
+import sys
+import shlex
+from urllib.parse import urlparse
 import time
+import json
+from array import array
+from collections.abc import MutableSequence
 from datetime import datetime
+# psutil, ollama (through ollama_pool), subprocess, hashlib and the GUI toolkit are imported where they are first
+# needed, so that headless users of ChatObject / ChatMemory don't pay for them. The input dialog is in dialogs.py.
+
+# Backend configuration, overridable through the environment so the app and benchmarks
+# can point at a remote server or at the bundled fake server (fake_ollama_server.py)
+OLLAMA_HOST = os.environ.get("OLLAMA_HOST", "http://127.0.0.1:11434")
+if "://" not in OLLAMA_HOST:
+    OLLAMA_HOST = f"http://{OLLAMA_HOST}"
+# Extra endpoints for load balancing, comma separated urls. The first one defaults to OLLAMA_HOST
+OLLAMA_HOSTS = [host.strip() for host in os.environ.get("OLLAMA_HOSTS", OLLAMA_HOST).split(",") if host.strip()]
+OLLAMA_HOSTS = [host if "://" in host else f"http://{host}" for host in OLLAMA_HOSTS]
+# Devices to start a dedicated local server on (e.g. "0,1" or "CPU,0"), one port each from the base port
+LOCAL_DEVICES = [device.strip() for device in os.environ.get("OLLAMA_LOCAL_DEVICES", "").split(",") if device.strip()]
+LOCAL_DEVICES_BASE_PORT = int(os.environ.get("OLLAMA_LOCAL_BASE_PORT", "11500"))
+USE_FAKE_SERVER = os.environ.get("OLLAMA_FAKE_SERVER", "") not in ("", "0")
+FAKE_SERVER_ARGS = shlex.split(os.environ.get("OLLAMA_FAKE_ARGS", ""))  # e.g. "--token-latency 0.02"
+_ollama_pool = None
+
+def parse_flag(value: str) -> bool:
+    lowered = str(value).strip().lower()
+    if lowered in ("1", "true", "yes", "on"):
+        return True
+    if lowered in ("0", "false", "no", "off"):
+        return False
+    raise ValueError(f"Expected true/false, got {value}")
+
+KEEP_ALIVE_DURATION = re.compile(r"(\d+(\.\d*)?(ns|us|µs|ms|s|m|h))+")
+
+def parse_keep_alive(value: str):
+    # Ollama takes a number of seconds (-1 keeps the model loaded, 0 unloads it) or a duration such as "5m" or
+    # "1h30m". Numbers have to be sent as JSON numbers, Ollama rejects "300" or "-1" as durations
+    value = str(value).strip()
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    if not KEEP_ALIVE_DURATION.fullmatch(value):
+        raise ValueError(f"Expected seconds or a duration like 5m, got {value}")
+    return value
+
+# Generation options that can be tuned per chat / per model, with the type used to parse them.
+# keep_alive is sent as a top level request field, reuse_context switches the request path
+# (see get_response_with_context), the rest go into the request's "options".
+GENERATION_OPTIONS = {
+    "num_ctx": int,
+    "num_thread": int,
+    "num_batch": int,
+    "num_gpu": int,
+    "keep_alive": parse_keep_alive,
+    "reuse_context": parse_flag,
+}
+# Timing fields returned by Ollama with every completed request (durations are in nanoseconds),
+# plus the number of prompt tokens served from a reused context and document retrieval timing
+METRIC_FIELDS = ["total_duration", "load_duration", "prompt_eval_count", "prompt_eval_duration",
+                 "eval_count", "eval_duration", "reused_context_tokens", "retrieval_duration", "retrieved_chunks"]
+
+class MessageList(MutableSequence):
+    """
+    Chat messages stored column wise: interned roles and contents in two parallel lists, keys other than
+    role / content (rare) in a side dict. Indexing, slicing and iteration build plain {"role", "content"} dicts
+    on demand, so they are copies: write a changed message back with messages[i] = message.
+    """
+    __slots__ = ("roles", "contents", "extras")
+
+    def __init__(self, messages=()):
+        self.roles = []
+        self.contents = []
+        self.extras = {}  # index -> {other keys}
+        self.extend(messages)
+
+    def __len__(self):
+        return len(self.contents)
+
+    def _message(self, index: int) -> dict:
+        message = {"role": self.roles[index], "content": self.contents[index]}
+        if self.extras and index in self.extras:
+            message.update(self.extras[index])
+        return message
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._message(i) for i in range(*index.indices(len(self.contents)))]
+        if index < 0:
+            index += len(self.contents)
+        if not 0 <= index < len(self.contents):
+            raise IndexError("message index out of range")
+        return self._message(index)
+
+    def __iter__(self):
+        extras = self.extras
+        for index, (role, content) in enumerate(zip(self.roles, self.contents)):
+            message = {"role": role, "content": content}
+            if extras and index in extras:
+                message.update(extras[index])
+            yield message
+
+    def _store(self, index: int, message: dict):
+        self.roles[index] = sys.intern(message["role"])
+        self.contents[index] = message["content"]
+        self.extras.pop(index, None)
+        if len(message) > 2:
+            self.extras[index] = {key: value for key, value in message.items() if key not in ("role", "content")}
+
+    def __setitem__(self, index, message):
+        if isinstance(index, slice):
+            messages = list(self)
+            messages[index] = message
+            self.clear()
+            self.extend(messages)
+            return
+        if index < 0:
+            index += len(self.contents)
+        if not 0 <= index < len(self.contents):
+            raise IndexError("message index out of range")
+        self._store(index, message)
+
+    def __delitem__(self, index):
+        if isinstance(index, slice) or self.extras:
+            messages = list(self)
+            del messages[index]
+            self.clear()
+            self.extend(messages)
+            return
+        del self.roles[index]
+        del self.contents[index]
+
+    def insert(self, index: int, message: dict):
+        if index < 0:
+            index = max(0, index + len(self.contents))
+        if index < len(self.contents) and self.extras:
+            # Extras are keyed by position, shift the ones after the insertion point
+            self.extras = {i + 1 if i >= index else i: extra for i, extra in self.extras.items()}
+        index = min(index, len(self.contents))
+        self.roles.insert(index, None)
+        self.contents.insert(index, None)
+        self._store(index, message)
+
+    def append(self, message: dict):
+        self.roles.append(sys.intern(message["role"]))
+        self.contents.append(message["content"])
+        if len(message) > 2:
+            self.extras[len(self.contents) - 1] = {key: value for key, value in message.items()
+                                                   if key not in ("role", "content")}
+
+    def extend(self, messages):
+        if isinstance(messages, MessageList):
+            offset = len(self.contents)
+            self.roles.extend(messages.roles)
+            self.contents.extend(messages.contents)
+            self.extras.update((offset + i, dict(extra)) for i, extra in messages.extras.items())
+            return
+        if not isinstance(messages, (list, tuple)):
+            messages = list(messages)
+        # Column at a time, much faster than appending one message at a time when loading a long chat
+        offset = len(self.contents)
+        intern = sys.intern
+        roles = [intern(message["role"]) for message in messages]
+        contents = [message["content"] for message in messages]
+        self.roles.extend(roles)
+        self.contents.extend(contents)
+        for i, message in enumerate(messages):
+            if len(message) > 2:
+                self.extras[offset + i] = {key: value for key, value in message.items()
+                                           if key not in ("role", "content")}
+
+    def clear(self):
+        self.roles.clear()
+        self.contents.clear()
+        self.extras.clear()
+
+    def tolist(self) -> list:
+        # Plain list of dicts (for JSON or the Ollama client), faster than list(messages)
+        messages = [{"role": role, "content": content} for role, content in zip(self.roles, self.contents)]
+        for index, extra in self.extras.items():
+            messages[index].update(extra)
+        return messages
+
+    copy = tolist
+
+    def __add__(self, other) -> list:
+        return self.tolist() + list(other)
+
+    def __radd__(self, other) -> list:
+        return list(other) + self.tolist()
+
+    def __eq__(self, other):
+        if isinstance(other, (MessageList, list)):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    def __repr__(self):
+        return f"MessageList({list(self)!r})"
+
+
+class ReplyTimes(array):
+    """Reply durations in seconds as a typed array of doubles (8 bytes each instead of a float object)."""
+
+    def __new__(cls, values=()):
+        return super().__new__(cls, "d", values)
+
+    def clear(self):
+        del self[:]
+
+    def __reduce_ex__(self, protocol):
+        return (type(self), (self.tolist(),))
+
+
+def compact_reply_times(values):
+    try:
+        return values if isinstance(values, ReplyTimes) else ReplyTimes(values)
+    except TypeError:  # e.g. a null in an old export, keep the list as it is
+        return values
+
 
 class ChatObject:
+    # Slots and compact containers keep long chats small in memory, see MessageList / ReplyTimes.
+    # messages, reply_times and addressed_models accept plain lists and convert them on assignment;
+    # use messages.tolist() / list(reply_times) to get JSON serializable lists
+    __slots__ = ("name", "_messages", "_reply_times", "_addressed_models", "instructions", "options",
+                 "turn_metrics", "kv_context", "creation_time")
+
     def __init__(self, name: str,
                  messages: list = None,
                  reply_times: list = None,
                  addressed_models: list = None,
                  instructions: str = None,
-                 creation_time: str = None):  # Parameter for creation time
+                 creation_time: str = None,  # Parameter for creation time
+                 options: dict = None,
+                 turn_metrics: list = None,
+                 kv_context: dict = None):
         self.name = name
         self.messages = messages if messages is not None else []
         self.reply_times = reply_times if reply_times is not None else []
         self.addressed_models = addressed_models if addressed_models is not None else []
         self.instructions = instructions if instructions is not None else ""
+        self.options = options if options is not None else {}  # Per chat generation options (override model profile)
+        self.turn_metrics = turn_metrics if turn_metrics is not None else []  # One dict per reply, aligned with reply_times
+        # Server evaluated context tokens of the conversation so far, see get_response_with_context
+        self.kv_context = kv_context if kv_context is not None else {}
         # Store creation time as a datetime object
         if creation_time is None:
             self.creation_time = datetime.now().isoformat()  # Store as ISO string
         else:
             self.creation_time = creation_time  # Use the provided ISO string
-class CenteredTextInputDialog(ctk.CTkToplevel):
-    def __init__(self, master=None, width=300, height=200, max_length=None, initial_text="", **kwargs):
-        super().__init__(master)
-        self.width = width
-        self.height = height
-        self.max_length = max_length  # Max length for input text
-        self.title(kwargs.get("title", "Input"))
-        self.result = None
 
-        self.frame = ctk.CTkFrame(self)
-        self.frame.pack(padx=20, pady=20, fill="both", expand=True)
+    @property
+    def messages(self) -> MessageList:
+        return self._messages
+
+    @messages.setter
+    def messages(self, messages):
+        self._messages = messages if isinstance(messages, MessageList) else MessageList(messages)
+
+    @property
+    def reply_times(self) -> ReplyTimes:
+        return self._reply_times
+
+    @reply_times.setter
+    def reply_times(self, reply_times):
+        self._reply_times = compact_reply_times(reply_times)
 
-        self.label = ctk.CTkLabel(self.frame, text=kwargs.get("text", "Enter text:"))
-        self.label.pack(pady=(0, 10))
+    @property
+    def addressed_models(self) -> list:
+        return self._addressed_models
 
-        self.text_widget = ctk.CTkTextbox(self.frame, width=width-40, height=height-120)  # Adjusted height
-        self.text_widget.pack(pady=(0, 10), fill="both", expand=True)
+    @addressed_models.setter
+    def addressed_models(self, addressed_models):
+        # Model names repeat on every turn, interning stores each distinct name once
+        self._addressed_models = [sys.intern(model) if isinstance(model, str) else model
+                                  for model in addressed_models]
 
-        # Insert initial text into the text widget
-        self.text_widget.insert("1.0", initial_text)  # Insert at line 1, character 0
 
-        if self.max_length is not None:
-            self.text_widget.bind("<KeyPress>", self.prevent_excess_input)
+_TURN_METRICS = ChatObject.turn_metrics  # The slot, wrapped by LazyChatObject's property
 
-        button_frame = ctk.CTkFrame(self.frame)
-        button_frame.pack(fill="x", pady=(10, 0))  # Added vertical padding
 
-        button_style = {
-            "width": 120,  # Increased width
-            "height": 40,  # Increased height
-            "corner_radius": 8,  # Rounded corners
-            "border_width": 2,  # Added border
-            "font": ("Arial", 14, "bold")  # Larger, bold font
-        }
+class LazyChatObject(ChatObject):
+    """
+    A stored chat opened without its history: name, instructions, options and server context are read up
+    front, the messages, reply times, models and turn metrics on first use. Until then the chat can be shown
+    page by page from storage (chat_view.ChatMemorySource). Pickles as a plain, loaded ChatObject.
+    """
+    __slots__ = ("_load",)
 
-        self.ok_button = ctk.CTkButton(button_frame, text="OK", command=self.on_ok, **button_style)
-        self.ok_button.pack(side="left", padx=(0, 10))
+    def __init__(self, chat_id: str, header: dict, load):
+        # header: {"name", "instructions", "options", "kv_context"}; load() -> the full ChatObject (or None)
+        self.name = header["name"]
+        self.instructions = header.get("instructions") or ""
+        self.options = header.get("options") or {}
+        self.kv_context = header.get("kv_context") or {}
+        self.creation_time = chat_id
+        self._load = load
 
-        self.cancel_button = ctk.CTkButton(button_frame, text="Cancel", command=self.on_cancel, **button_style)
-        self.cancel_button.pack(side="right")
+    @classmethod
+    def open(cls, chat_memory, chat_id: str):
+        # chat_memory: ChatMemory or one of the backend clients with the same methods. None if there's no such chat
+        header = chat_memory.get_chat_header(chat_id)
+        if header is None:
+            return None
+        return cls(chat_id, header, lambda: chat_memory.get_chat_by_timestamp(chat_id))
 
-        self.withdraw()  # Hide the window initially
-        self.after(0, self.center_and_show)  # Schedule centering and showing
+    @property
+    def loaded(self) -> bool:
+        return self._load is None
 
-    def prevent_excess_input(self, event=None):
-        """Prevent further input when the text reaches max_length."""
-        current_text = self.text_widget.get("1.0", "end-1c")  # Get current text without trailing newline
-        if len(current_text) >= self.max_length and event.keysym not in ("BackSpace", "Delete"):
-            return "break"  # Block any further input except for backspace and delete
+    def _ensure_loaded(self):
+        if self._load is None:
+            return
+        load, self._load = self._load, None
+        chat = load() or ChatObject(self.name)  # Deleted meanwhile, an empty history
+        ChatObject.messages.fset(self, chat.messages)
+        ChatObject.reply_times.fset(self, chat.reply_times)
+        ChatObject.addressed_models.fset(self, chat.addressed_models)
+        _TURN_METRICS.__set__(self, chat.turn_metrics)
 
-    def center_and_show(self):
-        self.update_idletasks()  # Ensure size calculations are correct
-        x = (self.winfo_screenwidth() // 2) - (self.width // 2)
-        y = (self.winfo_screenheight() // 2) - (self.height // 2)
-        self.geometry(f"{self.width}x{self.height}+{x}+{y}")
-        self.deiconify()  # Show the window
+    @property
+    def messages(self) -> MessageList:
+        self._ensure_loaded()
+        return self._messages
 
-    def on_ok(self):
-        self.result = self.text_widget.get("1.0", ctk.END).strip()
-        self.destroy()  # Close the window
+    @messages.setter
+    def messages(self, messages):
+        self._ensure_loaded()
+        ChatObject.messages.fset(self, messages)
 
-    def on_cancel(self):
-        self.result = None
-        self.destroy()  # Close the window
+    @property
+    def reply_times(self) -> ReplyTimes:
+        self._ensure_loaded()
+        return self._reply_times
 
-    def get_input(self):
-        self.master.wait_window(self)
-        return self.result
+    @reply_times.setter
+    def reply_times(self, reply_times):
+        self._ensure_loaded()
+        ChatObject.reply_times.fset(self, reply_times)
 
+    @property
+    def addressed_models(self) -> list:
+        self._ensure_loaded()
+        return self._addressed_models
+
+    @addressed_models.setter
+    def addressed_models(self, addressed_models):
+        self._ensure_loaded()
+        ChatObject.addressed_models.fset(self, addressed_models)
+
+    @property
+    def turn_metrics(self) -> list:
+        self._ensure_loaded()
+        return _TURN_METRICS.__get__(self)
+
+    @turn_metrics.setter
+    def turn_metrics(self, turn_metrics):
+        self._ensure_loaded()
+        _TURN_METRICS.__set__(self, turn_metrics)
+
+    def __reduce_ex__(self, protocol):
+        return ChatObject, (self.name, self.messages, self.reply_times, self.addressed_models, self.instructions,
+                            self.creation_time, self.options, self.turn_metrics, self.kv_context)
+
+
+def get_ollama_pool():
+    global _ollama_pool
+    if _ollama_pool is None:
+        from ollama_pool import OllamaPool
+        _ollama_pool = OllamaPool.from_urls(OLLAMA_HOSTS)
+    return _ollama_pool
 
 def get_available_models():
-    models_dict = ollama.list()
-    model_list = [model['name'] for model in models_dict['models']]
-    return model_list
+    pool = get_ollama_pool()
+    pool.check_all()
+    return pool.list_models()
+
+def get_device_id(selected_gpu: str):
+    # Maps a GPU dropdown entry ("0, NVIDIA GeForce ...", "MPS", "CPU") to the device a server is pinned to
+    if not selected_gpu or selected_gpu == "CPU":
+        return None
+    return selected_gpu.split(",")[0].strip()
+
+def get_server_command(host: str = OLLAMA_HOST):
+    if USE_FAKE_SERVER:
+        address = urlparse(host)
+        fake_server_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_ollama_server.py")
+        return [sys.executable, fake_server_path,
+                "--host", address.hostname or "127.0.0.1",
+                "--port", str(address.port or 11434)] + FAKE_SERVER_ARGS
+    return ["ollama", "serve"]
+
+def is_server_alive(host: str = OLLAMA_HOST, timeout: float = 0.5) -> bool:
+    import urllib.request
+    try:
+        with urllib.request.urlopen(host.rstrip("/") + "/", timeout=timeout) as response:
+            return response.status == 200
+    except (OSError, ValueError):
+        return False
+
+def wait_for_server(host: str = OLLAMA_HOST, process=None, timeout: float = 30.0,
+                    initial_delay: float = 0.05, max_delay: float = 1.0) -> bool:
+    # Polls the server root with exponential backoff, giving up early if the spawned process died
+    deadline = time.monotonic() + timeout
+    delay = initial_delay
+    while time.monotonic() < deadline:
+        if is_server_alive(host):
+            return True
+        if process is not None and process.poll() is not None:
+            return False
+        time.sleep(min(delay, max(0.0, deadline - time.monotonic())))
+        delay = min(delay * 2, max_delay)
+    return is_server_alive(host)
 
 def start_ollama_server():
+    # Returns None when a server is already listening on OLLAMA_HOST (it is reused, and not ours to stop)
+    if is_server_alive():
+        return None
+    import subprocess
     process = subprocess.Popen(
-        ["ollama", "serve"],
+        get_server_command(),
         stdout=subprocess.DEVNULL,
         stderr=subprocess.DEVNULL
     )
-    time.sleep(3)  # Give some time for the server to start
     return process
 
+def ensure_ollama_server(timeout: float = 30.0):
+    # Reuses or spawns the server and waits until it answers. Returns (process or None, ready)
+    process = start_ollama_server()
+    return process, wait_for_server(process=process, timeout=timeout)
+
+def start_local_device_servers():
+    # Starts one server per configured device and registers them with the pool. Returns the processes
+    if not LOCAL_DEVICES:
+        return []
+    from ollama_pool import OllamaEndpoint, start_device_servers
+    urls, processes = start_device_servers(LOCAL_DEVICES, LOCAL_DEVICES_BASE_PORT,
+                                           lambda address: get_server_command(f"http://{address}"))
+    pool = get_ollama_pool()
+    for url, device in zip(urls, LOCAL_DEVICES):
+        pool.add_endpoint(OllamaEndpoint(url, device=None if device.upper() == "CPU" else device))
+    return processes
+
 def terminate_with_children(process):
+    import psutil
     parent = psutil.Process(process.pid)
     for child in parent.children(recursive=True):  # Terminate child processes
         child.terminate()
@@ -116,9 +454,10 @@ def terminate_with_children(process):
     parent.wait()
 
 def check_gpu_availability():
+    import subprocess
     try:
         gpu_list = ["CPU"]  # Start with CPU option
-        if platform.system() == "Darwin":
+        if sys.platform == "darwin":
             from torch.backends import mps
             if mps.is_available():
                 gpu_list.append("MPS")
@@ -133,22 +472,216 @@ def check_gpu_availability():
         print("nvidia-smi not found. Please ensure CUDA or MPS is installed and accessible.")
         return ["CPU"]
 
-def get_response(curr_chat: ChatObject, model: str, selected_gpu: str):
+def parse_generation_options(raw_options: dict) -> dict:
+    # Converts user entered strings to typed options, dropping empty values. Raises ValueError on bad input
+    options = {}
+    for key, value in raw_options.items():
+        if key not in GENERATION_OPTIONS:
+            raise ValueError(f"Unknown generation option '{key}'")
+        if value is None or str(value).strip() == "":
+            continue
+        try:
+            options[key] = GENERATION_OPTIONS[key](str(value).strip())
+        except ValueError:
+            raise ValueError(f"Invalid value for '{key}': {value}")
+    return options
+
+def resolve_generation_options(model_options: dict = None, chat_options: dict = None):
+    # Chat options override the model profile. Returns (ollama options, keep_alive)
+    merged = dict(model_options or {})
+    merged.update(chat_options or {})
+    keep_alive = merged.pop("keep_alive", None)
+    if isinstance(keep_alive, str):
+        try:
+            keep_alive = parse_keep_alive(keep_alive)  # Saved as a string before it was parsed
+        except ValueError:
+            keep_alive = None
+    merged.pop("reuse_context", None)
+    return merged, keep_alive
+
+def recorded_options(model_options: dict = None, chat_options: dict = None) -> dict:
+    # The options a turn ran with, as stored in its metrics
+    options, keep_alive = resolve_generation_options(model_options, chat_options)
+    if keep_alive is not None:
+        options["keep_alive"] = keep_alive
+    return options
+
+def is_context_reuse_enabled(model_options: dict = None, chat_options: dict = None) -> bool:
+    merged = dict(model_options or {})
+    merged.update(chat_options or {})
+    return bool(merged.get("reuse_context"))
+
+def extract_turn_metrics(response, options: dict = None) -> dict:
+    metrics = {field: response.get(field) for field in METRIC_FIELDS if response.get(field) is not None}
+    if options:
+        metrics["options"] = dict(options)
+    return metrics
+
+def response_from_turn(content: str, metrics: dict) -> dict:
+    # Rebuilds a chat response from a turn answered elsewhere (API server, backend process)
+    response = {"message": {"role": "assistant", "content": content}}
+    response.update((field, value) for field, value in metrics.items() if field in METRIC_FIELDS)
+    return response
+
+def augment_with_documents(message: dict, chunks: list) -> dict:
+    # Returns a copy of the user message with the retrieved excerpts in front of it
+    excerpts = "\n\n".join(f"[{os.path.basename(chunk['path'])}]\n{chunk['text']}" for chunk in chunks)
+    content = ("Use the following excerpts from the attached documents if they are relevant.\n\n"
+               f"{excerpts}\n\nQuestion: {message['content']}")
+    return {"role": message["role"], "content": content}
+
+def prepare_messages(curr_chat: ChatObject, retriever=None):
+    # Returns (messages to send in place of the history, retrieval metrics).
+    # Retrieved chunks only go into what is sent for this turn, the stored history stays as typed
+    sent_messages = curr_chat.messages
+    retrieval = {}
+    if retriever is not None and sent_messages and sent_messages[-1]["role"] == "user":
+        retrieval_start = time.perf_counter()
+        chunks = retriever(curr_chat, sent_messages[-1]["content"])
+        retrieval = {"retrieval_duration": int((time.perf_counter() - retrieval_start) * 1e9),
+                     "retrieved_chunks": len(chunks)}
+        if chunks:
+            sent_messages = sent_messages[:-1] + [augment_with_documents(sent_messages[-1], chunks)]
+    return sent_messages, retrieval
+
+def stream_from_pool(model: str, device: str, method: str, piece_of, on_piece, **kwargs):
+    # Runs a streaming chat / generate call, handing each content piece to on_piece.
+    # Returns (final part with the timing fields, full content)
+    final, pieces = {}, []
+    with get_ollama_pool().lease(model, device) as endpoint:
+        for part in getattr(endpoint.client, method)(model=model, stream=True, **kwargs):
+            piece = piece_of(part)
+            if piece:
+                pieces.append(piece)
+                on_piece(piece)
+            if part.get("done"):
+                final = dict(part)
+    return final, "".join(pieces)
+
+def get_response(curr_chat: ChatObject, model: str, selected_gpu: str, model_options: dict = None,
+                 retriever=None, on_piece=None):
+    # retriever(chat, query) -> [{"path", "text", ...}] adds the most relevant attached document chunks.
+    # on_piece(text) streams the reply as it is generated, the full response is still returned at the end
     start = time.time()
-    if selected_gpu != "CPU":
-        os.environ["CUDA_VISIBLE_DEVICES"] = selected_gpu.split(":")[0]
-        print(f"Running on GPU {selected_gpu}")
-    else:
-        print("No GPU selected, running on CPU.")
+    # The device is chosen by routing to a server started on it, the client environment has no effect
+    device = get_device_id(selected_gpu)
+    sent_messages, retrieval = prepare_messages(curr_chat, retriever)
 
     # If instructions exist, prepend them to the messages
-    messages = curr_chat.messages.copy()
+    messages = sent_messages.copy()
     if curr_chat.instructions:
         messages.insert(0, {"role": "system", "content": curr_chat.instructions})
-    response = ollama.chat(model=model, messages=messages)
+    options, keep_alive = resolve_generation_options(model_options, curr_chat.options)
+    if is_context_reuse_enabled(model_options, curr_chat.options):
+        response = get_response_with_context(curr_chat, model, device, options, keep_alive, sent_messages, on_piece)
+    elif on_piece is not None:
+        response, content = stream_from_pool(model, device, "chat", lambda part: part["message"]["content"], on_piece,
+                                             messages=messages, options=options or None, keep_alive=keep_alive)
+        response["message"] = {"role": "assistant", "content": content}
+    else:
+        response = get_ollama_pool().chat(model, messages, device=device,
+                                          options=options or None, keep_alive=keep_alive)
+    if retrieval:
+        response = dict(response)
+        response.update(retrieval)
     end = time.time()
     return response, (end - start)
 
+def prefill_chat(curr_chat: ChatObject, model: str, selected_gpu: str, model_options: dict = None) -> dict:
+    # Loads the model and evaluates the instructions and history the next get_response will send (one token is
+    # generated), so that the server's prompt cache already holds them and only the new message is left to
+    # evaluate. Chats with context reuse send their history as evaluated context, for them the model is only
+    # loaded. Returns the timing fields of the request and "prefilled" ("history" or "load")
+    device = get_device_id(selected_gpu)
+    options, keep_alive = resolve_generation_options(model_options, curr_chat.options)
+    if not curr_chat.messages or is_context_reuse_enabled(model_options, curr_chat.options):
+        response = get_ollama_pool().generate(model, device=device, prompt="", keep_alive=keep_alive)
+        prefilled = "load"
+    else:
+        messages = curr_chat.messages.tolist()
+        if curr_chat.instructions:
+            messages.insert(0, {"role": "system", "content": curr_chat.instructions})
+        # Same options as the real request (a different num_ctx would reload the model), one token to generate
+        response = get_ollama_pool().chat(model, messages, device=device, options=dict(options or {}, num_predict=1),
+                                          keep_alive=keep_alive)
+        prefilled = "history"
+    result = {field: response.get(field) for field in ("total_duration", "load_duration", "prompt_eval_count",
+                                                       "prompt_eval_duration") if response.get(field) is not None}
+    result["prefilled"] = prefilled
+    return result
+
+def embed_texts(texts: list, model: str) -> list:
+    # Batch embedding through the pool, falls back to one request per text on older servers / clients
+    import ollama
+
+    def call(client):
+        try:
+            return client.embed(model=model, input=texts)["embeddings"]
+        except (AttributeError, ollama.ResponseError):
+            return [client.embeddings(model=model, prompt=text)["embedding"] for text in texts]
+    return get_ollama_pool().request(model, call)
+
+def context_fingerprint(model: str, instructions: str, messages: list) -> str:
+    # Identifies the exact conversation a stored context was evaluated from
+    import hashlib
+    payload = json.dumps([model, instructions, messages], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def format_transcript(messages: list) -> str:
+    # A single new user message is sent as is, the model template wraps it as a user turn
+    if len(messages) == 1 and messages[0]["role"] == "user":
+        return messages[0]["content"]
+    return "\n\n".join(f"{message['role'].capitalize()}: {message['content']}" for message in messages)
+
+def get_response_with_context(curr_chat: ChatObject, model: str, device: str = None,
+                              options: dict = None, keep_alive=None, sent_messages: list = None, on_piece=None):
+    # Uses /api/generate and its returned context so that only the messages added since the last
+    # turn are evaluated. The stored context is dropped when the model, instructions or history changed.
+    # sent_messages is what to send in place of the history (same length, e.g. with retrieved excerpts).
+    # The fingerprint covers the messages as sent, so a context evaluated with excerpts that are no longer
+    # in front of a message is not reused
+    messages = curr_chat.messages
+    sent_messages = sent_messages if sent_messages is not None else messages
+    stored = curr_chat.kv_context
+    covered = stored.get("message_count", 0)
+    reusable = (stored.get("model") == model and 0 < covered < len(messages) and
+                stored.get("fingerprint") == context_fingerprint(model, curr_chat.instructions, sent_messages[:covered]))
+    if reusable:
+        request = {"prompt": format_transcript(sent_messages[covered:]), "context": stored["tokens"]}
+    else:
+        request = {"prompt": format_transcript(sent_messages), "system": curr_chat.instructions or None}
+
+    if on_piece is not None:
+        result, content = stream_from_pool(model, device, "generate", lambda part: part["response"], on_piece,
+                                           options=options or None, keep_alive=keep_alive, **request)
+        result["response"] = content
+    else:
+        result = get_ollama_pool().generate(model, device=device, options=options or None,
+                                            keep_alive=keep_alive, **request)
+    reply = {"role": "assistant", "content": result["response"]}
+    curr_chat.kv_context = {
+        "model": model,
+        "tokens": list(result.get("context") or []),
+        "message_count": len(messages) + 1,  # The reply is appended by the caller
+        "fingerprint": context_fingerprint(model, curr_chat.instructions, sent_messages + [reply]),
+    }
+
+    # Shaped like a chat response so callers don't care which path was taken
+    response = {field: result.get(field) for field in METRIC_FIELDS if result.get(field) is not None}
+    response["model"] = model
+    response["message"] = reply
+    response["reused_context_tokens"] = len(stored["tokens"]) if reusable else 0
+    return response
+
+
+def validate_message(index: int, message):
+    # Raises ValueError for a malformed message of an imported chat
+    if not isinstance(message, dict):
+        raise ValueError(f"Invalid message format at index {index}: Expected a dictionary")
+    if not all(key in message for key in ["role", "content"]):
+        raise ValueError(f"Invalid message format at index {index}: Missing 'role' or 'content' keys")
+    if not message["role"] or not message["content"]:
+        raise ValueError(f"Invalid message format at index {index}: 'role' or 'content' cannot be empty")
 
 def validate_data_structure(chat_data):
     try:
@@ -161,12 +694,7 @@ def validate_data_structure(chat_data):
 
         # Validate the structure of each message in the 'messages' list
         for index, message in enumerate(chat_data["messages"]):
-            if not isinstance(message, dict):
-                raise ValueError(f"Invalid message format at index {index}: Expected a dictionary")
-            if not all(key in message for key in ["role", "content"]):
-                raise ValueError(f"Invalid message format at index {index}: Missing 'role' or 'content' keys")
-            if not message["role"] or not message["content"]:
-                raise ValueError(f"Invalid message format at index {index}: 'role' or 'content' cannot be empty")
+            validate_message(index, message)
 
         # Validate that the data aligns
         num_of_reply_times = len(chat_data["reply_times"])
@@ -174,8 +702,24 @@ def validate_data_structure(chat_data):
         if(len(chat_data["reply_times"]) != len(chat_data["addressed_models"])):
             raise ValueError(f"Number of  reply_times {num_of_reply_times} doesn't match number of addressed_models {num_of_addresed_models}")
 
+        # Optional keys added after the original export format. Options are checked like user entered ones and
+        # stored back typed, so unknown keys or bad values aren't sent with every request of the imported chat
+        if "options" in chat_data:
+            if not isinstance(chat_data["options"], dict):
+                raise ValueError("Invalid chat data format: 'options' should be a dictionary")
+            chat_data["options"] = parse_generation_options(chat_data["options"])
+        if "turn_metrics" in chat_data and not isinstance(chat_data["turn_metrics"], list):
+            raise ValueError("Invalid chat data format: 'turn_metrics' should be a list")
+
     except ValueError as e:
         return e
 
     return None #Meaning passed check
 
+
+def __getattr__(name):
+    # The input dialog moved to dialogs.py, still importable from here without loading the GUI toolkit up front
+    if name == "CenteredTextInputDialog":
+        from dialogs import CenteredTextInputDialog
+        return CenteredTextInputDialog
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")